@@ -1,6 +1,50 @@
 MAX_DAYS = 30
+# How far inside the MAX_DAYS horizon a sync starts when its high-water mark has fallen behind it
+SYNC_HORIZON_MARGIN_MINUTES = 10
 URL = "https://dnaspaces.io/api/location/v1/history"
 MAX_REQUEST_RETRIES = 10
 REQUEST_TIMEOUT = 240
+TIMEOUT_INCREMENT = 60
+BACKOFF_BASE_SECONDS = 2
+MAX_BACKOFF_SECONDS = 120
 HOURLY_TIME_CHUNK_SIZE = 24.0
+MIN_HOURLY_TIME_CHUNK_SIZE = 0.25
+ADAPTIVE_REQUEST_RETRIES = 2
+ADAPTIVE_TARGET_SECONDS_LOW = 30
+ADAPTIVE_TARGET_SECONDS_HIGH = 180
+ADAPTIVE_GROW_MAX_BYTES = 50 * 1024 * 1024
 CONVERT_FILE_CHUNK_SIZE = 10000
+COLUMNAR_ROW_GROUP_SIZE = 1000000
+OUTPUT_FORMATS = ["csv", "parquet", "feather"]
+DEFAULT_JOBS = 1
+SCAN_BUFFER_SIZE = 8 * 1024 * 1024
+DEFAULT_WORKERS = 1
+MAX_WORKERS = 8
+DEFAULT_GLOBAL_WORKERS = 16
+STITCH_BUFFER_SIZE = 1024 * 1024
+RAW_STREAM_BLOCK_SIZE = 1024 * 1024
+LAST_LINE_BYTES = 4096
+GZIP_COMPRESSION_LEVEL = 6
+ZSTD_COMPRESSION_LEVEL = 3
+CACHE_MIN_WINDOW_AGE_SECONDS = 60 * 60
+DEFAULT_CACHE_SIZE_MB = 10 * 1024
+DEFAULT_STORE_FILENAME = "history.db"
+DEFAULT_CONTACT_MINUTES = 15
+DEFAULT_COLOCATION_RADIUS = 2.0
+DEFAULT_COLOCATION_SECONDS = 60
+DEFAULT_DWELL_RADIUS = 3.0
+DEFAULT_DWELL_GAP_SECONDS = 5 * 60
+DEFAULT_OCCUPANCY_MINUTES = 15
+CHUNK_SAMPLE_ROWS = 1000
+CHUNK_MEMORY_FACTOR = 4
+MIN_CONVERT_CHUNK_SIZE = 100
+DEFAULT_GENERATOR_DEVICES = 5000
+DEFAULT_GENERATOR_FLOORS = 40
+DAEMON_HOST = "127.0.0.1"
+DEFAULT_DAEMON_PORT = 8765
+DEFAULT_JOB_MINUTES = 5
+DAEMON_RUN_HISTORY = 100
+DAEMON_TOKEN_ENV = "DAEMON_TOKEN"
+DEDUP_WINDOW_ROWS = 250000
+DEDUP_BOUNDARY_MS = 1000
+TIMEZONE_TABLE_PAD_DAYS = 31
@@ -32,22 +32,22 @@ history_dict = {
     'buildingid': 'category',
     'floorid': 'category',
     'floorhierarchy': 'str',
-    'coordinatex': 'str',
-    'coordinatey': 'str',
-    'sourcetimestamp': 'str',
+    'coordinatex': 'float32',
+    'coordinatey': 'float32',
+    'sourcetimestamp': 'datetime',
     'maxdetectedapmac': 'str',
     'maxdetectedband': 'category',
     'detectingcontrollers': 'category',
-    'firstactiveat': 'str',
+    'firstactiveat': 'datetime',
     'locatedsinceactivecount': 'str',
-    'changedon': 'str',
+    'changedon': 'datetime',
     'manufacturer': 'str',
     'associated': 'str',
-    'maxdetectedrssi': 'str',
+    'maxdetectedrssi': 'Int16',
     'ssid': 'category',
     'username': 'str',
     'associatedapmac': 'str',
-    'associatedaprssi': 'str',
+    'associatedaprssi': 'Int16',
     'maxdetectedslot': 'str',
     'ipaddress': 'str',
     'staticdevice': 'str',
@@ -64,7 +64,25 @@ import numpy as np
 from pytz import all_timezones
 from tzlocal import get_localzone
 import os
-from constants import CONVERT_FILE_CHUNK_SIZE
+import csv
+from io import BytesIO
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+from history_compression import get_compression, strip_compression_extension, open_history
+from history_filter import filter_lines, filter_rows, select_columns, use_columns, line_filter, \
+    add_filter_arguments, get_history_filter
+from history_memory import parse_size, progress
+from history_metrics import run_metrics
+from history_timezones import SiteTimezones, SITE_COLUMNS, load_site_timezones
+from constants import OUTPUT_FORMATS, CONVERT_FILE_CHUNK_SIZE, COLUMNAR_ROW_GROUP_SIZE, DEFAULT_JOBS, \
+    SCAN_BUFFER_SIZE, CHUNK_SAMPLE_ROWS, CHUNK_MEMORY_FACTOR, MIN_CONVERT_CHUNK_SIZE
+
+DATE_COLS = ["sourcetimestamp", "firstactiveat", "changedon"]
+# Epoch milliseconds outside this range cannot be held as datetime64[ns]
+MAX_EPOCH_MS = 9.2e12
+
 
 def change_timezone(col, timezone):
     # Must have tz set otherwise will fail
@@ -80,31 +98,437 @@ def timestamp_to_date(col):
     return pd.to_datetime(col, origin='unix', unit='ms', utc=True, errors="coerce")
 
 
-def convert_history(data_file, timezone, keep_original):
-    logging.debug(f"Converting data file {data_file} from timestamp to local timezone.")
-    date_cols = ["sourcetimestamp", "firstactiveat", "changedon"]
-    chunk_size = CONVERT_FILE_CHUNK_SIZE
+def epoch_ms(col):
+    # Epoch milliseconds as an int64 array plus a mask of the values that are missing, zero or out of range. Some
+    # timestamps are zero and must not end up as 1/1/1970.
+    values = pd.to_numeric(col, errors="coerce").to_numpy(dtype="float64", na_value=np.nan)
+    missing = np.isnan(values) | (values == 0) | (np.abs(values) > MAX_EPOCH_MS)
+    return np.where(missing, 0, values).astype("int64"), missing
+
+
+def utc_datetimes(col):
+    (ms, missing) = epoch_ms(col)
+    utc = pd.DatetimeIndex(ms.astype("datetime64[ms]").astype("datetime64[ns]"), tz="UTC")
+    return utc.where(~missing)
+
+
+def local_datetimes(col, timezone, df=None):
+    # Convert a column of epoch milliseconds to naive local datetime64 values in one vectorised pass. With
+    # SiteTimezones each row is converted to the time zone of its site in df.
+    if isinstance(timezone, SiteTimezones):
+        (ms, missing) = epoch_ms(col)
+        return timezone.local_datetimes(ms, missing, df)
+    return utc_datetimes(col).tz_convert(timezone).tz_localize(None).to_numpy()
+
+
+def format_datetimes(values):
+    # Format datetime64 values as "%Y-%m-%d %H:%M:%S" strings in bulk by writing the separator into the ISO string
+    # buffer. NaT becomes an empty string.
+    text = values.astype("datetime64[s]").astype("U19")
+    chars = text.view("U1").reshape(len(text), 19)
+    chars[:, 10] = " "
+    chars[np.isnat(values)] = ""
+    return text
+
+
+def read_history_chunks(source, chunksize=CONVERT_FILE_CHUNK_SIZE, usecols=None):
+    # Read an open raw or converted history csv in chunks of strings, leaving empty fields as empty strings
+    return pd.read_csv(source, chunksize=chunksize, dtype=str, keep_default_na=False, usecols=usecols)
+
+
+def history_read_dtypes():
+    # read_csv dtypes of the non date columns from history_dict, as the columnar formats store them. The chunk size of
+    # the columnar formats is measured on a sample read with them.
+    return {col: "object" if dtype == "str" else dtype for (col, dtype) in history_dict.items() if dtype != "datetime"}
+
+
+def header_columns(header):
+    return next(csv.reader([header.decode().rstrip("\r\n")]))
+
+
+def history_csv_options(columns):
+    # read_csv options that write every non date column back to csv exactly as it was read. Category columns keep their
+    # text and all the others are read as strings, so numbers are never rounded or turned into floats.
+    return {"dtype": {col: "category" if history_dict.get(col) == "category" else str
+                      for col in columns if col not in DATE_COLS},
+            "keep_default_na": False, "na_values": {col: [""] for col in DATE_COLS}}
+
+
+def get_chunk_size(source_file, max_memory, compression=None, chunks=1, columnar=False):
+    # Rows per chunk so that the chunks being converted at once fit in max_memory bytes. The memory of a row is
+    # measured on a sample of the file read the way the chosen reader reads it, with the history_dict dtypes for the
+    # columnar formats and as text for csv, allowing CHUNK_MEMORY_FACTOR times that for the converted chunk and its
+    # output. chunks is the number of chunks held at once. Without a budget the fixed CONVERT_FILE_CHUNK_SIZE is used.
+    if max_memory is None:
+        return CONVERT_FILE_CHUNK_SIZE
+    try:
+        with open_history(source_file, "rb", compression=compression) as f:
+            if columnar:
+                sample = pd.read_csv(f, nrows=CHUNK_SAMPLE_ROWS, dtype=history_read_dtypes())
+            else:
+                columns = header_columns(f.readline())
+                sample = pd.read_csv(f, nrows=CHUNK_SAMPLE_ROWS, header=None, names=columns,
+                                     **history_csv_options(columns))
+    except (IOError, ValueError) as e:
+        logging.error(f"Unable to sample {source_file} to size chunks. Got error {e}.")
+        return CONVERT_FILE_CHUNK_SIZE
+    if len(sample) == 0:
+        return CONVERT_FILE_CHUNK_SIZE
+    row_bytes = sample.memory_usage(index=True, deep=True).sum() / len(sample)
+    chunk_size = max(MIN_CONVERT_CHUNK_SIZE, int(max_memory / (chunks * row_bytes * CHUNK_MEMORY_FACTOR)))
+    logging.info(f"Converting {source_file} in chunks of {chunk_size:,} rows of about {row_bytes:,.0f} bytes each to "
+                 f"stay within {max_memory / 1024 ** 2:,.0f}MB.")
+    return chunk_size
+
+
+def convert_chunk(df, timezone):
+    # Replace the epoch millisecond date columns with timezone aware datetimes. With SiteTimezones the rows are in
+    # different time zones, so the datetimes are the naive local time of each site.
+    for col in [col for col in DATE_COLS if col in df.columns]:
+        if isinstance(timezone, SiteTimezones):
+            df[col] = pd.Series(local_datetimes(df[col], timezone, df), index=df.index)
+        else:
+            df[col] = change_timezone(pd.Series(utc_datetimes(df[col]), index=df.index), timezone)
+    return df
+
+
+def format_chunk(df, timezone):
+    # Replace the epoch millisecond date columns with local date time strings ready to be written to csv
+    for col in [col for col in DATE_COLS if col in df.columns]:
+        df[col] = format_datetimes(local_datetimes(df[col], timezone, df))
+    return df
+
+
+def timezone_columns(timezone):
+    # The columns that have to be read to convert the dates, even when --columns leaves them out of the output
+    return SITE_COLUMNS if isinstance(timezone, SiteTimezones) else []
+
+
+def convert_lines(header, lines, timezone, history_filter=None):
+    # Convert a batch of raw CSV lines (bytes without the header line) straight from the API and return the converted
+    # CSV rows as bytes with the number of rows. Non date columns are passed through as text exactly as received. Only
+    # the rows and columns kept by history_filter are parsed and converted, and without a timezone they are only
+    # filtered.
+    lines = filter_lines(history_filter, lines)
+    if len(lines) == 0:
+        return b"", 0
+    df = pd.read_csv(BytesIO(header + b"\n" + b"\n".join(lines)), dtype=str, keep_default_na=False,
+                     usecols=use_columns(history_filter, timezone_columns(timezone)))
+    df = filter_rows(df, history_filter)
+    if timezone is not None:
+        df = format_chunk(df, timezone)
+    return select_columns(df, history_filter).to_csv(header=False, index=False).encode(), len(df)
+
+
+def apply_history_dtypes(df):
+    # Give the non date columns of a converted chunk the dtypes from history_dict
+    for (col, dtype) in history_dict.items():
+        if col not in df.columns or dtype in ("datetime", "str"):
+            continue
+        if dtype == "category":
+            df[col] = df[col].astype("category")
+        else:
+            df[col] = pd.to_numeric(df[col], errors="coerce").astype(dtype)
+    return df
+
+
+def history_arrow_schema(columns, timezone):
+    import pyarrow as pa
+    # With SiteTimezones every row is in the local time of its own site, so the datetimes have no time zone
+    datetime_timezone = None if isinstance(timezone, SiteTimezones) else str(timezone)
+    arrow_types = {"category": pa.dictionary(pa.int32(), pa.string()),
+                   "float32": pa.float32(),
+                   "Int16": pa.int16(),
+                   "datetime": pa.timestamp("ms", tz=datetime_timezone),
+                   "str": pa.string()}
+    return pa.schema([(col, arrow_types[history_dict.get(col, "str")]) for col in columns])
+
+
+def get_output_filename(data_file, output_format):
+    if output_format == "csv":
+        return data_file
+    return os.path.splitext(strip_compression_extension(data_file))[0] + "." + output_format
+
+
+def open_columnar_writer(out_file, schema, output_format):
+    import pyarrow as pa
+    if output_format == "parquet":
+        import pyarrow.parquet as pq
+        return pq.ParquetWriter(out_file, schema)
+    return pa.ipc.new_file(out_file, schema)
+
+
+def write_row_group(writer, frames, schema):
+    import pyarrow as pa
+    table = pa.Table.from_pandas(pd.concat(frames, ignore_index=True), schema=schema, preserve_index=False)
+    if isinstance(writer, pa.ipc.RecordBatchFileWriter):
+        writer.write_table(table, max_chunksize=len(table))
+    else:
+        writer.write_table(table, row_group_size=len(table))
+    return len(table)
+
+
+def convert_history_columnar(data_file, out_file, timezone, output_format, compression=None, history_filter=None,
+                             chunk_size=CONVERT_FILE_CHUNK_SIZE):
+    # Write the converted history as Parquet or Feather (Arrow IPC) with the history_dict schema. Rows are grouped into
+    # row groups (record batches for Feather) that never span more than one local day of sourcetimestamp.
+    try:
+        import pyarrow
+    except ImportError as e:
+        logging.error(f"Writing {output_format} needs pyarrow. Install it with pip install pyarrow. Got error {e}")
+        return None
+    writer = None
+    schema = None
+    frames = []
+    buffered_rows = 0
+    buffered_day = None
+    total_rows = 0
+    chunk_started = perf_counter()
+    try:
+        with open_history(data_file, "rb", compression=compression) as source:
+            for df in read_history_chunks(source, chunk_size,
+                                          usecols=use_columns(history_filter, timezone_columns(timezone))):
+                df = convert_chunk(filter_rows(df, history_filter), timezone)
+                df = apply_history_dtypes(select_columns(df, history_filter))
+                if writer is None:
+                    schema = history_arrow_schema(df.columns, timezone)
+                    writer = open_columnar_writer(out_file, schema, output_format)
+                if "sourcetimestamp" in df.columns:
+                    days = df["sourcetimestamp"].dt.date.ffill()
+                else:
+                    days = pd.Series(0, index=df.index)
+                runs = (days != days.shift()).cumsum()
+                for (_, day_df) in df.groupby(runs, sort=False):
+                    day = days[day_df.index[0]]
+                    if frames and (day != buffered_day or buffered_rows >= COLUMNAR_ROW_GROUP_SIZE):
+                        total_rows += write_row_group(writer, frames, schema)
+                        logging.info(f"Converted {total_rows:,} rows written to {out_file}.")
+                        frames = []
+                        buffered_rows = 0
+                    frames.append(day_df)
+                    buffered_rows += len(day_df)
+                    buffered_day = day
+                run_metrics.record_chunk(out_file, len(df), perf_counter() - chunk_started)
+                chunk_started = perf_counter()
+        if frames:
+            total_rows += write_row_group(writer, frames, schema)
+            logging.info(f"Converted {total_rows:,} rows written to {out_file}.")
+    except pd.errors.EmptyDataError as e:
+        logging.error(f"Unable to open csv file to convert. Got error {e}.")
+        return None
+    except IOError as e:
+        logging.error(f"Unable to write {output_format} file {out_file}. Got error {e}.")
+        return None
+    finally:
+        if writer is not None:
+            writer.close()
+    return out_file
+
+
+def convert_history_serial(source_file, data_file, timezone, compression_level=None,
+                           chunk_size=CONVERT_FILE_CHUNK_SIZE):
+    # The source file has the .old extension so its compression is taken from the name of the converted file
     first_chuck = True
+    total_rows = 0
+    started = chunk_started = perf_counter()
+    compression = get_compression(data_file)
+    try:
+        with open_history(source_file, "rb", compression=compression) as source, \
+                open_history(data_file, "wt", compression_level) as f:
+            columns = header_columns(source.readline())
+            for df in pd.read_csv(source, chunksize=chunk_size, header=None, names=columns,
+                                  **history_csv_options(columns)):
+                df = format_chunk(df, timezone)
+                df.to_csv(f, header=first_chuck)
+                first_chuck = False
+                total_rows += len(df)
+                run_metrics.record_chunk(data_file, len(df), perf_counter() - chunk_started)
+                chunk_started = perf_counter()
+                logging.info(f"Converted {total_rows:,} rows written to {data_file}. {progress(total_rows, started)}.")
+    except IOError as e:
+        logging.error(f"Unable to write csv file {data_file}. Got error {e}.")
+        return None
+    except pd.errors.EmptyDataError as e:
+        logging.error(f"Unable to open csv file to convert. Got error {e}.")
+        return None
+    except ValueError as e:
+        logging.error(f"Unable to convert csv file {source_file}. Got error {e}.")
+        return None
+    return data_file
+
+
+def convert_filtered_rows(header, lines, rows, timezone, history_filter):
+    df = pd.read_csv(BytesIO(header + b"\n" + b"\n".join(lines)),
+                     usecols=use_columns(history_filter, timezone_columns(timezone)),
+                     **history_csv_options(header_columns(header)))
+    df.index = rows
+    return select_columns(format_chunk(filter_rows(df, history_filter), timezone), history_filter)
+
+
+def convert_history_filtered(source_file, data_file, timezone, history_filter, compression_level=None,
+                             chunk_size=CONVERT_FILE_CHUNK_SIZE):
+    # Convert only the rows and columns kept by history_filter. Lines that cannot match are thrown away on their raw
+    # bytes before pandas sees them. The row index column keeps the row numbers of the source file.
+    compression = get_compression(data_file)
+    total_rows = 0
+    started = chunk_started = perf_counter()
+    try:
+        with open_history(source_file, "rb", compression=compression) as source, \
+                open_history(data_file, "wt", compression_level) as f:
+            header = source.readline().rstrip(b"\r\n")
+            keep_line = line_filter(history_filter)
+            lines = []
+            rows = []
+            first_chunk = True
+            for (row, line) in enumerate(source):
+                if keep_line is None or keep_line(line):
+                    lines.append(line.rstrip(b"\r\n"))
+                    rows.append(row)
+                if len(lines) >= chunk_size:
+                    df = convert_filtered_rows(header, lines, rows, timezone, history_filter)
+                    df.to_csv(f, header=first_chunk)
+                    first_chunk = False
+                    total_rows += len(df)
+                    run_metrics.record_chunk(data_file, len(df), perf_counter() - chunk_started)
+                    chunk_started = perf_counter()
+                    logging.info(f"Converted {total_rows:,} of {row + 1:,} rows written to {data_file}. "
+                                 f"{progress(row + 1, started)}.")
+                    lines = []
+                    rows = []
+            df = convert_filtered_rows(header, lines, rows, timezone, history_filter)
+            df.to_csv(f, header=first_chunk)
+            total_rows += len(df)
+            run_metrics.record_chunk(data_file, len(df), perf_counter() - chunk_started)
+            logging.info(f"Converted {total_rows:,} rows written to {data_file}.")
+    except IOError as e:
+        logging.error(f"Unable to write csv file {data_file}. Got error {e}.")
+        return None
+    except (pd.errors.EmptyDataError, ValueError) as e:
+        logging.error(f"Unable to convert csv file {source_file}. Got error {e}.")
+        return None
+    return data_file
+
+
+def chunk_byte_ranges(data_file, chunk_size):
+    # Find the byte ranges of the file holding chunk_size data lines each. Converting each range on its own gives the
+    # same result as the matching chunk of the serial reader. Returns the header line and the list of ranges.
+    ranges = []
+    with open(data_file, "rb") as f:
+        header = f.readline()
+        start = f.tell()
+        position = start
+        lines = 0
+        while True:
+            buffer = f.read(SCAN_BUFFER_SIZE)
+            if not buffer:
+                break
+            newlines = np.flatnonzero(np.frombuffer(buffer, dtype=np.uint8) == ord("\n"))
+            for i in range(chunk_size - 1 - lines % chunk_size, len(newlines), chunk_size):
+                end = position + int(newlines[i]) + 1
+                ranges.append((start, end))
+                start = end
+            lines += len(newlines)
+            position += len(buffer)
+    if position > start:
+        ranges.append((start, position))
+    return header, ranges
+
+
+def convert_byte_range(source_file, header, start, end, first_row, timezone, include_header):
+    # Returns the converted csv text of the range with the number of rows
+    with open(source_file, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    df = pd.read_csv(BytesIO(header + data), **history_csv_options(header_columns(header)))
+    df.index += first_row
+    df = format_chunk(df, timezone)
+    return df.to_csv(header=include_header), len(df)
+
+
+def write_converted_range(f, result, data_file, last_written):
+    # The workers convert chunks at the same time, so a chunk is recorded as taking the wall clock seconds since the
+    # chunk before it was written and the seconds of a run add up to how long the conversion took. Returns when the
+    # chunk was written.
+    (text, rows) = result
+    f.write(text)
+    written = perf_counter()
+    run_metrics.record_chunk(data_file, rows, written - last_written)
+    return written
+
+
+def convert_history_parallel(source_file, data_file, timezone, jobs, compression_level=None,
+                             chunk_size=CONVERT_FILE_CHUNK_SIZE, executor=None):
+    # Convert chunks in a process pool and write them back in their original order. At most 2 * jobs chunks are in
+    # flight so memory use does not grow with the size of the file. A long running process can pass a pool of its own
+    # so the workers are not started again for every file.
+    (header, ranges) = chunk_byte_ranges(source_file, chunk_size)
+    if not ranges:
+        # A file with only a header is converted as one empty range so the output still has the converted header
+        ranges = [(len(header), len(header))]
+    logging.debug(f"Converting {len(ranges)} chunks of {source_file} with {jobs} processes.")
     total_chunks = 0
+    started = perf_counter()
+    last_written = started
+    try:
+        with (ProcessPoolExecutor(max_workers=jobs) if executor is None else nullcontext(executor)) as executor, \
+                open_history(data_file, "wt", compression_level) as f:
+            pending = deque()
+            for (index, (start, end)) in enumerate(ranges):
+                if len(pending) >= 2 * jobs:
+                    last_written = write_converted_range(f, pending.popleft().result(), data_file, last_written)
+                    total_chunks += chunk_size
+                    logging.info(f"Converted file chunk {total_chunks:,} written to {data_file}. "
+                                 f"{progress(total_chunks, started)}.")
+                pending.append(executor.submit(convert_byte_range, source_file, header, start, end,
+                                               index * chunk_size, timezone, index == 0))
+            while pending:
+                last_written = write_converted_range(f, pending.popleft().result(), data_file, last_written)
+                total_chunks += chunk_size
+                logging.info(f"Converted file chunk {total_chunks:,} written to {data_file}. "
+                             f"{progress(total_chunks, started)}.")
+    except IOError as e:
+        logging.error(f"Unable to write csv file {data_file}. Got error {e}.")
+        return None
+    except ValueError as e:
+        logging.error(f"Unable to convert csv file {source_file}. Got error {e}.")
+        return None
+    return data_file
+
+
+def convert_history(data_file, timezone, keep_original, output_format="csv", jobs=DEFAULT_JOBS,
+                    compression_level=None, history_filter=None, max_memory=None, executor=None):
+    logging.debug(f"Converting data file {data_file} from timestamp to local timezone.")
+    if output_format != "csv":
+        chunk_size = get_chunk_size(data_file, max_memory, get_compression(data_file), columnar=True)
+        out_file = convert_history_columnar(data_file, get_output_filename(data_file, output_format), timezone,
+                                            output_format, get_compression(data_file), history_filter, chunk_size)
+        if out_file is not None and not keep_original:
+            try:
+                os.remove(data_file)
+            except IOError as e:
+                logging.error(f"Tried to delete original file {data_file} but failed with error {e}")
+        return out_file
     try:
         tmp_data_file = data_file + ".old"
         os.rename(data_file, tmp_data_file)
-        try:
-            for df in pd.read_csv(tmp_data_file, chunksize=chunk_size):
-                # Some timestamps are zero and need to replace with Nan to avoid getting set to 1/1/1970
-                df[date_cols] = df[date_cols].replace(to_replace=0, value=np.nan)
-                df.update(df[date_cols].apply(pd.to_datetime, origin='unix', unit='ms', utc=True, errors="coerce"))
-                df.update(df[date_cols].apply(change_timezone, args=(timezone,)))
-                try:
-                    df.to_csv(data_file, date_format='%Y-%m-%d %H:%M:%S.%f'[:-3], mode='a', header=first_chuck)
-                    first_chuck = False
-                    total_chunks += chunk_size
-                    logging.info(f"Converted file chunk {total_chunks:,} written to {data_file}.")
-                except IOError as e:
-                    logging.error(f"Unable to write csv file {data_file}. Got error {e}.")
-                    return None
-        except pd.errors.EmptyDataError as e:
-            logging.error(f"Unable to open csv file to convert. Got error {e}.")
+        if jobs > 1 and get_compression(data_file) is not None:
+            logging.info(f"Compressed file {data_file} cannot be split into byte ranges. Converting with one process.")
+            jobs = 1
+        if history_filter is not None:
+            jobs = 1
+        # The parallel conversion keeps up to 2 * jobs chunks in flight
+        chunk_size = get_chunk_size(tmp_data_file, max_memory, get_compression(data_file), 2 * jobs if jobs > 1 else 1)
+        if history_filter is not None:
+            logging.debug(f"Converting the rows and columns kept by the filters of {data_file} with one process.")
+            converted_file = convert_history_filtered(tmp_data_file, data_file, timezone, history_filter,
+                                                      compression_level, chunk_size)
+        elif jobs > 1:
+            converted_file = convert_history_parallel(tmp_data_file, data_file, timezone, jobs, compression_level,
+                                                      chunk_size, executor)
+        else:
+            converted_file = convert_history_serial(tmp_data_file, data_file, timezone, compression_level,
+                                                    chunk_size)
+        if converted_file is None:
             return None
     except IOError as e:
         logging.error(f"Tried to rename old file {data_file}.old but failed with error {e}")
@@ -128,6 +552,18 @@ if __name__ == '__main__':
                         help="Time zone offset in hours minutes HH:MM e.g. 10:00 or -4:00")
     parser.add_argument("-ko", "--keep_original", dest="keep_original", default=False, action='store_true',
                         help="Keep the original file with timestamps as .old")
+    parser.add_argument("-fmt", "--format", dest="output_format", choices=OUTPUT_FORMATS, default="csv",
+                        help="Output format. parquet and feather keep column types and need pyarrow installed.")
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=DEFAULT_JOBS,
+                        help="Number of processes to convert a csv file with.")
+    parser.add_argument("-cl", "--compression_level", dest="compression_level", type=int,
+                        help="Compression level when the filename ends in .gz (default 6) or .zst (default 3).")
+    parser.add_argument("-mm", "--max-memory", dest="max_memory", type=parse_size,
+                        help="Memory budget e.g. 512MB that sets the number of rows converted at a time.")
+    parser.add_argument("-stz", "--site_timezones", dest="site_timezones",
+                        help="JSON file mapping buildingid and campusid to time zones. Rows of other sites are "
+                             "converted to the timezone.")
+    add_filter_arguments(parser)
     args = parser.parse_args()
     if args.timezone is None:
         tz = get_localzone()
@@ -137,4 +573,8 @@ if __name__ == '__main__':
         logging.error(f"Timezone {args.timezone} is not valid. Using local timezone {tz}")
     else:
         tz = args.timezone
-    convert_history(args.filename, tz, args.keep_original)
+    if args.site_timezones is not None:
+        # Falls back to the one timezone if the file is not valid
+        tz = load_site_timezones(args.site_timezones, tz) or tz
+    convert_history(args.filename, tz, args.keep_original, args.output_format, args.jobs, args.compression_level,
+                    get_history_filter(args), args.max_memory)
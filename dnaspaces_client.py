@@ -0,0 +1,149 @@
+#
+# dnaspaces_client.py holds a pooled HTTP session to DNA Spaces with the retry policy for the history API. Connections
+# are kept alive between requests and time windows, failed requests back off exponentially with jitter and the
+# Retry-After header is honoured when the service is rate limiting. With a HistoryCache windows that were downloaded
+# before are read from disk instead.
+import logging
+import random
+import threading
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from time import sleep
+import requests
+from requests.adapters import HTTPAdapter
+from history_cache import get_tenant_key
+from constants import URL, MAX_REQUEST_RETRIES, REQUEST_TIMEOUT, MAX_WORKERS, BACKOFF_BASE_SECONDS, \
+    MAX_BACKOFF_SECONDS, TIMEOUT_INCREMENT
+
+# Status codes worth trying again. Anything else that is not 200 will fail the same way every time.
+RETRY_STATUS_CODES = [408, 429, 500, 502, 503, 504]
+
+
+class DnaSpacesClient:
+    def __init__(self, token, url=URL, max_retries=MAX_REQUEST_RETRIES, timeout=REQUEST_TIMEOUT,
+                 pool_size=MAX_WORKERS, cache=None):
+        self.url = url
+        self.cache = cache
+        self.tenant = get_tenant_key(token)
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Authorization": "Bearer " + token,
+                                     "Accept-Encoding": "gzip, deflate",
+                                     "Connection": "keep-alive"})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    def backoff_delay(self, attempts, response=None):
+        # Full jitter exponential backoff so concurrent requests do not retry in lockstep. A Retry-After header from
+        # a 429 or 503 takes precedence.
+        retry_after = get_retry_after(response)
+        if retry_after is not None:
+            return min(retry_after, MAX_BACKOFF_SECONDS)
+        return random.uniform(0, min(MAX_BACKOFF_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempts))
+
+    def get_history(self, payload, max_retries=None, stats=None):
+        # Request one time window of history as a stream. Returns the response, which may not be 200 if the status is
+        # not worth retrying or all attempts failed, or None if no attempt got a response. The number of retries and
+        # timeout increases are added to stats if given.
+        stats = {} if stats is None else stats
+        stats["retries"] = 0
+        stats["timeout_escalations"] = 0
+        if self.cache is not None:
+            cached_response = self.cache.get_response(self.tenant, payload)
+            if cached_response is not None:
+                return cached_response
+        max_retries = self.max_retries if max_retries is None else max_retries
+        attempts = 0
+        current_timeout = self.timeout
+        response = None
+        while attempts < max_retries:
+            response = None
+            try:
+                response = self.session.get(self.url, params=payload, stream=True, timeout=current_timeout)
+                if response.status_code == requests.codes.ok:
+                    break
+                logging.error(f"{attempts}.Error with REST to DNA Spaces got {response.status_code} "
+                              f"should have got {requests.codes.ok}. Service may be too busy.")
+                if response.status_code not in RETRY_STATUS_CODES:
+                    break
+                logging.error(f"This is attempt {attempts} of maximum {max_retries}. Retrying..")
+            except requests.ConnectionError as e:
+                logging.error(f"Got a network connection error {e}. Please check {self.url} is reachable.")
+            except requests.Timeout as e:
+                logging.error(f"Got a timeout with request {e}. Incrementing timeout {current_timeout}")
+                current_timeout += TIMEOUT_INCREMENT
+                stats["timeout_escalations"] += 1
+            except requests.exceptions.RequestException as e:
+                logging.error(f"Got an unknown exception from requests {e}. Exiting.")
+                raise SystemExit(e)
+            attempts += 1
+            if attempts < max_retries:
+                stats["retries"] += 1
+                delay = self.backoff_delay(attempts, response)
+                # Give the connection back to the pool rather than holding it while waiting
+                if response is not None:
+                    response.close()
+                logging.debug(f"Waiting {delay:.1f} seconds before trying again.")
+                sleep(delay)
+        if self.cache is not None and response is not None and response.status_code == requests.codes.ok:
+            return self.cache.store_response(self.tenant, payload, response)
+        return response
+
+
+class ClientPool:
+    # Clients kept open between runs of a long running process so their connections are reused. There is one client
+    # for each token, URL and pool size. Clients must only be used by one run at a time.
+    def __init__(self):
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get(self, token, url=URL, pool_size=MAX_WORKERS, cache=None):
+        with self.lock:
+            client = self.clients.get((token, url, pool_size))
+            if client is None:
+                logging.debug(f"Opening a session to {url} for tenant {get_tenant_key(token)}.")
+                client = DnaSpacesClient(token, url=url, pool_size=pool_size)
+                self.clients[(token, url, pool_size)] = client
+        # The cache can be different for every run
+        client.cache = cache
+        return client
+
+    def close(self):
+        with self.lock:
+            for client in self.clients.values():
+                client.close()
+            self.clients = {}
+
+
+def get_retry_after(response):
+    # Retry-After is either a number of seconds or an HTTP date
+    if response is None or response.status_code not in [429, 503]:
+        return None
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is None:
+        return None
+    try:
+        return max(float(retry_after), 0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
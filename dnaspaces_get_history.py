@@ -5,16 +5,28 @@
 # You need to set your environment variable TOKEN to the token you configure in Cisco DNA Spaces. See README for
 # more details.
 from argparse import ArgumentParser
-from datetime import datetime, timedelta, timezone
+from datetime import datetime
+from collections import deque
+from contextlib import nullcontext
+import json
 import requests
 import logging
 from os import path, access, W_OK, environ
 from get_date_range import get_date_range
-from convert_history import convert_history
-from get_date_range import convert_timestamp_millisecond
-from constants import URL, MAX_REQUEST_RETRIES, REQUEST_TIMEOUT
+from history_manifest import new_manifest, load_manifest, save_manifest, record_window, windows_to_fetch, \
+    mark_converted, all_windows_complete
+from dnaspaces_client import DnaSpacesClient
+from history_compression import get_compression, check_compression
+from history_cache import HistoryCache
+from history_sync import get_sync_start, get_sync_run_filename, finish_sync_run
+from history_filter import add_filter_arguments, get_history_filter, download_filters
+from history_memory import parse_size
+from history_dedup import RecentRows
+from history_metrics import run_metrics
+from fetch_engine import fetch_window, bisect_failed_window, adapt_pending_windows, window_status, run_jobs
+from constants import URL, OUTPUT_FORMATS, DEFAULT_WORKERS, MAX_WORKERS, DEFAULT_JOBS, DEFAULT_GLOBAL_WORKERS, \
+    DEFAULT_CACHE_SIZE_MB, DEDUP_WINDOW_ROWS
 from tzlocal import get_localzone
-from time import sleep
 
 
 def get_arguments(passed_in=None):
@@ -35,6 +47,54 @@ def get_arguments(passed_in=None):
                         help="Stop the conversion of timestamp to localised date time.")
     parser.add_argument("-ko", "--keep_original", dest="keep_original", default=False, action='store_true',
                         help="Keep the original file with timestamps as .old")
+    parser.add_argument("-w", "--workers", dest="workers", type=int, default=DEFAULT_WORKERS,
+                        help=f"Number of time windows to fetch concurrently (maximum {MAX_WORKERS}).")
+    parser.add_argument("-r", "--resume", dest="resume", default=False, action='store_true',
+                        help="Only fetch the time windows the manifest of a previous run records as not complete.")
+    parser.add_argument("-a", "--adaptive", dest="adaptive", default=False, action='store_true',
+                        help="Split windows that time out or get server errors into smaller windows and grow them "
+                             "again when requests come back quickly.")
+    parser.add_argument("-s", "--stream_convert", dest="stream_convert", default=False, action='store_true',
+                        help="Convert timestamps while the data is downloaded instead of rewriting the file "
+                             "afterwards. The pandas row index column is not written.")
+    parser.add_argument("-fmt", "--format", dest="output_format", choices=OUTPUT_FORMATS, default="csv",
+                        help="Format of the converted file. parquet and feather keep column types and need pyarrow "
+                             "installed.")
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=DEFAULT_JOBS,
+                        help="Number of processes to convert the csv file with after it is downloaded.")
+    parser.add_argument("-t", "--tenants", dest="tenants", type=str,
+                        help="JSON file listing the tenants to fetch, each with a name, the environment variable "
+                             "holding its token as token_env and optionally a filename.")
+    parser.add_argument("-gw", "--global_workers", dest="global_workers", type=int, default=DEFAULT_GLOBAL_WORKERS,
+                        help="Maximum number of time windows fetched at once across all tenants.")
+    parser.add_argument("-cl", "--compression_level", dest="compression_level", type=int,
+                        help="Compression level for filenames ending in .gz (default 6) or .zst (default 3).")
+    parser.add_argument("-cd", "--cache_dir", dest="cache_dir", type=str,
+                        help="Directory to cache the raw data of each time window in. Windows that are already in "
+                             "the cache are not downloaded again. The windows are aligned to whole days in UTC so "
+                             "runs with different start times share them.")
+    parser.add_argument("-cs", "--cache_size", dest="cache_size", type=int, default=DEFAULT_CACHE_SIZE_MB,
+                        help="Maximum size of the cache in MB. The least recently used windows are removed first.")
+    parser.add_argument("-sy", "--sync", dest="sync", default=False, action='store_true',
+                        help="Only fetch the time since the last sync of the file and append it to the file. The "
+                             "start time is only used the first time a file is synced.")
+    parser.add_argument("-stz", "--site_timezones", dest="site_timezones", type=str,
+                        help="JSON file mapping buildingid and campusid to time zones, for tenants with sites in more "
+                             "than one time zone. Rows of other sites are converted to the timezone.")
+    parser.add_argument("-dd", "--dedup", dest="dedup", default=False, action='store_true',
+                        help="Drop rows with the same macaddress, sourcetimestamp and floorid as a recent row, e.g. "
+                             "the rows at the boundary of two time windows.")
+    parser.add_argument("-dr", "--dedup_rows", dest="dedup_rows", type=int, default=DEDUP_WINDOW_ROWS,
+                        help="Number of recent rows of the same time window a row is checked against with --dedup. "
+                             "Rows near a window edge are always checked against the window on the other side.")
+    parser.add_argument("-mm", "--max-memory", dest="max_memory", type=parse_size,
+                        help="Memory budget e.g. 512MB that sets the number of rows converted at a time.")
+    parser.add_argument("-mj", "--metrics_json", dest="metrics_json", type=str,
+                        help="Filename to write a JSON report of the fetch and conversion metrics of the run into.")
+    parser.add_argument("-mp", "--metrics_prom", dest="metrics_prom", type=str,
+                        help="Filename to write the metrics of the run into in the Prometheus textfile format, "
+                             "e.g. in the node exporter textfile collector directory.")
+    add_filter_arguments(parser)
     args = parser.parse_args(passed_in)
     if args.start_time is not None:
         logging.debug("Got arguments " + args.start_time.strftime("%Y-%m-%d %H:%M"))
@@ -43,15 +103,36 @@ def get_arguments(passed_in=None):
     return args
 
 
-def get_config():
-    if 'TOKEN' in environ:
-        token = environ['TOKEN']
+def get_config(token_env="TOKEN"):
+    if token_env in environ:
+        token = environ[token_env]
     else:
-        logging.error("Please set environment variable TOKEN before running.")
+        logging.error(f"Please set environment variable {token_env} before running.")
         token = ""
     return token
 
 
+def get_url(url_env="DNASPACES_URL"):
+    # The history API can be pointed somewhere else, e.g. a local mock server for benchmarks
+    return environ.get(url_env, URL)
+
+
+def load_tenants(tenants_file, timestamped=True):
+    # A JSON list of tenants, each with a "name", the environment variable holding its token in "token_env" and
+    # optionally the "filename" to write its history into
+    try:
+        with open(tenants_file) as f:
+            tenants = json.load(f)
+    except (IOError, ValueError) as e:
+        logging.error(f"Unable to read tenants file {tenants_file}. Got error {e}.")
+        return []
+    for tenant in tenants:
+        tenant["token"] = get_config(tenant.get("token_env", "TOKEN"))
+        if tenant.get("filename") is None:
+            tenant["filename"] = get_filename(prefix="client-history-" + tenant["name"], timestamped=timestamped)
+    return tenants
+
+
 def check_file_writable(full_file_name):
     if path.exists(full_file_name):
         # path exists
@@ -76,94 +157,194 @@ def valid_date(date):
         return False
 
 
-def get_api_response(payload, headers):
-    attempts = 0
-    current_timeout = REQUEST_TIMEOUT
-    while attempts < MAX_REQUEST_RETRIES:
-        try:
-            response = requests.get(URL, params=payload, headers=headers, stream=True, timeout=current_timeout)
-            if response.status_code == requests.codes.ok:
+def get_windows_sequentially(client, manifest, write_file, adaptive=False, convert_timezone=None,
+                             history_filter=None, dedup=None):
+    lines_read = 0
+    pending = deque(manifest["windows"])
+    with open(write_file, "wb") as f:
+        while pending:
+            window = pending.popleft()
+            offset = f.tell()
+            stats = fetch_window(client, window, f, not manifest["header"], adaptive, convert_timezone,
+                                 history_filter, dedup)
+            if adaptive and bisect_failed_window(manifest, window, stats, pending, dedup):
+                # Drop whatever the failed window managed to write before trying its halves
+                f.seek(offset)
+                f.truncate()
+                continue
+            record_window(manifest, window, stats, window_status(stats))
+            if stats["status_code"] != requests.codes.ok:
+                save_manifest(manifest, write_file)
                 break
-            else:
-                logging.error(f"{attempts}.Error with REST to DNA Spaces got {response.status_code} "
-                              f"should have got {requests.codes.ok}. Service may be too busy.")
-                logging.error(f"This is attempt {attempts} of maximum {MAX_REQUEST_RETRIES}. Retrying..")
-                attempts += 1
-        except requests.ConnectionError as e:
-            logging.error(f"Got a network connection error {e}. Please check {URL} is reachable.")
-            attempts += 1
-        except requests.Timeout as e:
-            logging.error(f"Got a timeout with request {e}. Incrementing timeout {current_timeout}")
-            current_timeout += 60
-            attempts += 1
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Got an unknown exception from requests {e}. Exiting.")
-            raise SystemExit(e)
-        sleep(5)
-
-    return response
-
-
-def get_client_history(time_tuples_list, write_file):
+            lines_read += stats["lines"]
+            window["offset"] = f.tell() - stats["bytes"]
+            save_manifest(manifest, write_file)
+            logging.info(f"Wrote {lines_read:,} lines to file {write_file}.")
+            if adaptive:
+                adapt_pending_windows(manifest, stats, pending)
+    return lines_read
+
+
+def plan_windows(time_tuples_list, write_file, resume=False):
+    # Work out which time windows to fetch. Returns the manifest, the windows to fetch into part files when resuming
+    # (None for a fresh run) and whether there is anything to do.
+    manifest = load_manifest(write_file) if resume else None
+    if manifest is not None and manifest.get("converted"):
+        logging.error(f"File {write_file} has already been converted so it cannot be resumed. "
+                      f"Fetch it again without resume.")
+        return None, None, False
+    if manifest is not None:
+        windows = windows_to_fetch(manifest)
+        if len(windows) == 0:
+            logging.info(f"All time windows of {write_file} are complete. Nothing to resume.")
+            return None, None, False
+        logging.info(f"Resuming {write_file}. Fetching {len(windows)} of {len(manifest['windows'])} windows.")
+        return manifest, windows, True
+    if resume:
+        logging.error(f"No manifest found for {write_file}. Fetching all time windows.")
+    valid_windows = []
+    for (start, end) in time_tuples_list:
+        if valid_date(start) and valid_date(end):
+            valid_windows.append((start, end))
+        else:
+            logging.error(f"Invalid start and/or end dates.")
+    if len(valid_windows) == 0:
+        return None, None, False
+    manifest = new_manifest(valid_windows)
+    save_manifest(manifest, write_file)
+    return manifest, None, True
+
+
+def check_workers(workers):
+    if workers > MAX_WORKERS:
+        logging.error(f"Workers {workers} is more than the maximum of {MAX_WORKERS}. Using {MAX_WORKERS}.")
+        return MAX_WORKERS
+    return workers
+
+
+def check_writable(write_file):
+    if not check_compression(write_file):
+        return False
+    if check_file_writable(write_file):
+        logging.debug(f"File {write_file} is suitable for writing")
+        return True
+    logging.error(f"File {write_file} cannot be written. Check path and permissions")
+    return False
+
+
+def open_client(token, workers, cache=None, clients=None):
+    # A client of its own that is closed after the run, or a client from the pool of a long running process that is
+    # kept open for the next run
+    if clients is None:
+        return DnaSpacesClient(token, url=get_url(), pool_size=max(workers, 1), cache=cache)
+    return nullcontext(clients.get(token, get_url(), max(workers, 1), cache))
+
+
+def get_client_history(time_tuples_list, write_file, workers=DEFAULT_WORKERS, resume=False, adaptive=False,
+                       convert_timezone=None, compression_level=None, cache=None, history_filter=None, clients=None,
+                       dedup_rows=None):
+    # With dedup_rows the rows repeating one of the last dedup_rows rows of their window, or a row at the edge of the
+    # next window, are dropped
     token = get_config()
     lines_read = 0
     # DNA spaces will return 1 day of history data.
-    if check_file_writable(write_file):
-        logging.debug(f"File {write_file} is suitable for writing")
-        valid_file = True
-    else:
-        logging.error(f"File {write_file} cannot be written. Check path and permissions")
-        valid_file = False
+    valid_file = check_writable(write_file)
+    workers = check_workers(workers)
     if len(token) > 0 and valid_file:
-        token_str = "Bearer " + token
-        headers = {"Authorization": token_str}
+        (manifest, windows, fetch) = plan_windows(time_tuples_list, write_file, resume)
+        if not fetch:
+            return lines_read
         logging.info("Connecting to DNA Spaces. This may take a minute or two.")
-        printed_header = False
-        with open(write_file, "w") as f:
-            for (start, end) in time_tuples_list:
-                if valid_date(start) and valid_date(end):
-                    logging.info(f"Using date range {start} to {end}")
-                    payload = {"startTime": convert_timestamp_millisecond(start),
-                               "endTime": convert_timestamp_millisecond(end)}
-                    logging.debug(f"Using URL params {payload}")
-                    response = get_api_response(payload, headers)
-                    if response.status_code == requests.codes.ok:
-                        logging.info("Connected to DNA Spaces. Writing data to file. This will take a while.")
-                        new_request = True
-                        chunk_line_count = 0
-                        try:
-                            for chunk in response.iter_lines(decode_unicode=True):
-                                if chunk_line_count > 0:
-                                    print(chunk, file=f)
-                                elif not printed_header and new_request:
-                                    print(chunk, file=f)
-                                    printed_header = True
-                                chunk_line_count += 1
-                                lines_read += 1
-                        except requests.exceptions.Timeout as e:
-                            logging.error(f"Connection timed out. Not all data was received. {e}")
-                        except requests.exceptions.RequestException as e:
-                            logging.error(f"Got an exception with the connection. Not all data was received. {e}")
-                        logging.info(f"Wrote {lines_read:,} lines to file {write_file}.")
-                    else:
-                        logging.error(f"Unable to connect to {URL}. Got status code {response.status_code}" +
-                                      f"Message {response.text}")
-                        break
-                else:
-                    logging.error(f"Invalid start and/or end dates.")
+        dedup = RecentRows(dedup_rows) if dedup_rows else None
+        with open_client(token, workers, cache, clients) as client:
+            # Compressed output always goes through part files so every window is its own gzip member or zstd frame
+            if windows is None and workers <= 1 and get_compression(write_file) is None:
+                return get_windows_sequentially(client, manifest, write_file, adaptive, convert_timezone,
+                                                history_filter, dedup)
+            if windows is None:
+                logging.info(f"Fetching up to {workers} time windows at once.")
+                windows = manifest["windows"]
+            job = {"client": client, "manifest": manifest, "windows": windows, "write_file": write_file,
+                   "workers": workers, "adaptive": adaptive, "convert_timezone": convert_timezone,
+                   "compression_level": compression_level, "history_filter": history_filter, "dedup": dedup}
+            [lines_read] = run_jobs([job], max(workers, 1))
     return lines_read
 
 
-def get_filename(fn=None):
+def get_tenants_history(tenants, time_tuples_list, workers=DEFAULT_WORKERS, global_workers=DEFAULT_GLOBAL_WORKERS,
+                        resume=False, adaptive=False, convert_timezone=None, compression_level=None, cache=None,
+                        history_filter=None, clients=None, dedup_rows=None):
+    # Fetch the history of several tenants at once. Every tenant gets its own client, manifest and output file, with
+    # at most workers windows in flight per tenant and global_workers overall. Returns the lines read per filename.
+    workers = check_workers(workers)
+    jobs = []
+    for tenant in tenants:
+        if len(tenant["token"]) == 0 or not check_writable(tenant["filename"]):
+            logging.error(f"Skipping tenant {tenant['name']}.")
+            continue
+        (manifest, windows, fetch) = plan_windows(tenant.get("time_tuples_list", time_tuples_list), tenant["filename"],
+                                                  resume)
+        if not fetch:
+            continue
+        if clients is None:
+            client = DnaSpacesClient(tenant["token"], url=get_url(), pool_size=max(workers, 1), cache=cache)
+        else:
+            client = clients.get(tenant["token"], get_url(), max(workers, 1), cache)
+        jobs.append({"client": client,
+                     "manifest": manifest,
+                     "windows": windows if windows is not None else manifest["windows"],
+                     "write_file": tenant["filename"],
+                     "workers": workers,
+                     "adaptive": adaptive,
+                     "convert_timezone": convert_timezone,
+                     "compression_level": compression_level,
+                     "history_filter": history_filter,
+                     "dedup": RecentRows(dedup_rows) if dedup_rows else None})
+    logging.info(f"Fetching history for {len(jobs)} tenants with up to {global_workers} requests at once.")
+    try:
+        lines = run_jobs(jobs, global_workers) if jobs else []
+    finally:
+        if clients is None:
+            for job in jobs:
+                job["client"].close()
+    return {job["write_file"]: job_lines for (job, job_lines) in zip(jobs, lines)}
+
+
+def get_filename(fn=None, prefix="client-history", timestamped=True):
     if fn is None:
-        generated_fn = "client-history" + "-" + datetime.now().strftime("%Y%m%d%H%M") + ".csv"
+        if timestamped:
+            generated_fn = prefix + "-" + datetime.now().strftime("%Y%m%d%H%M") + ".csv"
+        else:
+            generated_fn = prefix + ".csv"
         logging.debug(f"No filename provided, generated filename {generated_fn}.")
         return generated_fn
     else:
         return fn
 
 
-def main(passed_args=None):
+def check_sync_arguments(cmd_args):
+    # A sync run appends to the same csv file every time and the high-water mark already says where to resume from
+    if cmd_args.output_format != "csv":
+        logging.error(f"Sync appends to a csv file. Ignoring format {cmd_args.output_format}.")
+        cmd_args.output_format = "csv"
+    if cmd_args.resume:
+        logging.error("Sync always starts from the high-water mark. Ignoring resume.")
+        cmd_args.resume = False
+    if cmd_args.keep_original:
+        logging.error("Sync only keeps the appended file. Ignoring keep original.")
+        cmd_args.keep_original = False
+
+
+def plan_sync(dataset_file, cmd_args):
+    # Returns the run file to fetch into and the time windows from the high-water mark of dataset_file to the end time
+    start = get_sync_start(dataset_file)
+    if start is None:
+        start = cmd_args.start_time
+    return get_sync_run_filename(dataset_file), get_date_range(start, cmd_args.end_time, cmd_args.timezone,
+                                                               cmd_args.cache_dir is not None)
+
+
+def setup_logging():
     logging.basicConfig(format='%(levelname)s:%(asctime)s:%(funcName)s():%(message)s',
                         filename="get_history.log",
                         datefmt='%Y-%m-%d %H:%M.%S',
@@ -174,15 +355,90 @@ def main(passed_args=None):
     formatter = logging.Formatter('%(message)s')
     console.setFormatter(formatter)
     logging.getLogger('').addHandler(console)
-    cmd_args = get_arguments(passed_args)
-    time_split = get_date_range(cmd_args.start_time, cmd_args.end_time, cmd_args.timezone)
-    filename = get_filename(cmd_args.filename)
-    lines = get_client_history(time_split, filename)
-    if lines > 0 and cmd_args.convert_time:
-        logging.debug(f"Converting filename {filename} timestamps to local time with timezone {cmd_args.timezone}.")
-        convert_history(filename, cmd_args.timezone, cmd_args.keep_original)
+
+
+def main(passed_args=None):
+    setup_logging()
+    return fetch_and_convert(get_arguments(passed_args))
+
+
+def fetch_and_convert(cmd_args, clients=None, executor=None):
+    # Fetch and convert the history asked for by the parsed arguments. A long running process passes its ClientPool
+    # and conversion process pool so they are reused between runs. Returns True if any history was fetched.
+    run_metrics.reset()
+    if cmd_args.sync:
+        check_sync_arguments(cmd_args)
+    # Cached windows are only used again by runs with the same windows, so with a cache they are aligned to whole
+    # time chunks rather than to the start time
+    time_split = get_date_range(cmd_args.start_time, cmd_args.end_time, cmd_args.timezone,
+                                cmd_args.cache_dir is not None)
+    stream_convert = cmd_args.convert_time and cmd_args.stream_convert
+    if stream_convert and cmd_args.output_format != "csv":
+        logging.error(f"Streaming conversion only writes csv. Converting to {cmd_args.output_format} afterwards.")
+        stream_convert = False
+    if stream_convert and cmd_args.keep_original:
+        logging.error("Streaming conversion never writes the original file. Ignoring keep original.")
+    timezone = cmd_args.timezone
+    if cmd_args.convert_time and cmd_args.site_timezones is not None:
+        # Loaded here as it needs pandas, which a run with -nc never loads
+        from history_timezones import load_site_timezones
+        timezone = load_site_timezones(cmd_args.site_timezones, cmd_args.timezone) or timezone
+    convert_timezone = timezone if stream_convert else None
+    # Filters are applied as the data is downloaded so the file is already filtered when it is converted, apart from
+    # the site columns the time zone of each row is found from, which are only dropped once it is converted
+    history_filter = get_history_filter(cmd_args)
+    convert_filter = None
+    if cmd_args.convert_time and not stream_convert and cmd_args.site_timezones is not None:
+        from convert_history import timezone_columns
+        (history_filter, convert_filter) = download_filters(history_filter, timezone_columns(timezone))
+    dedup_rows = cmd_args.dedup_rows if cmd_args.dedup else None
+    cache = None
+    if cmd_args.cache_dir is not None:
+        cache = HistoryCache(cmd_args.cache_dir, cmd_args.cache_size * 1024 * 1024)
+    sync_datasets = {}
+    if cmd_args.tenants is not None:
+        tenants = load_tenants(cmd_args.tenants, not cmd_args.sync)
+        if cmd_args.sync:
+            for tenant in tenants:
+                dataset_file = tenant["filename"]
+                (tenant["filename"], tenant["time_tuples_list"]) = plan_sync(dataset_file, cmd_args)
+                sync_datasets[tenant["filename"]] = dataset_file
+        files_lines = get_tenants_history(tenants, time_split, cmd_args.workers, cmd_args.global_workers,
+                                          cmd_args.resume, cmd_args.adaptive, convert_timezone,
+                                          cmd_args.compression_level, cache, history_filter, clients,
+                                          dedup_rows)
+    else:
+        filename = get_filename(cmd_args.filename, timestamped=not cmd_args.sync)
+        if cmd_args.sync:
+            (run_file, time_split) = plan_sync(filename, cmd_args)
+            sync_datasets[run_file] = filename
+            filename = run_file
+        files_lines = {filename: get_client_history(time_split, filename, cmd_args.workers, cmd_args.resume,
+                                                    cmd_args.adaptive, convert_timezone, cmd_args.compression_level,
+                                                    cache, history_filter, clients, dedup_rows)}
+    for (filename, lines) in files_lines.items():
+        if lines > 0 and cmd_args.convert_time and not stream_convert:
+            # The manifest offsets are only good for the raw file, so a file with windows still to fetch is converted
+            # once --resume has fetched them
+            if not all_windows_complete(filename):
+                logging.error(f"Not converting {filename} as not all of its time windows were fetched. Run again with "
+                              f"--resume to fetch them and convert the file.")
+                continue
+            # pandas and numpy are only loaded when a file is converted so a run with -nc starts quickly
+            from convert_history import convert_history
+            logging.debug(f"Converting filename {filename} timestamps to local time with timezone {timezone}.")
+            convert_history(filename, timezone, cmd_args.keep_original, cmd_args.output_format,
+                            cmd_args.jobs, cmd_args.compression_level, convert_filter, cmd_args.max_memory,
+                            executor)
+            mark_converted(filename)
+    for (run_file, dataset_file) in sync_datasets.items():
+        finish_sync_run(run_file, dataset_file, cmd_args.compression_level)
+    if cmd_args.metrics_json is not None:
+        run_metrics.write_report(cmd_args.metrics_json)
+    if cmd_args.metrics_prom is not None:
+        run_metrics.write_prometheus(cmd_args.metrics_prom)
     logging.info("Finished.")
-    return lines > 0
+    return sum(files_lines.values()) > 0
 
 
 if __name__ == '__main__':
@@ -0,0 +1,357 @@
+#
+# fetch_engine.py streams time windows of client history from DNA Spaces into files. The asyncio scheduler runs the
+# (tenant, window) pairs of one or more tenants at once, limited both per tenant and overall. The blocking requests
+# stream of each window runs on a thread pool.
+import asyncio
+import logging
+import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from os import path, remove, replace
+from time import monotonic
+import requests
+from get_date_range import bisect_window, merge_windows
+from history_compression import get_compression, compress_stream
+from history_filter import filter_columns
+from history_dedup import key_indexes
+from history_metrics import run_metrics
+from history_manifest import save_manifest, record_window, window_times, replace_windows, COMPLETE, INCOMPLETE, \
+    FAILED
+from constants import URL, MAX_REQUEST_RETRIES, CONVERT_FILE_CHUNK_SIZE, STITCH_BUFFER_SIZE, \
+    ADAPTIVE_REQUEST_RETRIES, ADAPTIVE_TARGET_SECONDS_LOW, ADAPTIVE_TARGET_SECONDS_HIGH, ADAPTIVE_GROW_MAX_BYTES, \
+    DEFAULT_GLOBAL_WORKERS, RAW_STREAM_BLOCK_SIZE, LAST_LINE_BYTES
+
+
+def write_response_blocks(response, f, include_header):
+    # Copy the response body to the binary file f in large blocks, slicing out the header line unless include_header
+    # is set. Lines are counted from the newlines in each block so no Python work is done per row. The bytes after the
+    # last newline of a block are held back until the rest of their row arrives, so a stream that breaks part way
+    # through a row leaves only whole rows in the file. Returns the line count, data bytes written (header excluded),
+    # header, last line and whether the whole stream was received.
+    stats = {"lines": 0, "bytes": 0, "header": "", "last_line": "", "complete": True}
+    header = b""
+    in_header = True
+    rest = b""
+    tail = b""
+
+    def write(data):
+        nonlocal tail
+        f.write(data)
+        stats["bytes"] += len(data)
+        stats["lines"] += data.count(b"\n")
+        tail = data[-LAST_LINE_BYTES:] if len(data) >= LAST_LINE_BYTES else (tail + data)[-LAST_LINE_BYTES:]
+
+    try:
+        for block in response.iter_content(chunk_size=RAW_STREAM_BLOCK_SIZE):
+            if in_header:
+                newline = block.find(b"\n")
+                if newline < 0:
+                    header += block
+                    continue
+                header += block[:newline + 1]
+                block = block[newline + 1:]
+                in_header = False
+                stats["lines"] = 1
+                if include_header:
+                    f.write(header)
+            newline = block.rfind(b"\n")
+            if newline < 0:
+                rest += block
+                continue
+            if rest:
+                write(rest)
+            write(block[:newline + 1])
+            rest = block[newline + 1:]
+    except requests.exceptions.Timeout as e:
+        logging.error(f"Connection timed out. Not all data was received. {e}")
+        stats["complete"] = False
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Got an exception with the connection. Not all data was received. {e}")
+        stats["complete"] = False
+    if in_header and header and stats["complete"]:
+        # The body was only a header without a trailing newline
+        stats["lines"] = 1
+        if include_header:
+            f.write(header + b"\n")
+    elif rest and stats["complete"]:
+        # Always finish on a newline so the next window starts on its own line
+        write(rest + b"\n")
+    elif rest:
+        logging.debug(f"Dropped the {len(rest):,} bytes of the row that was cut off.")
+    stats["header"] = header.rstrip(b"\r\n").decode()
+    stats["last_line"] = tail.rstrip(b"\r\n").rsplit(b"\n", 1)[-1].decode(errors="replace")
+    return stats
+
+
+def write_response_lines(response, f, include_header, convert_timezone, history_filter=None, dedup=None,
+                         dedup_window=None):
+    # Convert, filter and/or drop repeated rows of the streamed CSV lines in batches as they arrive and write them to
+    # the binary file f, dropping the header line unless include_header is set. Returns the same statistics as
+    # write_response_blocks, with the header of the lines that were received as source_header when filtering drops
+    # columns, the number of repeated rows dropped as duplicates and the number of rows the filters dropped as
+    # filtered.
+    stats = {"lines": 0, "bytes": 0, "header": "", "last_line": "", "complete": True, "duplicates": 0, "filtered": 0}
+    last_chunk = b""
+    batch = []
+    indexes = None
+    try:
+        for chunk in response.iter_lines(chunk_size=RAW_STREAM_BLOCK_SIZE):
+            if stats["lines"] == 0:
+                stats["source_header"] = chunk.decode()
+                stats["header"] = ",".join(filter_columns(history_filter, stats["source_header"].split(",")))
+                if include_header:
+                    f.write(stats["header"].encode() + b"\n")
+                if dedup is not None:
+                    indexes = key_indexes(stats["source_header"])
+            else:
+                batch.append(chunk)
+                if len(batch) >= CONVERT_FILE_CHUNK_SIZE:
+                    stats["bytes"] += write_batch(stats, batch, f, convert_timezone, history_filter, dedup, indexes,
+                                                  dedup_window)
+                    batch = []
+                last_chunk = chunk
+            stats["lines"] += 1
+    except requests.exceptions.Timeout as e:
+        logging.error(f"Connection timed out. Not all data was received. {e}")
+        stats["complete"] = False
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Got an exception with the connection. Not all data was received. {e}")
+        stats["complete"] = False
+    if batch:
+        stats["bytes"] += write_batch(stats, batch, f, convert_timezone, history_filter, dedup, indexes, dedup_window)
+    # Lines counts the rows written so it matches the file
+    stats["lines"] -= stats["duplicates"] + stats["filtered"]
+    stats["last_line"] = last_chunk.decode(errors="replace")
+    return stats
+
+
+def write_batch(stats, batch, f, convert_timezone, history_filter, dedup, indexes, dedup_window):
+    if dedup is not None:
+        (batch, duplicates) = dedup.drop_repeats(indexes, batch, dedup_window)
+        stats["duplicates"] += duplicates
+    if not batch:
+        return 0
+    if convert_timezone is None and history_filter is None:
+        # Only dropping repeated rows, so the lines are written as they were received
+        data = b"\n".join(batch) + b"\n"
+        f.write(data)
+        return len(data)
+    return write_converted_lines(stats, batch, f, convert_timezone, history_filter)
+
+
+def write_converted_lines(stats, batch, f, convert_timezone, history_filter=None):
+    # The conversion is only loaded when streaming conversion is used so a raw download does not load pandas
+    from convert_history import convert_lines
+    (converted, rows) = convert_lines(stats["source_header"].encode(), batch, convert_timezone, history_filter)
+    stats["filtered"] += len(batch) - rows
+    f.write(converted)
+    return len(converted)
+
+
+def window_status(stats):
+    if stats["status_code"] != requests.codes.ok:
+        return FAILED
+    return COMPLETE if stats["complete"] else INCOMPLETE
+
+
+def window_failed(stats):
+    # Timeouts, server errors and broken streams are worth retrying as smaller windows
+    if stats["status_code"] is None or stats["status_code"] >= 500:
+        return True
+    return stats["status_code"] == requests.codes.ok and not stats["complete"]
+
+
+def get_part_filename(write_file, window):
+    return f"{write_file}.{window['start_ms']}.part"
+
+
+def fetch_window(client, window, f, include_header, adaptive=False, convert_timezone=None, history_filter=None,
+                 dedup=None):
+    # Fetch a single time window into the open binary file f. Returns the window statistics with the HTTP status code
+    # (None if no response was received) and the elapsed seconds. Rows the RecentRows dedup has seen recently in the
+    # window or at one of its edges are dropped.
+    (start, end) = window_times(window)
+    logging.info(f"Using date range {start} to {end}")
+    payload = {"startTime": window["start_ms"], "endTime": window["end_ms"]}
+    logging.debug(f"Using URL params {payload}")
+    started = monotonic()
+    max_retries = ADAPTIVE_REQUEST_RETRIES if adaptive else MAX_REQUEST_RETRIES
+    attempts = {}
+    dedup_window = dedup.start_window(window) if dedup is not None else None
+    response = client.get_history(payload, max_retries, attempts)
+    ttfb = monotonic() - started
+    if response is not None and response.status_code == requests.codes.ok:
+        logging.info("Connected to DNA Spaces. Writing data to file. This will take a while.")
+        if convert_timezone is None and history_filter is None and dedup is None:
+            stats = write_response_blocks(response, f, include_header)
+        else:
+            stats = write_response_lines(response, f, include_header, convert_timezone, history_filter, dedup,
+                                         dedup_window)
+            if stats["duplicates"] > 0:
+                logging.info(f"Dropped {stats['duplicates']:,} repeated rows from {start} to {end}.")
+    else:
+        if response is not None:
+            logging.error(f"Unable to connect to {URL}. Got status code {response.status_code}" +
+                          f"Message {response.text}")
+        else:
+            logging.error(f"Unable to connect to {URL}. No response received.")
+        stats = {"lines": 0, "bytes": 0, "header": "", "last_line": "", "complete": False}
+    stats["status_code"] = response.status_code if response is not None else None
+    stats["elapsed"] = monotonic() - started
+    stats["ttfb"] = ttfb
+    stats["dedup_window"] = dedup_window
+    if dedup is not None:
+        dedup.finish_window(dedup_window)
+    stats.update(attempts)
+    logging.debug(f"Window {start} to {end} took {stats['elapsed']:.1f} seconds for {stats['bytes']:,} bytes.")
+    run_metrics.record_window(client.tenant, window, stats)
+    return stats
+
+
+def fetch_window_to_part(client, window, part_file, adaptive=False, convert_timezone=None, compression=None,
+                         compression_level=None, history_filter=None, dedup=None):
+    # Fetch a single time window into its own part file without the header. With compression the part file is a
+    # single gzip member or zstd frame so it can be copied into the output as it is.
+    with open(part_file, "wb") as f, compress_stream(f, compression, compression_level) as out:
+        stats = fetch_window(client, window, out, False, adaptive, convert_timezone, history_filter, dedup)
+    if stats["status_code"] != requests.codes.ok:
+        remove(part_file)
+    else:
+        logging.info(f"Wrote {stats['lines']:,} lines for {window['start']} to {window['end']} to file {part_file}.")
+    return stats
+
+
+def bisect_failed_window(manifest, window, stats, pending, dedup=None):
+    # Replace a window that timed out or got a server error with two halves at the front of the pending queue.
+    # Returns False if the window is already at the minimum size. What the window wrote is thrown away, so the rows
+    # it kept are forgotten by the dedup.
+    halves = bisect_window(*window_times(window))
+    if not window_failed(stats) or len(halves) == 1:
+        return False
+    if dedup is not None:
+        dedup.discard(stats["dedup_window"])
+    logging.info(f"Splitting window {window['start']} to {window['end']} into two and trying again.")
+    pending.extendleft(reversed(replace_windows(manifest, [window], halves)))
+    return True
+
+
+def adapt_pending_windows(manifest, stats, pending):
+    # Keep requests inside the target latency band by shrinking the next window after a slow one and growing it
+    # again after a quick, small one
+    if stats["elapsed"] > ADAPTIVE_TARGET_SECONDS_HIGH and len(pending) > 0:
+        halves = bisect_window(*window_times(pending[0]))
+        if len(halves) > 1:
+            logging.debug(f"Window took {stats['elapsed']:.1f} seconds. Shrinking the next window.")
+            new_windows = replace_windows(manifest, [pending.popleft()], halves)
+            pending.extendleft(reversed(new_windows))
+    elif stats["elapsed"] < ADAPTIVE_TARGET_SECONDS_LOW and stats["bytes"] < ADAPTIVE_GROW_MAX_BYTES \
+            and len(pending) > 1:
+        merged = merge_windows(window_times(pending[0]), window_times(pending[1]))
+        if len(merged) == 1:
+            logging.debug(f"Window took {stats['elapsed']:.1f} seconds. Growing the next window.")
+            new_windows = replace_windows(manifest, [pending.popleft(), pending.popleft()], merged)
+            pending.extendleft(new_windows)
+
+
+def copy_range(source_file, offset, length, f):
+    source_file.seek(offset)
+    while length > 0:
+        buffer = source_file.read(min(length, STITCH_BUFFER_SIZE))
+        if not buffer:
+            break
+        f.write(buffer)
+        length -= len(buffer)
+
+
+def assemble_output(manifest, write_file, part_files, compression_level=None):
+    # Rebuild write_file in window order from freshly fetched part files and, when resuming, the ranges of the
+    # previous output that are still good. Keeps a single header and updates the window offsets in the manifest.
+    tmp_write_file = write_file + ".tmp"
+    old_file = open(write_file, "rb") if path.isfile(write_file) else None
+    try:
+        with open(tmp_write_file, "wb") as f:
+            if manifest["header"]:
+                with compress_stream(f, get_compression(write_file), compression_level) as out:
+                    out.write(manifest["header"].encode() + b"\n")
+            for window in manifest["windows"]:
+                part_file = part_files.get(window["start_ms"])
+                offset = f.tell()
+                if part_file is not None and path.isfile(part_file):
+                    with open(part_file, "rb") as part:
+                        shutil.copyfileobj(part, f, STITCH_BUFFER_SIZE)
+                elif old_file is not None and window["bytes"] > 0:
+                    copy_range(old_file, window["offset"], window["bytes"], f)
+                window["offset"] = offset
+                window["bytes"] = f.tell() - offset
+    finally:
+        if old_file is not None:
+            old_file.close()
+    replace(tmp_write_file, write_file)
+    for part_file in part_files.values():
+        if path.isfile(part_file):
+            remove(part_file)
+    logging.debug(f"Assembled {len(manifest['windows'])} windows into {write_file}.")
+
+
+async def fetch_window_async(executor, global_limit, client, window, part_file, adaptive, convert_timezone,
+                             compression, compression_level, history_filter, dedup):
+    async with global_limit:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, fetch_window_to_part, client, window, part_file, adaptive,
+                                          convert_timezone, compression, compression_level, history_filter, dedup)
+
+
+async def fetch_job(job, executor, global_limit):
+    # Fetch the windows of one tenant into part files, at most job["workers"] at a time, then assemble its output
+    manifest = job["manifest"]
+    write_file = job["write_file"]
+    adaptive = job.get("adaptive", False)
+    workers = max(job.get("workers", 1), 1)
+    compression = get_compression(write_file)
+    compression_level = job.get("compression_level")
+    lines_read = 0
+    part_files = {}
+    pending = deque(job["windows"])
+    running = {}
+    while pending or running:
+        while pending and len(running) < workers:
+            window = pending.popleft()
+            part_file = get_part_filename(write_file, window)
+            part_files[window["start_ms"]] = part_file
+            task = asyncio.ensure_future(fetch_window_async(executor, global_limit, job["client"], window, part_file,
+                                                            adaptive, job.get("convert_timezone"), compression,
+                                                            compression_level, job.get("history_filter"),
+                                                            job.get("dedup")))
+            running[task] = window
+        (done, _) = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            window = running.pop(task)
+            stats = task.result()
+            if adaptive and bisect_failed_window(manifest, window, stats, pending, job.get("dedup")):
+                if path.isfile(part_files[window["start_ms"]]):
+                    remove(part_files[window["start_ms"]])
+                continue
+            lines_read += stats["lines"]
+            record_window(manifest, window, stats, window_status(stats))
+            if adaptive:
+                adapt_pending_windows(manifest, stats, pending)
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(executor, assemble_output, manifest, write_file, part_files,
+                               compression_level)
+    save_manifest(manifest, write_file)
+    logging.info(f"Wrote {lines_read:,} lines to file {write_file}.")
+    return lines_read
+
+
+async def fetch_jobs(jobs, global_workers=DEFAULT_GLOBAL_WORKERS):
+    global_limit = asyncio.Semaphore(global_workers)
+    with ThreadPoolExecutor(max_workers=global_workers) as executor:
+        return await asyncio.gather(*[fetch_job(job, executor, global_limit) for job in jobs])
+
+
+def run_jobs(jobs, global_workers=DEFAULT_GLOBAL_WORKERS):
+    # Each job is a dict with the tenant "client", its "manifest", the "windows" to fetch, the "write_file" and
+    # optionally "workers", "adaptive", "convert_timezone", "compression_level", "history_filter" and "dedup", a
+    # RecentRows shared by the windows of the job. The output is compressed when the "write_file" ends in .gz or .zst.
+    # Returns the lines read for each job.
+    return asyncio.run(fetch_jobs(jobs, global_workers))
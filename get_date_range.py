@@ -3,7 +3,7 @@ from datetime import datetime, timedelta, timezone
 import logging
 import pytz
 from tzlocal import get_localzone
-from constants import MAX_DAYS, HOURLY_TIME_CHUNK_SIZE
+from constants import MAX_DAYS, HOURLY_TIME_CHUNK_SIZE, MIN_HOURLY_TIME_CHUNK_SIZE
 
 
 def valid_time(start, end):
@@ -47,12 +47,27 @@ def valid_time(start, end):
     return valid
 
 
-def split_dates(start=None, end=None):
-    # Create a list of tuples (start_time, end_time) that are each chunked CHUNK_SIZE apart + end time
+def next_aligned_time(start, time_chunk):
+    # The first time at or after start that is a whole number of time chunks from the UTC epoch, in the timezone of
+    # start
+    epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+    return (epoch - ((epoch - start) // time_chunk) * time_chunk).astimezone(start.tzinfo)
+
+
+def split_dates(start=None, end=None, aligned=False):
+    # Create a list of tuples (start_time, end_time) that are each chunked CHUNK_SIZE apart + end time. When aligned
+    # the chunks start on whole multiples of CHUNK_SIZE since the UTC epoch, so every run over a range gets the same
+    # windows whatever its start time, with a shorter first window up to the first aligned time.
     time_range_list = []
     if valid_time(start, end):
         time_chunk = timedelta(hours=HOURLY_TIME_CHUNK_SIZE)
         time_range_list = []
+        if aligned:
+            first_end = next_aligned_time(start, time_chunk)
+            if start < first_end < end:
+                time_range_list.append((start, first_end))
+                logging.debug(f"Append {start} to {first_end} to time range")
+                start = first_end
         while start + time_chunk < end:
             time_range_list.append((start, start + time_chunk))
             start += time_chunk
@@ -63,8 +78,25 @@ def split_dates(start=None, end=None):
     return time_range_list
 
 
+def bisect_window(start, end):
+    # Split a time window into two halves unless the halves would be smaller than MIN_HOURLY_TIME_CHUNK_SIZE
+    if end - start < 2 * timedelta(hours=MIN_HOURLY_TIME_CHUNK_SIZE):
+        return [(start, end)]
+    middle = start + timedelta(seconds=round((end - start).total_seconds() / 2))
+    logging.debug(f"Bisect {start} to {end} at {middle}")
+    return [(start, middle), (middle, end)]
+
+
+def merge_windows(first, second):
+    # Join two contiguous time windows if the result is no longer than HOURLY_TIME_CHUNK_SIZE
+    if first[1] == second[0] and second[1] - first[0] <= timedelta(hours=HOURLY_TIME_CHUNK_SIZE):
+        logging.debug(f"Merge {first[0]} to {second[1]}")
+        return [(first[0], second[1])]
+    return [first, second]
+
+
 def add_timezone(time_no_tz, tz=None):
-    if time_no_tz.tzinfo in pytz.all_timezones:
+    if time_no_tz.tzinfo is not None:
         logging.debug("Valid timezone has been provided in ISO string")
         time_tz = time_no_tz
     else:
@@ -100,12 +132,12 @@ def convert_timestamp_millisecond(time_convert):
     return ms_int
 
 
-def get_date_range(start, end, local_tz=None):
+def get_date_range(start, end, local_tz=None, aligned=False):
     # Assumes that start_time, end_time are datetime formatted
     (start, end) = check_dates_exist(start, end)
     start_time_tz = add_timezone(start, local_tz)
     end_time_tz = add_timezone(end, local_tz)
-    return split_dates(start_time_tz, end_time_tz)
+    return split_dates(start_time_tz, end_time_tz, aligned)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,182 @@
+#
+# history_benchmark.py measures the rows a second and peak memory of the fetch, convert and end to end paths against
+# a local mock of the history API. Each benchmark runs in a fresh process so its peak RSS is its own. The results are
+# written as JSON with the commit they were run on, and can be compared with the results of an earlier run.
+#
+# python history_benchmark.py -rh 2000000 -hr 6 -o results.json
+# python history_benchmark.py -rh 2000000 -hr 6 -o results-new.json -c results.json
+from argparse import ArgumentParser
+from datetime import datetime, timedelta, timezone
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+from time import perf_counter
+from history_mock_server import MockHistoryServer
+from history_memory import peak_rss_bytes
+
+BENCHMARKS = ["get_client_history", "convert_history", "main"]
+BENCHMARK_TIMEZONE = "Australia/Sydney"
+
+
+def benchmark_range(hours):
+    # Whole hours ending an hour ago so the range is always valid for get_date_range
+    end = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0) - timedelta(hours=1)
+    return end - timedelta(hours=hours), end
+
+
+def run_benchmark(name, url, work_dir, hours, workers, jobs):
+    # Runs in its own process. Returns the seconds taken, the peak RSS of the process and the size of the output.
+    logging.basicConfig(level=logging.WARNING)
+    os.chdir(work_dir)
+    os.environ["DNASPACES_URL"] = url
+    os.environ["TOKEN"] = "benchmark"
+    (start, end) = benchmark_range(hours)
+    if name == "get_client_history":
+        from dnaspaces_get_history import get_client_history
+        from get_date_range import split_dates
+        windows = split_dates(start, end)
+        started = perf_counter()
+        rows = get_client_history(windows, "raw.csv", workers)
+        output_file = "raw.csv"
+    elif name == "convert_history":
+        from convert_history import convert_history
+        shutil.copyfile("raw.csv", "convert.csv")
+        started = perf_counter()
+        convert_history("convert.csv", BENCHMARK_TIMEZONE, False, jobs=jobs)
+        rows = None
+        output_file = "convert.csv"
+    else:
+        from dnaspaces_get_history import main
+        started = perf_counter()
+        main(["-st", start.isoformat(), "-et", end.isoformat(), "-tz", BENCHMARK_TIMEZONE, "-f", "main.csv",
+              "-w", str(workers), "-j", str(jobs)])
+        rows = None
+        output_file = "main.csv"
+    seconds = perf_counter() - started
+    return {"seconds": seconds, "rows": rows, "peak_rss_bytes": peak_rss_bytes(),
+            "output_bytes": os.path.getsize(output_file) if os.path.isfile(output_file) else 0}
+
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(rows_per_hour, hours, workers=1, jobs=1, rate=None, latency=0.0, error_rate=0.0,
+                   benchmarks=BENCHMARKS):
+    # Returns the results of every benchmark with the settings they were run with
+    context = multiprocessing.get_context("spawn")
+    results = []
+    work_dir = tempfile.mkdtemp(prefix="history-benchmark-")
+    try:
+        with MockHistoryServer(rows_per_hour, rate, latency, error_rate) as server:
+            rows = None
+            for name in benchmarks:
+                if name == "convert_history" and not os.path.isfile(os.path.join(work_dir, "raw.csv")):
+                    # convert_history converts the file fetched by get_client_history
+                    rows = run_benchmark_process(context, "get_client_history", server.url, work_dir, hours, workers,
+                                                 jobs)["rows"]
+                result = run_benchmark_process(context, name, server.url, work_dir, hours, workers, jobs)
+                if result["rows"] is not None:
+                    rows = result["rows"]
+                # Every benchmark handles the same rows as the mock server serves the same data each time
+                result["rows"] = rows if rows is not None else int(rows_per_hour * hours)
+                result["rows_per_second"] = result["rows"] / result["seconds"] if result["seconds"] > 0 else None
+                results.append({"name": name, **result})
+                logging.info(f"{name} handled {result['rows']:,} rows in {result['seconds']:.2f} seconds.")
+            server_stats = {"requests": server.requests, "errors": server.errors}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return {"created": datetime.now(timezone.utc).isoformat(),
+            "commit": get_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "settings": {"rows_per_hour": rows_per_hour, "hours": hours, "workers": workers, "jobs": jobs,
+                         "rate": rate, "latency": latency, "error_rate": error_rate},
+            "server": server_stats,
+            "results": results}
+
+
+def send_benchmark(sender, *args):
+    try:
+        sender.send(run_benchmark(*args))
+    finally:
+        sender.close()
+
+
+def run_benchmark_process(context, name, url, work_dir, hours, workers, jobs):
+    # A plain process rather than a pool worker so convert_history can start its own process pool
+    (receiver, sender) = context.Pipe(duplex=False)
+    process = context.Process(target=send_benchmark, args=(sender, name, url, work_dir, hours, workers, jobs))
+    process.start()
+    sender.close()
+    try:
+        return receiver.recv()
+    except EOFError:
+        raise SystemExit(f"Benchmark {name} failed with exit code {process.exitcode}.")
+    finally:
+        process.join()
+
+
+def compare_results(report, previous):
+    # Lines with the change in rows a second and peak RSS of each benchmark since the previous report
+    before = {result["name"]: result for result in previous["results"]}
+    lines = []
+    for result in report["results"]:
+        old = before.get(result["name"])
+        if old is None or not old.get("rows_per_second") or not result.get("rows_per_second"):
+            continue
+        speed = (result["rows_per_second"] / old["rows_per_second"] - 1) * 100
+        line = f"{result['name']}: {result['rows_per_second']:,.0f} rows/s ({speed:+.1f}%)"
+        if old.get("peak_rss_bytes") and result.get("peak_rss_bytes"):
+            memory = (result["peak_rss_bytes"] / old["peak_rss_bytes"] - 1) * 100
+            line += f", peak RSS {result['peak_rss_bytes'] / 1024 ** 2:,.0f}MB ({memory:+.1f}%)"
+        lines.append(line)
+    return lines
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(levelname)s:%(asctime)s:%(funcName)s():%(message)s',
+                        datefmt='%H:%M:%S',
+                        level=logging.INFO)
+    parser = ArgumentParser()
+    parser.add_argument("-rh", "--rows_per_hour", dest="rows_per_hour", type=float, default=500000,
+                        help="Rows of history the mock server serves for each hour.")
+    parser.add_argument("-hr", "--hours", dest="hours", type=int, default=4, help="Hours of history to fetch.")
+    parser.add_argument("-w", "--workers", dest="workers", type=int, default=1,
+                        help="Number of time windows to fetch concurrently.")
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=1, help="Number of processes to convert with.")
+    parser.add_argument("-rt", "--rate", dest="rate", type=float,
+                        help="Most bytes a second the mock server sends each response at.")
+    parser.add_argument("-l", "--latency", dest="latency", type=float, default=0.0,
+                        help="Seconds the mock server waits before the first byte of each response.")
+    parser.add_argument("-e", "--error_rate", dest="error_rate", type=float, default=0.0,
+                        help="Share of requests from 0 to 1 the mock server answers with a 503.")
+    parser.add_argument("-b", "--benchmark", dest="benchmarks", action="append", choices=BENCHMARKS,
+                        help="Benchmark to run. Can be given more than once. All are run if not given.")
+    parser.add_argument("-o", "--output", dest="output", default="benchmark.json",
+                        help="Filename to write the JSON results into.")
+    parser.add_argument("-c", "--compare", dest="compare", help="JSON results of an earlier run to compare with.")
+    args = parser.parse_args()
+    report = run_benchmarks(args.rows_per_hour, args.hours, args.workers, args.jobs, args.rate, args.latency,
+                            args.error_rate, args.benchmarks or BENCHMARKS)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    logging.info(f"Wrote results to {args.output}.")
+    if args.compare is not None:
+        try:
+            with open(args.compare) as f:
+                previous = json.load(f)
+        except (IOError, ValueError) as e:
+            logging.error(f"Unable to read earlier results {args.compare}. Got error {e}.")
+        else:
+            for line in compare_results(report, previous):
+                logging.info(line)
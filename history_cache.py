@@ -0,0 +1,122 @@
+#
+# history_cache.py keeps the raw CSV payload of every completed time window on local disk, keyed by tenant and the UTC
+# bounds of the window, so overlapping runs only download the windows they have not seen before. The cache is limited
+# in size and evicts the least recently used windows first. Windows older than the MAX_DAYS horizon of the API can no
+# longer be downloaded again so they are only evicted once nothing else is left.
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from time import time
+import requests
+from constants import MAX_DAYS, CACHE_MIN_WINDOW_AGE_SECONDS, RAW_STREAM_BLOCK_SIZE
+
+
+def get_tenant_key(token):
+    # The token identifies the tenant. Only a hash of it is kept on disk.
+    return hashlib.sha256(token.encode()).hexdigest()[:16]
+
+
+class CachedResponse:
+    # Stands in for a streamed requests response, handing out the blocks of a cached window or of a live response
+    # that is being copied into the cache
+    status_code = requests.codes.ok
+    text = ""
+    iter_lines = requests.Response.iter_lines
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+
+    def iter_content(self, chunk_size=RAW_STREAM_BLOCK_SIZE, decode_unicode=False):
+        return self.blocks(chunk_size)
+
+
+class HistoryCache:
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    def get_window_filename(self, tenant, payload):
+        return os.path.join(self.cache_dir, tenant, f"{payload['startTime']}-{payload['endTime']}.csv")
+
+    def get_response(self, tenant, payload):
+        # Returns a response reading the window from the cache, or None if it has not been cached
+        window_file = self.get_window_filename(tenant, payload)
+        if not os.path.isfile(window_file):
+            return None
+        try:
+            # The modification time records when the window was last used for eviction
+            os.utime(window_file)
+        except OSError:
+            return None
+        logging.info(f"Using cached window {payload['startTime']} to {payload['endTime']} from {window_file}.")
+
+        def blocks(chunk_size):
+            with open(window_file, "rb") as f:
+                while True:
+                    block = f.read(chunk_size)
+                    if not block:
+                        break
+                    yield block
+
+        return CachedResponse(blocks)
+
+    def cacheable(self, payload):
+        # Windows that ended only recently may still get late records so they are always downloaded
+        return payload["endTime"] <= (time() - CACHE_MIN_WINDOW_AGE_SECONDS) * 1000
+
+    def store_response(self, tenant, payload, response):
+        # Copy the blocks of response into the cache as they are read. The window is only added once the whole stream
+        # has been read without an error.
+        if not self.cacheable(payload):
+            return response
+        window_file = self.get_window_filename(tenant, payload)
+
+        def blocks(chunk_size):
+            os.makedirs(os.path.dirname(window_file), exist_ok=True)
+            (fd, tmp_window_file) = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(window_file))
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    for block in response.iter_content(chunk_size=chunk_size):
+                        f.write(block)
+                        yield block
+                os.replace(tmp_window_file, window_file)
+                logging.debug(f"Cached window {payload['startTime']} to {payload['endTime']} in {window_file}.")
+            finally:
+                if os.path.isfile(tmp_window_file):
+                    os.remove(tmp_window_file)
+            self.evict()
+
+        return CachedResponse(blocks)
+
+    def evict(self):
+        # Remove least recently used windows until the cache fits in max_bytes, keeping the windows the API can no
+        # longer serve until last
+        with self.lock:
+            horizon_ms = (time() - MAX_DAYS * 24 * 60 * 60) * 1000
+            windows = []
+            total_bytes = 0
+            for (dir_path, _, filenames) in os.walk(self.cache_dir):
+                for filename in filenames:
+                    if not filename.endswith(".csv"):
+                        continue
+                    window_file = os.path.join(dir_path, filename)
+                    try:
+                        stat = os.stat(window_file)
+                        end_ms = int(filename[:-len(".csv")].split("-")[1])
+                    except (OSError, ValueError, IndexError):
+                        continue
+                    windows.append((end_ms < horizon_ms, stat.st_mtime, stat.st_size, window_file))
+                    total_bytes += stat.st_size
+            for (_, _, size, window_file) in sorted(windows):
+                if total_bytes <= self.max_bytes:
+                    break
+                try:
+                    os.remove(window_file)
+                except OSError as e:
+                    logging.error(f"Unable to remove cached window {window_file}. Got error {e}.")
+                    continue
+                total_bytes -= size
+                logging.debug(f"Evicted cached window {window_file}.")
@@ -0,0 +1,220 @@
+#
+# history_colocation.py finds clients that were within a radius of each other on the same floor within a time
+# tolerance and writes each contact with its start, end and duration. Rows are bucketed by floor, time slice and grid
+# cell so only rows in neighbouring buckets are compared, with NumPy doing the distance checks.
+#
+# The history is read in chunks in sourcetimestamp order. A time slice is as long as the tolerance, so once a chunk
+# has moved on to a later slice only the rows of the last two slices are kept, plus as far back as rows have been seen
+# out of order. Memory stays bounded by the chunk size and the contacts still in progress, however long the file is.
+# Rows later than any seen before, which are older than the kept rows when they arrive, can no longer be matched so
+# they are skipped and counted.
+from argparse import ArgumentParser
+import logging
+import numpy as np
+import pandas as pd
+from convert_history import local_datetimes, format_datetimes
+from history_compression import open_history
+from history_store import timestamp_ms, get_timezone
+from constants import CONVERT_FILE_CHUNK_SIZE, DEFAULT_COLOCATION_RADIUS, DEFAULT_COLOCATION_SECONDS
+
+COLOCATION_COLUMNS = ["macaddress", "floorid", "coordinatex", "coordinatey", "sourcetimestamp"]
+CONTACT_COLUMNS = ["macaddress_a", "macaddress_b", "floorid", "start", "end", "duration_seconds", "sightings"]
+# Grid cells are packed into one int64 key as floor << 42 | x << 21 | y, with x and y offset to stay positive
+CELL_BITS = 21
+CELL_OFFSET = 1 << (CELL_BITS - 1)
+NEIGHBOUR_CELLS = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+# Buckets are packed into one int64 key as the number of the cell among the cells of the rows << 32 | time slice
+SLICE_BITS = 32
+NEIGHBOUR_SLICES = [-1, 0, 1]
+
+
+def cell_keys(floor_codes, x, y, radius):
+    cx = np.clip(np.floor(x / radius).astype("int64") + CELL_OFFSET, 1, 2 * CELL_OFFSET - 2)
+    cy = np.clip(np.floor(y / radius).astype("int64") + CELL_OFFSET, 1, 2 * CELL_OFFSET - 2)
+    return (floor_codes << (2 * CELL_BITS)) | (cx << CELL_BITS) | cy
+
+
+def time_slices(ts, tolerance_ms):
+    # Time slices as long as the tolerance, numbered from 1 so the slice before is never negative. Rows within the
+    # tolerance of each other are always in the same or a neighbouring slice.
+    return (ts - ts.min()) // max(tolerance_ms, 1) + 1 if len(ts) else ts
+
+
+def neighbour_pairs(a_cells, a_slices, b_cells, b_slices):
+    # Index pairs (i, j) of every a row and b row in the same or a neighbouring grid cell and time slice. The cells of
+    # b are numbered and b is sorted by cell and slice once, then each of the 27 neighbouring buckets is a range
+    # lookup expanded into pairs without a Python loop over rows.
+    (cells, b_numbers) = np.unique(b_cells, return_inverse=True)
+    b_keys = (b_numbers.astype("int64") << SLICE_BITS) | b_slices
+    order = np.argsort(b_keys, kind="stable")
+    sorted_keys = b_keys[order]
+    a_index = []
+    b_index = []
+    for (dx, dy) in NEIGHBOUR_CELLS:
+        neighbours = a_cells + (dx << CELL_BITS) + dy
+        numbers = np.minimum(np.searchsorted(cells, neighbours), max(len(cells) - 1, 0))
+        found = cells[numbers] == neighbours if len(cells) else np.zeros(len(a_cells), dtype=bool)
+        for ds in NEIGHBOUR_SLICES:
+            keys = (numbers.astype("int64") << SLICE_BITS) + a_slices + ds
+            lo = np.searchsorted(sorted_keys, keys, side="left")
+            counts = np.where(found, np.searchsorted(sorted_keys, keys, side="right") - lo, 0)
+            total = int(counts.sum())
+            if total == 0:
+                continue
+            starts = np.repeat(lo - (np.cumsum(counts) - counts), counts)
+            a_index.append(np.repeat(np.arange(len(a_cells)), counts))
+            b_index.append(order[starts + np.arange(total)])
+    if not a_index:
+        return np.empty(0, dtype="int64"), np.empty(0, dtype="int64")
+    return np.concatenate(a_index), np.concatenate(b_index)
+
+
+def find_contacts(rows, first_new, radius, tolerance_ms):
+    # Pairs of rows within radius and tolerance_ms of each other where at least one row is new, i.e. at or after
+    # position first_new. Rows are numbered in arrival order and each pair is only found once.
+    slices = time_slices(rows["ts"], tolerance_ms)
+    (i, j) = neighbour_pairs(rows["key"][first_new:], slices[first_new:], rows["key"], slices)
+    i += first_new
+    keep = j < i
+    (i, j) = (i[keep], j[keep])
+    keep = (rows["mac"][i] != rows["mac"][j]) & (np.abs(rows["ts"][i] - rows["ts"][j]) <= tolerance_ms) & \
+           (np.hypot(rows["x"][i] - rows["x"][j], rows["y"][i] - rows["y"][j]) <= radius)
+    (i, j) = (i[keep], j[keep])
+    swap = rows["mac"][i] > rows["mac"][j]
+    return pd.DataFrame({"mac_a": np.where(swap, rows["mac"][j], rows["mac"][i]),
+                         "mac_b": np.where(swap, rows["mac"][i], rows["mac"][j]),
+                         "floor": rows["floor"][i],
+                         "start": np.minimum(rows["ts"][i], rows["ts"][j]),
+                         "end": np.maximum(rows["ts"][i], rows["ts"][j]),
+                         "sightings": 1})
+
+
+def merge_contacts(contacts, tolerance_ms):
+    # Join the sightings of each pair of clients into contacts, starting a new contact when the pair was not seen
+    # together for longer than tolerance_ms
+    if len(contacts) == 0:
+        return contacts
+    contacts = contacts.sort_values(["mac_a", "mac_b", "floor", "start"], kind="stable", ignore_index=True)
+    pair = contacts.groupby(["mac_a", "mac_b", "floor"], sort=False).ngroup()
+    previous_end = contacts.groupby(pair)["end"].cummax().groupby(pair).shift()
+    new_contact = previous_end.isna() | (contacts["start"] - previous_end > tolerance_ms)
+    return contacts.groupby(new_contact.cumsum()).agg({"mac_a": "first", "mac_b": "first", "floor": "first",
+                                                       "start": "min", "end": "max", "sightings": "sum"})
+
+
+def write_contacts(contacts, f, timezone):
+    df = pd.DataFrame({"macaddress_a": contacts["mac_a"],
+                       "macaddress_b": contacts["mac_b"],
+                       "floorid": contacts["floor"],
+                       "start": format_datetimes(local_datetimes(contacts["start"], timezone)),
+                       "end": format_datetimes(local_datetimes(contacts["end"], timezone)),
+                       "duration_seconds": (contacts["end"] - contacts["start"]) / 1000,
+                       "sightings": contacts["sightings"]})
+    df.to_csv(f, header=False, index=False)
+
+
+def read_rows(df, floor_codes, radius, timezone):
+    df = df[(df["floorid"] != "") & (df["coordinatex"] != "") & (df["coordinatey"] != "")]
+    floors = df["floorid"].to_numpy()
+    for floor in pd.unique(floors):
+        floor_codes.setdefault(floor, len(floor_codes))
+    x = pd.to_numeric(df["coordinatex"], errors="coerce").to_numpy(dtype="float64")
+    y = pd.to_numeric(df["coordinatey"], errors="coerce").to_numpy(dtype="float64")
+    ts = timestamp_ms(df["sourcetimestamp"], timezone).to_numpy(dtype="float64", na_value=np.nan)
+    valid = ~(np.isnan(x) | np.isnan(y) | np.isnan(ts))
+    codes = pd.Series(floors).map(floor_codes).to_numpy(dtype="int64")
+    return {"mac": df["macaddress"].to_numpy()[valid],
+            "floor": floors[valid],
+            "x": x[valid],
+            "y": y[valid],
+            "ts": ts[valid].astype("int64"),
+            "key": cell_keys(codes[valid], x[valid], y[valid], radius)}
+
+
+def colocate_history(data_file, out_file, timezone, radius=DEFAULT_COLOCATION_RADIUS,
+                     tolerance_seconds=DEFAULT_COLOCATION_SECONDS, macaddress=None):
+    # Write every contact between two clients, or between macaddress and anyone else if given, to out_file.
+    # Returns the number of contacts written and the number of rows skipped as they arrived too late to be matched.
+    tolerance_ms = int(tolerance_seconds * 1000)
+    floor_codes = {}
+    kept = None
+    horizon = None
+    # The latest sourcetimestamp so far and the furthest any row has been behind the latest row before it
+    latest = None
+    lag = 0
+    open_contacts = None
+    total_rows = 0
+    total_contacts = 0
+    late_rows = 0
+    try:
+        with open_history(data_file) as source, open_history(out_file, "wt") as f:
+            f.write(",".join(CONTACT_COLUMNS) + "\n")
+            for df in pd.read_csv(source, chunksize=CONVERT_FILE_CHUNK_SIZE, dtype=str, keep_default_na=False,
+                                  usecols=COLOCATION_COLUMNS):
+                new = read_rows(df, floor_codes, radius, timezone)
+                if len(new["ts"]) > 0:
+                    before = np.maximum.accumulate(np.concatenate([[new["ts"][0] if latest is None else latest],
+                                                                   new["ts"]]))
+                    lag = max(lag, int((before[:-1] - new["ts"]).max()))
+                    latest = int(before[-1])
+                if kept is not None:
+                    # Rows from slices that have already been dropped can no longer be matched
+                    late = new["ts"] < horizon
+                    late_rows += int(late.sum())
+                    new = {name: values[~late] for (name, values) in new.items()}
+                rows = new if kept is None else {name: np.concatenate([kept[name], new[name]]) for name in new}
+                first_new = 0 if kept is None else len(kept["ts"])
+                contacts = find_contacts(rows, first_new, radius, tolerance_ms)
+                if macaddress is not None:
+                    contacts = contacts[(contacts["mac_a"] == macaddress) | (contacts["mac_b"] == macaddress)]
+                contacts = merge_contacts(pd.concat([open_contacts, contacts], ignore_index=True), tolerance_ms)
+                if len(rows["ts"]) == 0:
+                    continue
+                # Only the rows of the last two time slices, and as far back as rows have arrived out of order, can
+                # still be within the tolerance of a later row. Later sightings start after the horizon and contacts
+                # that ended a tolerance before it are done.
+                horizon = ((latest - lag) // tolerance_ms - 1) * tolerance_ms
+                still_open = contacts["end"] >= horizon - tolerance_ms
+                write_contacts(contacts[~still_open], f, timezone)
+                total_contacts += int((~still_open).sum())
+                open_contacts = contacts[still_open]
+                keep = rows["ts"] >= horizon
+                kept = {name: values[keep] for (name, values) in rows.items()}
+                total_rows += len(df)
+                logging.info(f"Checked {total_rows:,} rows and wrote {total_contacts:,} contacts to {out_file}.")
+            if open_contacts is not None:
+                write_contacts(open_contacts, f, timezone)
+                total_contacts += len(open_contacts)
+    except (pd.errors.EmptyDataError, ValueError) as e:
+        logging.error(f"Unable to read csv file {data_file}. Got error {e}.")
+        return 0, late_rows
+    except IOError as e:
+        logging.error(f"Unable to write contacts file {out_file}. Got error {e}.")
+        return 0, late_rows
+    if late_rows:
+        logging.error(f"{late_rows:,} rows were further out of sourcetimestamp order than any row before them and "
+                      f"were skipped. Sort the file by sourcetimestamp to match them.")
+    logging.info(f"Wrote {total_contacts:,} contacts to {out_file}. Skipped {late_rows:,} rows.")
+    return total_contacts, late_rows
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(levelname)s:%(asctime)s:%(funcName)s():%(message)s',
+                        datefmt='%H:%M:%S',
+                        level=logging.INFO)
+    parser = ArgumentParser()
+    parser.add_argument("filename", help="Raw or converted history csv file in sourcetimestamp order.")
+    parser.add_argument("-o", "--output", dest="output", default="contacts.csv",
+                        help="Filename to write the contacts into.")
+    parser.add_argument("-tz", "--timezone", dest="timezone",
+                        help="Time zone database name e.g. Australia/Sydney of converted files and contact times.")
+    parser.add_argument("-r", "--radius", dest="radius", type=float, default=DEFAULT_COLOCATION_RADIUS,
+                        help="Distance in the units of coordinatex and coordinatey within which clients are in "
+                             "contact.")
+    parser.add_argument("-ts", "--tolerance", dest="tolerance", type=float, default=DEFAULT_COLOCATION_SECONDS,
+                        help="Seconds apart two clients can be seen and still be in contact.")
+    parser.add_argument("-m", "--macaddress", dest="macaddress",
+                        help="Only write the contacts of this MAC address.")
+    args = parser.parse_args()
+    colocate_history(args.filename, args.output, get_timezone(args.timezone), args.radius, args.tolerance,
+                     args.macaddress)
@@ -0,0 +1,73 @@
+#
+# history_compression.py opens history files compressed with gzip or zstd, picked from the .gz or .zst extension of
+# the filename. Output is written as one gzip member or zstd frame per time window so byte ranges of a file can still
+# be copied and concatenated when resuming. zstd needs the optional zstandard package.
+import gzip
+import io
+import logging
+from contextlib import nullcontext
+from os import path
+from constants import GZIP_COMPRESSION_LEVEL, ZSTD_COMPRESSION_LEVEL
+
+COMPRESSION_EXTENSIONS = {".gz": "gzip", ".zst": "zstd"}
+COMPRESSION_LEVELS = {"gzip": GZIP_COMPRESSION_LEVEL, "zstd": ZSTD_COMPRESSION_LEVEL}
+
+
+def get_compression(filename):
+    return COMPRESSION_EXTENSIONS.get(path.splitext(filename)[1].lower())
+
+
+def strip_compression_extension(filename):
+    if get_compression(filename) is None:
+        return filename
+    return path.splitext(filename)[0]
+
+
+def check_compression(filename):
+    # Make sure the library for the compression of filename can be imported before any data is fetched
+    if get_compression(filename) != "zstd":
+        return True
+    try:
+        import zstandard
+    except ImportError as e:
+        logging.error(f"Writing {filename} needs zstandard. Install it with pip install zstandard. Got error {e}")
+        return False
+    return True
+
+
+def compression_level(compression, level=None):
+    return COMPRESSION_LEVELS[compression] if level is None else level
+
+
+def compress_stream(f, compression, level=None):
+    # Wrap the open binary file f so everything written is compressed as a single gzip member or zstd frame, which is
+    # finished when the wrapper is closed. f itself is left open. Without compression f is written to directly.
+    if compression is None:
+        return nullcontext(f)
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=f, mode="wb", compresslevel=compression_level(compression, level), mtime=0)
+    import zstandard
+    return zstandard.ZstdCompressor(level=compression_level(compression, level)).stream_writer(f, closefd=False)
+
+
+def open_history(filename, mode="rb", level=None, compression=None):
+    # Open a history file for reading or writing in binary ("rb", "wb") or text ("rt", "wt") mode, compressed
+    # according to its extension unless compression is given. Text mode leaves line endings alone like the csv module.
+    compression = compression or get_compression(filename)
+    binary_mode = mode.replace("t", "") + ("b" if "b" not in mode else "")
+    if compression is None:
+        f = open(filename, binary_mode)
+    elif compression == "gzip":
+        f = gzip.open(filename, binary_mode, compresslevel=compression_level(compression, level))
+    else:
+        import zstandard
+        raw_file = open(filename, binary_mode)
+        if "r" in mode:
+            f = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw_file, read_across_frames=True,
+                                                                              closefd=True))
+        else:
+            f = zstandard.ZstdCompressor(level=compression_level(compression, level)).stream_writer(raw_file,
+                                                                                                   closefd=True)
+    if "t" in mode:
+        return io.TextIOWrapper(f, newline="")
+    return f
@@ -0,0 +1,335 @@
+#
+# history_daemon.py keeps one process running that fetches and converts history on a schedule, so pandas is imported
+# once, the HTTPS sessions to DNA Spaces stay open between runs and the conversion processes are started once. Jobs
+# are read from a JSON file, each with a name, the dnaspaces_get_history.py arguments to run with and how many minutes
+# apart to run. A small HTTP endpoint on localhost shows the status of the jobs and runs, starts a job straight away
+# and queues ad-hoc exports. Runs are done one at a time in the order they were queued. Every request must carry the
+# token in the DAEMON_TOKEN environment variable, and ad-hoc exports only write inside the export directory.
+#
+# DAEMON_TOKEN=secret python history_daemon.py -c jobs.json -p 8765 -j 4 -o /data/exports
+# curl -H "Authorization: Bearer secret" http://127.0.0.1:8765/status
+# curl -H "Authorization: Bearer secret" -X POST http://127.0.0.1:8765/jobs/sydney/run
+# curl -H "Authorization: Bearer secret" -H "Content-Type: application/json" -X POST http://127.0.0.1:8765/exports \
+#   -d '{"args": ["-st", "2020-05-25", "-et", "2020-05-26", "-f", "export.csv"]}'
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue
+from time import time
+import hmac
+import json
+import logging
+import os
+import signal
+import threading
+from dnaspaces_client import ClientPool
+from dnaspaces_get_history import get_arguments, fetch_and_convert, setup_logging, get_config, get_filename
+from history_metrics import run_metrics
+# dnaspaces_get_history only loads the conversion, and with it pandas, when it is first needed. The daemon loads it up
+# front so no run pays for it and forked conversion processes start with it already loaded.
+import convert_history
+from constants import DAEMON_HOST, DEFAULT_DAEMON_PORT, DEFAULT_JOB_MINUTES, DAEMON_RUN_HISTORY, DEFAULT_JOBS, \
+    DAEMON_TOKEN_ENV
+
+QUEUED = "queued"
+RUNNING = "running"
+FINISHED = "finished"
+FAILED = "failed"
+# Arguments of an ad-hoc export naming files or directories it writes
+EXPORT_PATH_ARGUMENTS = ["filename", "metrics_json", "metrics_prom", "cache_dir"]
+
+
+def load_jobs(jobs_file):
+    # A JSON object with a list of "jobs", each with a "name", the dnaspaces_get_history.py "args" and optionally
+    # "every_minutes". Jobs with arguments that do not parse are left out.
+    try:
+        with open(jobs_file) as f:
+            config = json.load(f)
+    except (IOError, ValueError) as e:
+        logging.error(f"Unable to read jobs file {jobs_file}. Got error {e}.")
+        return []
+    jobs = []
+    for job in config.get("jobs", []):
+        if parse_arguments(job.get("args", [])) is None:
+            logging.error(f"Skipping job {job.get('name')} as its arguments are not valid.")
+            continue
+        jobs.append({"name": job["name"], "args": job.get("args", []),
+                     "every_minutes": job.get("every_minutes", DEFAULT_JOB_MINUTES)})
+    return jobs
+
+
+def parse_arguments(args):
+    # argparse exits on arguments it cannot parse, which must not stop the daemon
+    try:
+        return get_arguments(args)
+    except SystemExit:
+        logging.error(f"Unable to parse arguments {args}.")
+        return None
+
+
+def confine_export(cmd_args, export_dir):
+    # Anyone with the token can queue an export, so exports only write inside export_dir. Relative paths are taken
+    # from export_dir and the parsed arguments are changed to the full paths. Returns why the export is not allowed,
+    # or None.
+    if export_dir is None:
+        return "Exports are not enabled. Start the daemon with an export directory."
+    if cmd_args.tenants is not None:
+        return "Exports cannot use a tenants file."
+    root = os.path.realpath(export_dir)
+    if cmd_args.filename is None:
+        cmd_args.filename = get_filename(timestamped=not cmd_args.sync)
+    for name in EXPORT_PATH_ARGUMENTS:
+        value = getattr(cmd_args, name)
+        if value is None:
+            continue
+        full_path = os.path.realpath(os.path.join(root, value))
+        if os.path.commonpath([root, full_path]) != root:
+            return f"{value} is not in the export directory."
+        setattr(cmd_args, name, full_path)
+    return None
+
+
+def export_arguments(args, export_dir):
+    # Returns the parsed arguments of an ad-hoc export and why it is not allowed, or None if it is
+    cmd_args = parse_arguments(args) if isinstance(args, list) else None
+    if cmd_args is None:
+        return None, "Expected a JSON object with a list of valid dnaspaces_get_history.py arguments as args."
+    return cmd_args, confine_export(cmd_args, export_dir)
+
+
+def iso_time(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat() if timestamp is not None else None
+
+
+class HistoryDaemon:
+    def __init__(self, jobs, token, host=DAEMON_HOST, port=DEFAULT_DAEMON_PORT, conversion_jobs=DEFAULT_JOBS,
+                 export_dir=None):
+        # Every job starts its first run straight away. Requests without the token are turned away.
+        self.jobs = {job["name"]: dict(job, next_run=time(), last_run=None) for job in jobs}
+        self.token = token
+        self.export_dir = export_dir
+        self.runs = []
+        self.next_id = 1
+        self.queue = Queue()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.clients = ClientPool()
+        self.executor = ProcessPoolExecutor(max_workers=conversion_jobs) if conversion_jobs > 1 else None
+        self.server = ThreadingHTTPServer((host, port), self.handler())
+        self.server.daemon_threads = True
+        self.threads = []
+
+    @property
+    def url(self):
+        (host, port) = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        self.threads = [threading.Thread(target=target, daemon=True)
+                        for target in [self.server.serve_forever, self.schedule, self.work]]
+        for thread in self.threads:
+            thread.start()
+        logging.info(f"History daemon listening on {self.url} with {len(self.jobs)} jobs.")
+
+    def stop(self):
+        # The run in progress is finished first
+        self.stopping.set()
+        self.queue.put(None)
+        self.server.shutdown()
+        self.server.server_close()
+        for thread in self.threads:
+            thread.join()
+        self.clients.close()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def submit(self, args, job_name=None):
+        # Queue a run. A job that is already queued or running is not queued again.
+        with self.lock:
+            if job_name is not None:
+                last_run = self.jobs[job_name]["last_run"]
+                if last_run is not None and last_run["state"] in [QUEUED, RUNNING]:
+                    return last_run
+            run = {"id": self.next_id, "job": job_name, "args": args, "state": QUEUED, "queued": iso_time(time()),
+                   "started": None, "finished": None, "fetched": None, "error": None, "metrics": None}
+            self.next_id += 1
+            self.runs.append(run)
+            if job_name is not None:
+                self.jobs[job_name]["last_run"] = run
+            # Only the newest runs are kept, finished or not
+            del self.runs[:-DAEMON_RUN_HISTORY]
+        self.queue.put(run)
+        return run
+
+    def schedule(self):
+        while not self.stopping.is_set():
+            now = time()
+            with self.lock:
+                due = [job for job in self.jobs.values() if job["next_run"] <= now]
+                for job in due:
+                    job["next_run"] = now + job["every_minutes"] * 60
+                wait = min([job["next_run"] for job in self.jobs.values()], default=now + 60) - now
+            for job in due:
+                logging.debug(f"Job {job['name']} is due.")
+                self.submit(job["args"], job["name"])
+            self.stopping.wait(max(wait, 0))
+
+    def work(self):
+        while True:
+            run = self.queue.get()
+            # Runs still queued when the daemon stops are not started
+            if run is None or self.stopping.is_set():
+                return
+            self.execute(run)
+
+    def execute(self, run):
+        with self.lock:
+            run["state"] = RUNNING
+            run["started"] = iso_time(time())
+        logging.info(f"Starting run {run['id']} of {run['job'] or 'export'} with arguments {run['args']}.")
+        fetched = None
+        error = None
+        # Arguments are parsed for every run so default start and end times are relative to when it runs
+        if run["job"] is None:
+            (cmd_args, error) = export_arguments(run["args"], self.export_dir)
+        else:
+            cmd_args = parse_arguments(run["args"])
+            error = "Unable to parse arguments." if cmd_args is None else None
+        if error is None:
+            try:
+                fetched = fetch_and_convert(cmd_args, self.clients, self.executor)
+            except (Exception, SystemExit) as e:
+                logging.error(f"Run {run['id']} failed with error {e}.")
+                error = str(e) or type(e).__name__
+        report = run_metrics.report()
+        with self.lock:
+            run["state"] = FAILED if error is not None else FINISHED
+            run["finished"] = iso_time(time())
+            run["fetched"] = fetched
+            run["error"] = error
+            run["metrics"] = {key: report[key] for key in ["duration_seconds", "tenants", "convert"]}
+        logging.info(f"Run {run['id']} {run['state']}.")
+
+    def status(self):
+        with self.lock:
+            jobs = [{"name": job["name"], "args": job["args"], "every_minutes": job["every_minutes"],
+                     "next_run": iso_time(job["next_run"]),
+                     "last_run": job["last_run"]["id"] if job["last_run"] is not None else None}
+                    for job in self.jobs.values()]
+            return json.loads(json.dumps({"jobs": jobs, "runs": self.runs}))
+
+    def get_run(self, run_id):
+        with self.lock:
+            for run in self.runs:
+                if run["id"] == run_id:
+                    return json.loads(json.dumps(run))
+        return None
+
+    def handler(self):
+        daemon = self
+
+        class DaemonHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                logging.debug(f"History daemon {self.address_string()} {format % args}")
+
+            def send_json(self, status, body):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def read_json(self):
+                # Only a JSON body is read. A web page can only send one cross-origin after a preflight, which is
+                # never answered.
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+                if self.headers.get_content_type() != "application/json":
+                    return None
+                try:
+                    return json.loads(body or b"{}")
+                except ValueError:
+                    return None
+
+            def authorised(self):
+                expected = f"Bearer {daemon.token}".encode()
+                if hmac.compare_digest(self.headers.get("Authorization", "").encode(), expected):
+                    return True
+                self.send_json(401, {"error": "Missing or wrong token."})
+                return False
+
+            def do_GET(self):
+                if not self.authorised():
+                    return
+                parts = self.path.strip("/").split("/")
+                if parts == ["status"]:
+                    return self.send_json(200, daemon.status())
+                if len(parts) == 2 and parts[0] == "runs" and parts[1].isdigit():
+                    run = daemon.get_run(int(parts[1]))
+                    if run is not None:
+                        return self.send_json(200, run)
+                self.send_json(404, {"error": f"Nothing at {self.path}."})
+
+            def do_POST(self):
+                if not self.authorised():
+                    return
+                parts = self.path.strip("/").split("/")
+                body = self.read_json()
+                if len(parts) == 3 and parts[0] == "jobs" and parts[2] == "run":
+                    if parts[1] not in daemon.jobs:
+                        return self.send_json(404, {"error": f"No job named {parts[1]}."})
+                    return self.send_json(202, daemon.submit(daemon.jobs[parts[1]]["args"], parts[1]))
+                if parts == ["exports"]:
+                    if body is None:
+                        return self.send_json(415, {"error": "Expected a body with Content-Type application/json."})
+                    (_, error) = export_arguments(body.get("args") if isinstance(body, dict) else None,
+                                                  daemon.export_dir)
+                    if error is not None:
+                        return self.send_json(400, {"error": error})
+                    return self.send_json(202, daemon.submit(body["args"]))
+                self.send_json(404, {"error": f"Nothing at {self.path}."})
+
+        return DaemonHandler
+
+
+if __name__ == '__main__':
+    setup_logging()
+    parser = ArgumentParser()
+    parser.add_argument("-c", "--config", dest="config", required=True,
+                        help="JSON file with the jobs to run, each with a name, the dnaspaces_get_history.py args and "
+                             "every_minutes.")
+    parser.add_argument("-H", "--host", dest="host", default=DAEMON_HOST,
+                        help="Address to listen on for status and ad-hoc exports. Anyone who can reach it and has the "
+                             f"token in {DAEMON_TOKEN_ENV} can start runs.")
+    parser.add_argument("-p", "--port", dest="port", type=int, default=DEFAULT_DAEMON_PORT, help="Port to listen on.")
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=DEFAULT_JOBS,
+                        help="Number of conversion processes to keep running for runs that convert with -j.")
+    parser.add_argument("-o", "--export_dir", dest="export_dir",
+                        help="Directory ad-hoc exports write their files into. Without it exports are turned away.")
+    args = parser.parse_args()
+    token = get_config(DAEMON_TOKEN_ENV)
+    if len(token) == 0:
+        raise SystemExit(1)
+    if args.host != DAEMON_HOST:
+        logging.info(f"Listening on {args.host}. Anyone who can reach it with the token can start runs.")
+    daemon = HistoryDaemon(load_jobs(args.config), token, args.host, args.port, args.jobs, args.export_dir)
+    # A service manager stops the daemon with SIGTERM
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stopping.set())
+    daemon.start()
+    try:
+        daemon.stopping.wait()
+    except KeyboardInterrupt:
+        logging.info("Stopping.")
+    finally:
+        daemon.stop()
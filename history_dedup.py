@@ -0,0 +1,115 @@
+#
+# history_dedup.py drops repeated rows of client history as they stream in. A row repeats an earlier one when it has
+# the same macaddress, sourcetimestamp and floorid. Time windows share their endpoints, so the rows at a boundary can
+# come back in both windows. The keys of the rows within DEDUP_BOUNDARY_MS of each window edge are kept for as long as
+# the run, however many rows the windows on either side of the edge return in between. Repeats inside a window are
+# found with a sliding window of the hashes of its most recent rows, so memory stays the same however big the export
+# is.
+import csv
+import logging
+import threading
+from collections import deque
+from operator import itemgetter
+from constants import DEDUP_WINDOW_ROWS, DEDUP_BOUNDARY_MS
+
+DEDUP_KEY = ["macaddress", "sourcetimestamp", "floorid"]
+# Position of sourcetimestamp in DEDUP_KEY
+TIMESTAMP_FIELD = 1
+
+
+def key_indexes(header):
+    # The positions of the key columns in the header line, or None if any of them is missing
+    columns = header.split(",")
+    if not all(column in columns for column in DEDUP_KEY):
+        logging.error(f"The history does not have all of the columns {DEDUP_KEY}. Not dropping repeated rows.")
+        return None
+    return [columns.index(column) for column in DEDUP_KEY]
+
+
+def row_key(line, indexes, last, key_fields=None):
+    # The key fields of the line as bytes. Only the fields up to the last key column are split. Quoted fields with
+    # commas in them are rare, so the csv module is only used for lines with a quote before the key columns.
+    fields = line.split(b",", last + 1)
+    if len(fields) <= last:
+        return None
+    if b'"' in line and any(b'"' in field for field in fields[:last + 1]):
+        fields = [field.encode() for field in next(csv.reader([line.decode(errors="replace")]))]
+    return (key_fields or itemgetter(*indexes))(fields)
+
+
+def boundary_edge(key, window):
+    # The edge of the window the row is within DEDUP_BOUNDARY_MS of, or None if it is not near either edge
+    try:
+        timestamp = int(key[TIMESTAMP_FIELD])
+    except ValueError:
+        return None
+    for edge in (window["start_ms"], window["end_ms"]):
+        if abs(timestamp - edge) <= DEDUP_BOUNDARY_MS:
+            return edge
+    return None
+
+
+class RecentRows:
+    # The dedup shared by the windows of a file, including windows fetched at the same time. Each window edge keeps
+    # the keys of its rows with the window that kept them, so a boundary row is kept by whichever window gets to it
+    # first. Every fetch of a window registers with start_window and drops its recent rows with finish_window. When
+    # the output of a fetch is thrown away its rows are forgotten with discard, so fetching the window again keeps
+    # them.
+    def __init__(self, size=DEDUP_WINDOW_ROWS):
+        self.size = size
+        self.edges = {}
+        self.windows = {}
+        self.next_window = 1
+        self.discarded = set()
+        self.lock = threading.Lock()
+
+    def start_window(self, window):
+        # window is the manifest window being fetched
+        with self.lock:
+            fetch = self.next_window
+            self.next_window += 1
+            self.windows[fetch] = {"start_ms": window["start_ms"], "end_ms": window["end_ms"], "seen": set(),
+                                   "order": deque()}
+            return fetch
+
+    def finish_window(self, fetch):
+        with self.lock:
+            self.windows.pop(fetch, None)
+
+    def discard(self, fetch):
+        with self.lock:
+            self.discarded.add(fetch)
+
+    def repeated(self, key, fetch, window):
+        # Whether the key is a repeat of a row kept by this window or, at an edge, a window next to it. Must be called
+        # with the lock held.
+        hashed = hash(key)
+        if hashed in window["seen"]:
+            return True
+        edge = boundary_edge(key, window)
+        if edge is not None:
+            owners = self.edges.setdefault(edge, {})
+            owner = owners.get(hashed)
+            if owner is not None and owner != fetch and owner not in self.discarded:
+                return True
+            owners[hashed] = fetch
+        window["seen"].add(hashed)
+        window["order"].append(hashed)
+        if len(window["order"]) > self.size:
+            window["seen"].discard(window["order"].popleft())
+        return False
+
+    def drop_repeats(self, indexes, lines, fetch):
+        # Returns the lines that were not seen before and the number of lines dropped
+        if indexes is None:
+            return lines, 0
+        last = max(indexes)
+        key_fields = itemgetter(*indexes)
+        keys = [row_key(line, indexes, last, key_fields) for line in lines]
+        kept = []
+        with self.lock:
+            window = self.windows[fetch]
+            for (line, key) in zip(lines, keys):
+                if key is None or not self.repeated(key, fetch, window):
+                    kept.append(line)
+        return kept, len(lines) - len(kept)
@@ -0,0 +1,185 @@
+#
+# history_dwell.py compacts the history into dwell segments and occupancy counts. Consecutive rows of a client on the
+# same floor that are within a radius of the row before and not more than a gap apart become one segment with its
+# start, end, mean position and number of samples. The number of distinct clients on each floor and in each building
+# is counted for every interval.
+#
+# The history is read in chunks in sourcetimestamp order. The last segment of each client is carried into the next
+# chunk until the client has not been seen for longer than the gap, and the counts of the last two intervals are
+# carried until a chunk has moved past them, so memory stays bounded by the chunk size and the number of clients.
+from argparse import ArgumentParser
+import logging
+import numpy as np
+import pandas as pd
+from convert_history import read_history_chunks, local_datetimes, format_datetimes
+from history_compression import open_history
+from history_store import timestamp_ms, get_timezone
+from constants import CONVERT_FILE_CHUNK_SIZE, DEFAULT_DWELL_RADIUS, DEFAULT_DWELL_GAP_SECONDS, \
+    DEFAULT_OCCUPANCY_MINUTES
+
+DWELL_COLUMNS = ["macaddress", "buildingid", "floorid", "coordinatex", "coordinatey", "sourcetimestamp"]
+SEGMENT_COLUMNS = ["macaddress", "buildingid", "floorid", "start", "end", "duration_seconds", "coordinatex",
+                   "coordinatey", "samples"]
+FLOOR_OCCUPANCY_COLUMNS = ["interval_start", "buildingid", "floorid", "devices"]
+BUILDING_OCCUPANCY_COLUMNS = ["interval_start", "buildingid", "devices"]
+# How the pieces of a segment are joined together
+SEGMENT_AGG = {"mac": "first", "building": "first", "floor": "first", "start": "min", "end": "max", "sum_x": "sum",
+               "sum_y": "sum", "samples": "sum", "first_x": "first", "first_y": "first", "last_x": "last",
+               "last_y": "last"}
+
+
+def read_pieces(df, timezone):
+    # Every located row as a segment of one sample, and the (interval independent) rows used for occupancy
+    ts = timestamp_ms(df["sourcetimestamp"], timezone)
+    x = pd.to_numeric(df["coordinatex"], errors="coerce")
+    y = pd.to_numeric(df["coordinatey"], errors="coerce")
+    on_floor = (df["floorid"] != "") & ts.notna()
+    located = on_floor & x.notna() & y.notna()
+    pieces = pd.DataFrame({"mac": df["macaddress"][located].to_numpy(),
+                           "building": df["buildingid"][located].to_numpy(),
+                           "floor": df["floorid"][located].to_numpy(),
+                           "start": ts[located].to_numpy(dtype="int64"),
+                           "end": ts[located].to_numpy(dtype="int64"),
+                           "sum_x": x[located].to_numpy(dtype="float64"),
+                           "sum_y": y[located].to_numpy(dtype="float64"),
+                           "samples": 1})
+    for (axis, values) in [("x", "sum_x"), ("y", "sum_y")]:
+        pieces[f"first_{axis}"] = pieces[values]
+        pieces[f"last_{axis}"] = pieces[values]
+    seen = pd.DataFrame({"ts": ts[on_floor].to_numpy(dtype="int64"),
+                         "building": df["buildingid"][on_floor].to_numpy(),
+                         "floor": df["floorid"][on_floor].to_numpy(),
+                         "mac": df["macaddress"][on_floor].to_numpy()})
+    return pieces, seen
+
+
+def merge_segments(pieces, radius, gap_ms):
+    # Join the pieces of each client in time order, starting a new segment when the client changes floor, moves more
+    # than radius from its last position or was not seen for longer than gap_ms
+    if len(pieces) == 0:
+        return pieces
+    pieces = pieces.sort_values(["mac", "start"], kind="stable", ignore_index=True)
+    previous = pieces.shift()
+    new_segment = (pieces["mac"] != previous["mac"]) | (pieces["floor"] != previous["floor"]) | \
+                  (pieces["start"] - previous["end"] > gap_ms) | \
+                  (np.hypot(pieces["first_x"] - previous["last_x"], pieces["first_y"] - previous["last_y"]) > radius)
+    return pieces.groupby(new_segment.cumsum()).agg(SEGMENT_AGG).reset_index(drop=True)
+
+
+def write_segments(segments, f, timezone):
+    segments = segments.sort_values("start", kind="stable")
+    df = pd.DataFrame({"macaddress": segments["mac"],
+                       "buildingid": segments["building"],
+                       "floorid": segments["floor"],
+                       "start": format_datetimes(local_datetimes(segments["start"], timezone)),
+                       "end": format_datetimes(local_datetimes(segments["end"], timezone)),
+                       "duration_seconds": (segments["end"] - segments["start"]) / 1000,
+                       "coordinatex": (segments["sum_x"] / segments["samples"]).round(2),
+                       "coordinatey": (segments["sum_y"] / segments["samples"]).round(2),
+                       "samples": segments["samples"]})
+    df.to_csv(f, header=False, index=False)
+
+
+def write_occupancy(seen, floor_f, building_f, timezone):
+    # Count the distinct clients of each interval on every floor and in every building. seen has one row per
+    # interval, floor and client.
+    if len(seen) == 0:
+        return
+    floors = seen.groupby(["interval", "building", "floor"], sort=True)["mac"].nunique().reset_index()
+    buildings = seen.groupby(["interval", "building"], sort=True)["mac"].nunique().reset_index()
+    for (counts, f, columns) in [(floors, floor_f, FLOOR_OCCUPANCY_COLUMNS),
+                                 (buildings, building_f, BUILDING_OCCUPANCY_COLUMNS)]:
+        counts.insert(0, "interval_start", format_datetimes(local_datetimes(counts.pop("interval"), timezone)))
+        counts.columns = columns
+        counts.to_csv(f, header=False, index=False)
+
+
+def dwell_history(data_file, dwell_file, floor_file, building_file, timezone, radius=DEFAULT_DWELL_RADIUS,
+                  gap_seconds=DEFAULT_DWELL_GAP_SECONDS, interval_minutes=DEFAULT_OCCUPANCY_MINUTES):
+    # Write the dwell segments of every client to dwell_file and the occupancy of every interval to floor_file and
+    # building_file. Returns the number of segments written.
+    gap_ms = int(gap_seconds * 1000)
+    interval_ms = int(interval_minutes * 60 * 1000)
+    open_segments = None
+    open_seen = None
+    latest_ms = None
+    done_before = None
+    total_rows = 0
+    total_segments = 0
+    late_rows = 0
+    try:
+        with open_history(data_file) as source, open_history(dwell_file, "wt") as dwell_f, \
+                open_history(floor_file, "wt") as floor_f, open_history(building_file, "wt") as building_f:
+            dwell_f.write(",".join(SEGMENT_COLUMNS) + "\n")
+            floor_f.write(",".join(FLOOR_OCCUPANCY_COLUMNS) + "\n")
+            building_f.write(",".join(BUILDING_OCCUPANCY_COLUMNS) + "\n")
+            for df in read_history_chunks(source, CONVERT_FILE_CHUNK_SIZE, usecols=DWELL_COLUMNS):
+                total_rows += len(df)
+                (pieces, seen) = read_pieces(df, timezone)
+                if len(seen) == 0:
+                    continue
+                latest_ms = max(latest_ms or 0, int(seen["ts"].max()))
+                segments = merge_segments(pd.concat([open_segments, pieces], ignore_index=True), radius, gap_ms)
+                # The last segment of a client stays open until the client has not been seen for longer than the gap
+                last = segments["mac"] != segments["mac"].shift(-1)
+                still_open = last & (segments["end"] >= latest_ms - gap_ms)
+                write_segments(segments[~still_open], dwell_f, timezone)
+                total_segments += int((~still_open).sum())
+                open_segments = segments[still_open]
+
+                seen["interval"] = seen.pop("ts") // interval_ms * interval_ms
+                if done_before is not None:
+                    # Intervals that have already been counted cannot take more clients
+                    late = seen["interval"] < done_before
+                    late_rows += int(late.sum())
+                    seen = seen[~late]
+                seen = pd.concat([open_seen, seen], ignore_index=True).drop_duplicates()
+                # Rows can be out of order by up to an interval, so only intervals before the last two are counted
+                done_before = (latest_ms // interval_ms - 1) * interval_ms
+                done = seen["interval"] < done_before
+                write_occupancy(seen[done], floor_f, building_f, timezone)
+                open_seen = seen[~done]
+                logging.info(f"Compacted {total_rows:,} rows into {total_segments:,} segments written to "
+                             f"{dwell_file}.")
+            if open_segments is not None:
+                write_segments(open_segments, dwell_f, timezone)
+                total_segments += len(open_segments)
+                write_occupancy(open_seen, floor_f, building_f, timezone)
+    except (pd.errors.EmptyDataError, ValueError) as e:
+        logging.error(f"Unable to read csv file {data_file}. Got error {e}.")
+        return 0
+    except IOError as e:
+        logging.error(f"Unable to write dwell and occupancy files. Got error {e}.")
+        return 0
+    if late_rows:
+        logging.error(f"{late_rows:,} rows were more than an interval out of sourcetimestamp order and were not "
+                      f"counted in the occupancy.")
+    logging.info(f"Wrote {total_segments:,} segments to {dwell_file} and occupancy to {floor_file} and "
+                 f"{building_file}.")
+    return total_segments
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(levelname)s:%(asctime)s:%(funcName)s():%(message)s',
+                        datefmt='%H:%M:%S',
+                        level=logging.INFO)
+    parser = ArgumentParser()
+    parser.add_argument("filename", help="Raw or converted history csv file in sourcetimestamp order.")
+    parser.add_argument("-o", "--output", dest="output", default="dwell.csv",
+                        help="Filename to write the dwell segments into.")
+    parser.add_argument("-fo", "--floor_output", dest="floor_output", default="floor-occupancy.csv",
+                        help="Filename to write the occupancy of each floor into.")
+    parser.add_argument("-bo", "--building_output", dest="building_output", default="building-occupancy.csv",
+                        help="Filename to write the occupancy of each building into.")
+    parser.add_argument("-tz", "--timezone", dest="timezone",
+                        help="Time zone database name e.g. Australia/Sydney of converted files and output times.")
+    parser.add_argument("-r", "--radius", dest="radius", type=float, default=DEFAULT_DWELL_RADIUS,
+                        help="Distance in the units of coordinatex and coordinatey a client can move between rows "
+                             "and still be dwelling.")
+    parser.add_argument("-g", "--gap", dest="gap", type=float, default=DEFAULT_DWELL_GAP_SECONDS,
+                        help="Seconds a client can go unseen before its dwell segment ends.")
+    parser.add_argument("-i", "--interval", dest="interval", type=float, default=DEFAULT_OCCUPANCY_MINUTES,
+                        help="Minutes in each occupancy interval.")
+    args = parser.parse_args()
+    dwell_history(args.filename, args.output, args.floor_output, args.building_output, get_timezone(args.timezone),
+                  args.radius, args.gap, args.interval)
@@ -0,0 +1,114 @@
+#
+# history_filter.py keeps only the rows and columns of the history that are wanted. Rows are rejected on their raw
+# bytes before they are parsed, with pandas only checking the lines that might match, and only the wanted columns are
+# read with usecols.
+import logging
+
+# Row filter option names and the column each of them matches
+ROW_FILTERS = {"floor": "floorid",
+               "building": "buildingid",
+               "ssid": "ssid",
+               "mac": "macaddress",
+               "device_type": "devicetype"}
+
+
+def add_filter_arguments(parser):
+    parser.add_argument("--columns", dest="columns", type=lambda value: value.split(","),
+                        help="Comma separated list of the columns to keep, e.g. macaddress,floorid,sourcetimestamp")
+    parser.add_argument("--floor", dest="floor", action="append", help="Only keep rows with this floorid.")
+    parser.add_argument("--building", dest="building", action="append",
+                        help="Only keep rows with this buildingid.")
+    parser.add_argument("--ssid", dest="ssid", action="append", help="Only keep rows with this SSID.")
+    parser.add_argument("--mac", dest="mac", action="append", help="Only keep rows with this MAC address.")
+    parser.add_argument("--device-type", dest="device_type", action="append",
+                        help="Only keep rows with this device type e.g. CLIENT.")
+
+
+def get_history_filter(args):
+    # Each row filter option can be given more than once to keep any of the values. Returns None without filters.
+    rows = {}
+    for (option, column) in ROW_FILTERS.items():
+        values = getattr(args, option, None)
+        if values:
+            rows[column] = set(value.lower() if option == "mac" else value for value in values)
+    if not rows and not args.columns:
+        return None
+    from convert_history import history_dict
+    unknown = [col for col in args.columns or [] if col not in history_dict]
+    if unknown:
+        logging.error(f"Columns {unknown} are not history columns and will not be in the output.")
+    logging.debug(f"Keeping columns {args.columns} and rows matching {rows}.")
+    return {"columns": args.columns, "rows": rows}
+
+
+def filter_columns(history_filter, columns):
+    # The columns that are written, in the order of the file
+    if history_filter is None or not history_filter["columns"]:
+        return list(columns)
+    return [col for col in columns if col in history_filter["columns"]]
+
+
+def use_columns(history_filter, convert_columns=()):
+    # usecols for pandas read_csv, reading only the wanted columns, the columns the row filters check and
+    # convert_columns, which the conversion needs before the columns that are not wanted are dropped
+    if history_filter is None or not history_filter["columns"]:
+        return None
+    wanted = set(history_filter["columns"]) | set(history_filter["rows"]) | set(convert_columns)
+    return lambda col: col in wanted
+
+
+def download_filters(history_filter, convert_columns):
+    # For a file converted after it is downloaded, the filter to download it with, which also keeps convert_columns,
+    # and the filter dropping them again when it is converted, or None if there is nothing to drop
+    if history_filter is None or not history_filter["columns"]:
+        return history_filter, None
+    extra = [col for col in convert_columns if col not in history_filter["columns"]]
+    if not extra:
+        return history_filter, None
+    return ({"columns": history_filter["columns"] + extra, "rows": history_filter["rows"]},
+            {"columns": history_filter["columns"], "rows": {}})
+
+
+def line_filter(history_filter):
+    # A function telling if a raw line might match, or None if every line is kept. A line has to contain one of the
+    # values of every row filter. The exact column match is left to filter_frame.
+    if history_filter is None or not history_filter["rows"]:
+        return None
+    needles = [[value.encode() for value in values] for values in history_filter["rows"].values()]
+    return lambda line: all(any(needle in line for needle in values) for values in needles)
+
+
+def filter_lines(history_filter, lines):
+    # Throw away the raw lines that cannot match before they are parsed
+    keep_line = line_filter(history_filter)
+    if keep_line is None:
+        return lines
+    return [line for line in lines if keep_line(line)]
+
+
+def filter_rows(df, history_filter):
+    # Keep the rows where every row filter column holds one of its values, with all of the columns that were read
+    if history_filter is None or not history_filter["rows"]:
+        return df
+    # pandas is only loaded when there are frames to filter so a raw download does not pay for it
+    import pandas as pd
+    keep = pd.Series(True, index=df.index)
+    for (column, values) in history_filter["rows"].items():
+        if column not in df.columns:
+            logging.error(f"Column {column} is not in the history. No rows can match.")
+            keep &= False
+            continue
+        keep &= df[column].astype(str).isin(values)
+    return df.loc[keep].copy()
+
+
+def select_columns(df, history_filter):
+    # Only the wanted columns, once the rows have been filtered and converted
+    if history_filter is None or not history_filter["columns"]:
+        return df
+    return df[filter_columns(history_filter, df.columns)]
+
+
+def filter_frame(df, history_filter):
+    # Keep the rows where every row filter column holds one of its values, then only the wanted columns
+    return select_columns(filter_rows(df, history_filter), history_filter)
@@ -0,0 +1,269 @@
+#
+# history_generator.py writes synthetic DNA Spaces client history with the history_dict columns for load testing. A
+# model of devices, floors and access points is built once so the cardinalities look like a real tenant: thousands of
+# MAC addresses that mostly stay on their home floor, tens of floors across buildings and campuses, zero firstactiveat
+# and changedon timestamps and quoted multi-value ipaddress fields.
+#
+# Rows are written in batches straight into a byte buffer with NumPy. Every field of a batch is a slice of a byte
+# table, either a table of the model or digits rendered for the batch, and the fields are copied into their place in
+# the CSV with one fancy-indexing pass per column instead of formatting each row in Python.
+#
+# python history_generator.py -o history.csv.gz -r 10000000 -st 2020-05-25T00:00+10:00 -et 2020-05-26T00:00+10:00
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+import logging
+from time import perf_counter
+import numpy as np
+from convert_history import history_dict
+from history_compression import open_history
+from get_date_range import convert_timestamp_millisecond
+from constants import DEFAULT_GENERATOR_DEVICES, DEFAULT_GENERATOR_FLOORS
+
+GENERATOR_BATCH_ROWS = 20000
+FLOORS_PER_BUILDING = 5
+BUILDINGS_PER_CAMPUS = 4
+ACCESS_POINTS_PER_FLOOR = 12
+FLOOR_WIDTH = 300.0
+FLOOR_DEPTH = 150.0
+HOME_FLOOR_SHARE = 0.9
+ZERO_FIRSTACTIVEAT_SHARE = 0.1
+ZERO_CHANGEDON_SHARE = 0.01
+MANUFACTURERS = ["Apple, Inc.", "Samsung Electronics Co.,Ltd", "Intel Corporate", "Rivet Networks", "Google, Inc.",
+                 "Microsoft Corporation", "Dell Inc.", "Hewlett Packard", "Cisco Systems, Inc", "Unknown", ""]
+SSIDS = ["Staff", "Guest", "IoT", "Test-WiFI"]
+CONTROLLERS = ["172.20.0.1", "172.20.0.2", "172.20.0.3"]
+
+
+def byte_table(values):
+    # A table of byte strings as one buffer with the start and length of each value. Values holding a comma or
+    # a quote are quoted as the API does.
+    encoded = []
+    for value in values:
+        value = value.encode() if isinstance(value, str) else value
+        if b"," in value or b'"' in value:
+            value = b'"' + value.replace(b'"', b'""') + b'"'
+        encoded.append(value)
+    lengths = np.array([len(value) for value in encoded], dtype="int64")
+    starts = np.cumsum(lengths) - lengths
+    return np.frombuffer(b"".join(encoded) or b" ", dtype=np.uint8), starts, lengths
+
+
+def table_field(table, index):
+    (buffer, starts, lengths) = table
+    return buffer, starts[index], lengths[index]
+
+
+def int_field(values, width=20):
+    # Render integers as decimal digits right aligned in a (rows, width) byte matrix
+    values = np.asarray(values, dtype="int64")
+    negative = values < 0
+    magnitude = np.abs(values)
+    digits = np.maximum(1, np.floor(np.log10(np.maximum(magnitude, 1))).astype("int64") + 1)
+    matrix = np.empty((len(values), width), dtype=np.uint8)
+    remaining = magnitude.copy()
+    for column in range(width - 1, -1, -1):
+        matrix[:, column] = 48 + remaining % 10
+        remaining //= 10
+    lengths = digits + negative
+    rows = np.arange(len(values))
+    matrix[rows[negative], width - lengths[negative]] = ord("-")
+    return matrix.ravel(), rows * width + width - lengths, lengths
+
+
+def decimal_field(values, decimals=4, width=12):
+    # Render non-negative numbers with a fixed number of decimals by rendering the scaled integer and moving the
+    # integer digits one place left to make room for the point
+    scaled = np.round(np.asarray(values, dtype="float64") * 10 ** decimals).astype("int64")
+    (buffer, starts, lengths) = int_field(scaled, width)
+    matrix = buffer.reshape(-1, width)
+    matrix[:, :-decimals - 1] = matrix[:, 1:-decimals]
+    matrix[:, -decimals - 1] = ord(".")
+    # At least one digit before the point
+    lengths = np.maximum(lengths, decimals + 1) + 1
+    return buffer, np.arange(len(scaled)) * width + width - lengths, lengths
+
+
+def blank(field, mask):
+    # Empty the field in the rows where mask is set
+    (buffer, starts, lengths) = field
+    return buffer, starts, np.where(mask, 0, lengths)
+
+
+def join_fields(fields):
+    # The CSV lines of a batch from one field per column. Every line ends in a newline.
+    lengths = np.stack([field[2] for field in fields])
+    line_lengths = lengths.sum(axis=0) + len(fields)
+    line_ends = np.cumsum(line_lengths)
+    out = np.full(line_ends[-1], ord(","), dtype=np.uint8)
+    out[line_ends - 1] = ord("\n")
+    positions = line_ends - line_lengths
+    for ((buffer, starts, _), field_lengths) in zip(fields, lengths):
+        width = int(field_lengths[0])
+        if (field_lengths == width).all():
+            # Fields of the same width, such as MAC addresses and timestamps, are copied as a (rows, width) block
+            within = np.arange(width)
+            out[positions[:, None] + within] = buffer[starts[:, None] + within]
+        else:
+            # The offset of every byte within its field, so each field is copied without a loop over rows
+            within = np.arange(int(field_lengths.sum())) - np.repeat(np.cumsum(field_lengths) - field_lengths,
+                                                                     field_lengths)
+            out[np.repeat(positions, field_lengths) + within] = buffer[np.repeat(starts, field_lengths) + within]
+        positions += field_lengths + 1
+    return out.tobytes()
+
+
+def mac_addresses(rng, count):
+    values = rng.choice(2 ** 40, count, replace=False) + (0x02 << 40)
+    return [":".join(f"{(value >> shift) & 0xff:02x}" for shift in range(40, -1, -8)) for value in values]
+
+
+def hex_ids(rng, count):
+    return [rng.bytes(16).hex() for _ in range(count)]
+
+
+def build_model(devices=DEFAULT_GENERATOR_DEVICES, floors=DEFAULT_GENERATOR_FLOORS, seed=0):
+    # Tables of the devices, floors and access points rows are drawn from, with the index of each device's home floor
+    rng = np.random.default_rng(seed)
+    buildings = -(-floors // FLOORS_PER_BUILDING)
+    campuses = -(-buildings // BUILDINGS_PER_CAMPUS)
+    floor_building = np.arange(floors) // FLOORS_PER_BUILDING
+    building_ids = hex_ids(rng, buildings)
+    campus_ids = hex_ids(rng, campuses)
+    access_points = floors * ACCESS_POINTS_PER_FLOOR
+    ipv4 = [f"10.{i >> 16 & 0xff}.{i >> 8 & 0xff}.{i & 0xff}" for i in rng.integers(0, 2 ** 24, devices)]
+    macs = mac_addresses(rng, devices)
+    ip_kind = rng.choice(3, devices, p=[0.2, 0.5, 0.3])
+    ipaddresses = ["" if kind == 0 else ip if kind == 1 else f"{ip}, fe80::{mac.replace(':', '')[-8:-4]}:"
+                   f"{mac.replace(':', '')[-4:]}" for (ip, mac, kind) in zip(ipv4, macs, ip_kind)]
+    usernames = [f"user{i}" if rng.random() < 0.4 else "" for i in range(devices)]
+    return {"devices": devices,
+            "floors": floors,
+            "macaddress": byte_table(macs),
+            "devicetype": byte_table(["CLIENT", "TAG"]),
+            "device_type": (rng.random(devices) < 0.03).astype("int64"),
+            "manufacturer": byte_table(MANUFACTURERS),
+            "device_manufacturer": rng.integers(0, len(MANUFACTURERS), devices),
+            "username": byte_table(usernames),
+            "ipaddress": byte_table(ipaddresses),
+            "home_floor": rng.integers(0, floors, devices),
+            "home_x": rng.uniform(0, FLOOR_WIDTH, devices),
+            "home_y": rng.uniform(0, FLOOR_DEPTH, devices),
+            "zero_firstactiveat": rng.random(devices) < ZERO_FIRSTACTIVEAT_SHARE,
+            "active_for": rng.integers(0, 8 * 3600000, devices),
+            "campusid": byte_table([campus_ids[b // BUILDINGS_PER_CAMPUS] for b in floor_building]),
+            "buildingid": byte_table([building_ids[b] for b in floor_building]),
+            "floorid": byte_table(hex_ids(rng, floors)),
+            "floorhierarchy": byte_table([f"Campus {b // BUILDINGS_PER_CAMPUS + 1}>Building {b + 1}>"
+                                          f"Level {f % FLOORS_PER_BUILDING + 1}"
+                                          for (f, b) in enumerate(floor_building)]),
+            "apmac": byte_table(mac_addresses(rng, access_points)),
+            "band": byte_table(["IEEE_802_11_B", "IEEE_802_11_A"]),
+            "controllers": byte_table(CONTROLLERS),
+            "ssid": byte_table(SSIDS),
+            "flags": byte_table(["false", "true", "0", "1"]),
+            "tenantid": byte_table(["16655"]),
+            "recordtype": byte_table(["CLIENT"]),
+            "computetype": byte_table(["RSSI", "FASTLOCATE"]),
+            "source": byte_table(["CMX", "MERAKI"])}
+
+
+def batch_fields(model, rng, timestamps):
+    # One field per history_dict column for the rows with these sourcetimestamps
+    n = len(timestamps)
+    device = rng.integers(0, model["devices"], n)
+    away = rng.random(n) >= HOME_FLOOR_SHARE
+    floor = np.where(away, rng.integers(0, model["floors"], n), model["home_floor"][device])
+    access_point = floor * ACCESS_POINTS_PER_FLOOR + rng.integers(0, ACCESS_POINTS_PER_FLOOR, n)
+    x = np.clip(model["home_x"][device] + rng.normal(0, 3, n), 0, FLOOR_WIDTH)
+    y = np.clip(model["home_y"][device] + rng.normal(0, 3, n), 0, FLOOR_DEPTH)
+    associated = rng.random(n) < 0.7
+    rssi = rng.integers(-90, -30, n)
+    firstactiveat = np.where(model["zero_firstactiveat"][device], 0, timestamps - model["active_for"][device])
+    changedon = np.where(rng.random(n) < ZERO_CHANGEDON_SHARE, 0, timestamps)
+    zeros = np.zeros(n, dtype="int64")
+    return {"tenantid": table_field(model["tenantid"], zeros),
+            "macaddress": table_field(model["macaddress"], device),
+            "devicetype": table_field(model["devicetype"], model["device_type"][device]),
+            "campusid": table_field(model["campusid"], floor),
+            "buildingid": table_field(model["buildingid"], floor),
+            "floorid": table_field(model["floorid"], floor),
+            "floorhierarchy": table_field(model["floorhierarchy"], floor),
+            "coordinatex": decimal_field(x),
+            "coordinatey": decimal_field(y),
+            "sourcetimestamp": int_field(timestamps, 13),
+            "maxdetectedapmac": table_field(model["apmac"], access_point),
+            "maxdetectedband": table_field(model["band"], rng.integers(0, 2, n)),
+            "detectingcontrollers": table_field(model["controllers"], floor % len(CONTROLLERS)),
+            "firstactiveat": int_field(firstactiveat, 13),
+            "locatedsinceactivecount": int_field(rng.integers(0, 5000, n), 4),
+            "changedon": int_field(changedon, 13),
+            "manufacturer": table_field(model["manufacturer"], model["device_manufacturer"][device]),
+            "associated": table_field(model["flags"], associated.astype("int64")),
+            "maxdetectedrssi": int_field(rssi, 3),
+            "ssid": blank(table_field(model["ssid"], floor % len(SSIDS)), ~associated),
+            "username": table_field(model["username"], device),
+            "associatedapmac": blank(table_field(model["apmac"], access_point), ~associated),
+            "associatedaprssi": blank(int_field(rssi, 3), ~associated),
+            "maxdetectedslot": table_field(model["flags"], rng.integers(2, 4, n)),
+            "ipaddress": table_field(model["ipaddress"], device),
+            "staticdevice": table_field(model["flags"], (rng.random(n) < 0.02).astype("int64")),
+            "recordtype": table_field(model["recordtype"], zeros),
+            "computetype": table_field(model["computetype"], rng.integers(0, 2, n)),
+            "source": table_field(model["source"], zeros),
+            "machashed": table_field(model["flags"], zeros)}
+
+
+def generate_batches(start_ms, end_ms, rows, model, seed=0, columns=None, batch_rows=GENERATOR_BATCH_ROWS):
+    # CSV bytes of rows history records spread over the window in sourcetimestamp order, header first. The same
+    # window, model and seed always give the same bytes.
+    columns = list(history_dict) if columns is None else columns
+    rng = np.random.default_rng([seed, start_ms])
+    yield (",".join(columns) + "\n").encode()
+    timestamps = np.sort(rng.integers(start_ms, max(end_ms, start_ms + 1), rows))
+    for first in range(0, rows, batch_rows):
+        fields = batch_fields(model, rng, timestamps[first:first + batch_rows])
+        yield join_fields([fields[col] for col in columns])
+
+
+def write_history(filename, start_ms, end_ms, rows, model, seed=0, compression_level=None):
+    # Write the generated history to filename, compressed by its extension. Returns the bytes written before
+    # compression.
+    written = 0
+    started = perf_counter()
+    try:
+        with open_history(filename, "wb", compression_level) as f:
+            for block in generate_batches(start_ms, end_ms, rows, model, seed):
+                f.write(block)
+                written += len(block)
+    except IOError as e:
+        logging.error(f"Unable to write generated history {filename}. Got error {e}.")
+        return 0
+    seconds = perf_counter() - started
+    logging.info(f"Wrote {rows:,} rows and {written / 1024 ** 2:,.0f}MB to {filename} in {seconds:.1f} seconds.")
+    return written
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(levelname)s:%(asctime)s:%(funcName)s():%(message)s',
+                        datefmt='%H:%M:%S',
+                        level=logging.INFO)
+    parser = ArgumentParser()
+    parser.add_argument("-o", "--output", dest="output", default="synthetic-history.csv",
+                        help="Filename to write the history into. Ending in .gz or .zst compresses it.")
+    parser.add_argument("-r", "--rows", dest="rows", type=int, default=1000000, help="Number of rows to write.")
+    parser.add_argument("-st", "--start_time", dest="start_time", type=datetime.fromisoformat,
+                        help="Start time ISO format [YYY-MM-DDThh:mm:ss.s+TZD]. Defaults to a day before the end.")
+    parser.add_argument("-et", "--end_time", dest="end_time", type=datetime.fromisoformat,
+                        help="End time ISO format [YYY-MM-DDThh:mm:ss.s+TZD]. Defaults to now.")
+    parser.add_argument("-d", "--devices", dest="devices", type=int, default=DEFAULT_GENERATOR_DEVICES,
+                        help="Number of distinct MAC addresses.")
+    parser.add_argument("-fl", "--floors", dest="floors", type=int, default=DEFAULT_GENERATOR_FLOORS,
+                        help="Number of floors.")
+    parser.add_argument("-s", "--seed", dest="seed", type=int, default=0, help="Seed of the random numbers.")
+    parser.add_argument("-cl", "--compression_level", dest="compression_level", type=int,
+                        help="Compression level when the filename ends in .gz (default 6) or .zst (default 3).")
+    args = parser.parse_args()
+    end_time = args.end_time or datetime.now().astimezone()
+    start_time = args.start_time or end_time - timedelta(days=1)
+    write_history(args.output, convert_timestamp_millisecond(start_time), convert_timestamp_millisecond(end_time),
+                  args.rows, build_model(args.devices, args.floors, args.seed), args.seed, args.compression_level)
@@ -0,0 +1,120 @@
+#
+# history_manifest.py keeps a JSON manifest next to the history output file recording what was fetched for each time
+# window. A window that is not complete can then be fetched again with --resume without downloading the whole range.
+import csv
+import json
+import logging
+from datetime import datetime
+from os import path, replace
+from get_date_range import convert_timestamp_millisecond
+
+PENDING = "pending"
+COMPLETE = "complete"
+INCOMPLETE = "incomplete"
+FAILED = "failed"
+
+
+def get_manifest_filename(write_file):
+    return write_file + ".manifest.json"
+
+
+def new_window(start, end):
+    return {"start": start.isoformat(),
+            "end": end.isoformat(),
+            "start_ms": convert_timestamp_millisecond(start),
+            "end_ms": convert_timestamp_millisecond(end),
+            "status": PENDING,
+            "offset": 0,
+            "bytes": 0,
+            "rows": 0,
+            "duplicates": 0,
+            "last_sourcetimestamp": None}
+
+
+def new_manifest(time_tuples_list):
+    return {"header": "",
+            "converted": False,
+            "windows": [new_window(start, end) for (start, end) in time_tuples_list]}
+
+
+def mark_converted(write_file):
+    # The byte offsets of the windows no longer match once the whole file has been rewritten by convert_history
+    manifest = load_manifest(write_file)
+    if manifest is not None:
+        manifest["converted"] = True
+        save_manifest(manifest, write_file)
+
+
+def all_windows_complete(write_file):
+    # A file without a manifest has nothing left to fetch as far as anyone knows
+    manifest = load_manifest(write_file)
+    return manifest is None or len(windows_to_fetch(manifest)) == 0
+
+
+def window_times(window):
+    return datetime.fromisoformat(window["start"]), datetime.fromisoformat(window["end"])
+
+
+def load_manifest(write_file):
+    manifest_file = get_manifest_filename(write_file)
+    if not path.isfile(manifest_file):
+        logging.debug(f"No manifest {manifest_file} found.")
+        return None
+    try:
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError) as e:
+        logging.error(f"Unable to read manifest {manifest_file}. Got error {e}.")
+        return None
+    logging.debug(f"Loaded manifest {manifest_file} with {len(manifest['windows'])} windows.")
+    return manifest
+
+
+def save_manifest(manifest, write_file):
+    # Write to a temporary file first so a crash never leaves a half written manifest
+    manifest_file = get_manifest_filename(write_file)
+    tmp_manifest_file = manifest_file + ".tmp"
+    try:
+        with open(tmp_manifest_file, "w") as f:
+            json.dump(manifest, f, indent=2)
+        replace(tmp_manifest_file, manifest_file)
+    except IOError as e:
+        logging.error(f"Unable to write manifest {manifest_file}. Got error {e}.")
+
+
+def last_sourcetimestamp(header, last_line):
+    # Pull the sourcetimestamp field out of the last data line received for a window
+    if not header or not last_line:
+        return None
+    columns = header.split(",")
+    if "sourcetimestamp" not in columns:
+        return None
+    try:
+        fields = next(csv.reader([last_line]))
+        return fields[columns.index("sourcetimestamp")]
+    except (csv.Error, IndexError, StopIteration):
+        return None
+
+
+def record_window(manifest, window, stats, status):
+    if stats["header"] and not manifest["header"]:
+        manifest["header"] = stats["header"]
+    window["status"] = status
+    window["bytes"] = stats["bytes"]
+    window["rows"] = max(stats["lines"] - 1, 0)
+    window["duplicates"] = stats.get("duplicates", 0)
+    # The last line is as received, which may have more columns than the header written when filtering
+    window["last_sourcetimestamp"] = last_sourcetimestamp(stats.get("source_header", manifest["header"]),
+                                                          stats["last_line"])
+
+
+def replace_windows(manifest, windows, time_tuples_list):
+    # Swap a contiguous run of windows in the manifest for new windows covering the same time range
+    index = next(i for (i, window) in enumerate(manifest["windows"]) if window is windows[0])
+    new_windows = [new_window(start, end) for (start, end) in time_tuples_list]
+    manifest["windows"][index:index + len(windows)] = new_windows
+    return new_windows
+
+
+def windows_to_fetch(manifest):
+    return [window for window in manifest["windows"] if window["status"] != COMPLETE]
@@ -0,0 +1,37 @@
+#
+# history_memory.py turns a memory budget such as 512MB into bytes and reports the peak resident set size of the
+# process, so the rows of each chunk can be sized to the budget and memory use can be seen in the logs.
+import re
+import sys
+from argparse import ArgumentTypeError
+from time import perf_counter
+
+SIZE_UNITS = {"": 1, "B": 1, "K": 1024, "KB": 1024, "M": 1024 ** 2, "MB": 1024 ** 2, "G": 1024 ** 3,
+              "GB": 1024 ** 3}
+
+
+def parse_size(value):
+    # Bytes from a size with an optional K, M or G unit e.g. 512MB. Used as an argparse type.
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMG]?B?)\s*", value.upper())
+    if match is None or float(match.group(1)) <= 0:
+        raise ArgumentTypeError(f"{value} is not a size such as 512MB or 2GB.")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+def peak_rss_bytes():
+    # Peak resident set size of this process, or None where the resource module is not available e.g. Windows
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def progress(rows, started):
+    # Rows per second since started, a perf_counter time, and the peak RSS to add to a log line
+    elapsed = perf_counter() - started
+    rate = f"{rows / elapsed:,.0f} rows/s" if elapsed > 0 else "- rows/s"
+    peak = peak_rss_bytes()
+    return rate if peak is None else f"{rate}, peak RSS {peak / 1024 ** 2:,.0f}MB"
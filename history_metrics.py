@@ -0,0 +1,166 @@
+#
+# history_metrics.py collects what every time window fetch and conversion chunk of a run cost: time to first byte,
+# duration, bytes, rows, retries and timeout escalations for windows and rows a second for chunks. At the end of a run
+# the metrics are written as a JSON report and as a Prometheus textfile collector file for the node exporter.
+import json
+import logging
+import threading
+from datetime import datetime, timezone
+from os import replace
+from time import time
+from history_manifest import window_times
+
+METRIC_PREFIX = "dnaspaces_history"
+TTFB_QUANTILES = [0.5, 0.9, 0.99]
+
+
+def escape_label(value):
+    # Label values escape backslash, double quote and line feed in the Prometheus exposition format
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class RunMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time()
+            self.windows = []
+            self.chunks = []
+
+    def record_window(self, tenant, window, stats):
+        (start, end) = window_times(window)
+        record = {"tenant": tenant,
+                  "start": start.isoformat(),
+                  "end": end.isoformat(),
+                  "status_code": stats["status_code"],
+                  "complete": stats["status_code"] == 200 and stats["complete"],
+                  "ttfb_seconds": stats.get("ttfb"),
+                  "seconds": stats["elapsed"],
+                  "bytes": stats["bytes"],
+                  "rows": max(stats["lines"] - 1, 0),
+                  "duplicates": stats.get("duplicates", 0),
+                  "retries": stats.get("retries", 0),
+                  "timeout_escalations": stats.get("timeout_escalations", 0)}
+        with self.lock:
+            self.windows.append(record)
+
+    def record_chunk(self, filename, rows, seconds):
+        with self.lock:
+            self.chunks.append({"filename": filename, "rows": rows, "seconds": seconds,
+                                "rows_per_second": rows / seconds if seconds > 0 else None})
+
+    def totals(self):
+        # Totals of the run per tenant and for the conversion
+        duration = time() - self.started
+        tenants = {}
+        for window in self.windows:
+            totals = tenants.setdefault(window["tenant"], {"windows": 0, "failed_windows": 0, "bytes": 0, "rows": 0,
+                                                           "duplicates": 0, "seconds": 0.0, "retries": 0,
+                                                           "timeout_escalations": 0, "ttfb_seconds": []})
+            totals["windows"] += 1
+            totals["failed_windows"] += not window["complete"]
+            for key in ["bytes", "rows", "duplicates", "seconds", "retries", "timeout_escalations"]:
+                totals[key] += window[key]
+            if window["ttfb_seconds"] is not None:
+                totals["ttfb_seconds"].append(window["ttfb_seconds"])
+        for totals in tenants.values():
+            # Windows are fetched concurrently so throughput is over the whole run rather than the summed durations
+            totals["rows_per_second"] = totals["rows"] / duration if duration > 0 else None
+            totals["ttfb_seconds"] = sorted(totals["ttfb_seconds"])
+        convert_rows = sum(chunk["rows"] for chunk in self.chunks)
+        convert_seconds = sum(chunk["seconds"] for chunk in self.chunks)
+        return {"duration_seconds": duration,
+                "tenants": tenants,
+                "convert": {"chunks": len(self.chunks), "rows": convert_rows, "seconds": convert_seconds,
+                            "rows_per_second": convert_rows / convert_seconds if convert_seconds > 0 else None}}
+
+    def report(self):
+        with self.lock:
+            totals = self.totals()
+            return {"started": datetime.fromtimestamp(self.started, timezone.utc).isoformat(),
+                    "finished": datetime.now(timezone.utc).isoformat(),
+                    "duration_seconds": totals["duration_seconds"],
+                    "tenants": {tenant: {key: value for (key, value) in tenant_totals.items()
+                                         if key != "ttfb_seconds"}
+                                for (tenant, tenant_totals) in totals["tenants"].items()},
+                    "convert": totals["convert"],
+                    "windows": list(self.windows),
+                    "convert_chunks": list(self.chunks)}
+
+    def prometheus_lines(self):
+        with self.lock:
+            totals = self.totals()
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} {metric_type}")
+            for (labels, value) in samples:
+                label_text = ",".join(f'{key}="{escape_label(label)}"' for (key, label) in labels.items())
+                lines.append(f"{METRIC_PREFIX}_{name}{{{label_text}}} {value}" if label_text else
+                             f"{METRIC_PREFIX}_{name} {value}")
+
+        tenants = totals["tenants"]
+        for (name, key, help_text) in [("windows", "windows", "Time windows fetched in the last run."),
+                                       ("failed_windows", "failed_windows", "Time windows that did not complete."),
+                                       ("fetch_bytes", "bytes", "Bytes fetched in the last run."),
+                                       ("fetch_rows", "rows", "Rows fetched in the last run."),
+                                       ("fetch_duplicates", "duplicates", "Repeated rows dropped in the last run."),
+                                       ("fetch_seconds", "seconds", "Seconds spent fetching windows in the last run."),
+                                       ("fetch_retries", "retries", "Requests retried in the last run."),
+                                       ("fetch_timeout_escalations", "timeout_escalations",
+                                        "Times the request timeout was increased in the last run.")]:
+            metric(name, "gauge", help_text, [({"tenant": tenant}, tenant_totals[key])
+                                              for (tenant, tenant_totals) in tenants.items()])
+        metric("fetch_rows_per_second", "gauge", "Rows fetched a second over the last run.",
+               [({"tenant": tenant}, tenant_totals["rows_per_second"] or 0)
+                for (tenant, tenant_totals) in tenants.items()])
+        ttfb_samples = []
+        for (tenant, tenant_totals) in tenants.items():
+            ttfb = tenant_totals["ttfb_seconds"]
+            for quantile in TTFB_QUANTILES if ttfb else []:
+                ttfb_samples.append(({"tenant": tenant, "quantile": str(quantile)},
+                                     ttfb[min(int(quantile * len(ttfb)), len(ttfb) - 1)]))
+        metric("ttfb_seconds", "summary", "Seconds until the response of a time window arrived.", ttfb_samples)
+        for (tenant, tenant_totals) in tenants.items():
+            ttfb = tenant_totals["ttfb_seconds"]
+            lines.append(f'{METRIC_PREFIX}_ttfb_seconds_sum{{tenant="{escape_label(tenant)}"}} {sum(ttfb)}')
+            lines.append(f'{METRIC_PREFIX}_ttfb_seconds_count{{tenant="{escape_label(tenant)}"}} {len(ttfb)}')
+        convert = totals["convert"]
+        metric("convert_rows", "gauge", "Rows converted in the last run.", [({}, convert["rows"])])
+        metric("convert_seconds", "gauge", "Seconds spent converting in the last run.", [({}, convert["seconds"])])
+        metric("convert_rows_per_second", "gauge", "Rows converted a second in the last run.",
+               [({}, convert["rows_per_second"] or 0)])
+        metric("run_duration_seconds", "gauge", "Seconds the last run took.", [({}, totals["duration_seconds"])])
+        metric("last_run_timestamp_seconds", "gauge", "Unix time the last run finished.", [({}, time())])
+        return lines
+
+    def write_report(self, report_file):
+        try:
+            with open(report_file, "w") as f:
+                json.dump(self.report(), f, indent=2)
+        except IOError as e:
+            logging.error(f"Unable to write metrics report {report_file}. Got error {e}.")
+            return False
+        logging.info(f"Wrote metrics report to {report_file}.")
+        return True
+
+    def write_prometheus(self, textfile):
+        # The node exporter may read the file at any time so it is written to a temporary file and renamed
+        tmp_textfile = textfile + ".tmp"
+        try:
+            with open(tmp_textfile, "w") as f:
+                f.write("\n".join(self.prometheus_lines()) + "\n")
+            replace(tmp_textfile, textfile)
+        except IOError as e:
+            logging.error(f"Unable to write Prometheus textfile {textfile}. Got error {e}.")
+            return False
+        logging.info(f"Wrote Prometheus metrics to {textfile}.")
+        return True
+
+
+# The metrics of the current run, shared by the fetch threads and the conversion
+run_metrics = RunMetrics()
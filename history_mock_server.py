@@ -0,0 +1,145 @@
+#
+# history_mock_server.py is a local stand-in for the DNA Spaces /api/location/v1/history endpoint. It streams
+# synthetic history for the requested time window with chunked transfer encoding, optionally limited to a number of
+# bytes a second, delayed before the first byte or failed with a 503 for a share of requests. The same window always
+# gets the same rows so runs can be compared.
+#
+# python history_mock_server.py -rh 1000000 -p 8080
+# DNASPACES_URL=http://127.0.0.1:8080/api/location/v1/history TOKEN=x python dnaspaces_get_history.py -nc
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from time import sleep, monotonic
+import logging
+import random
+import threading
+from history_generator import build_model, generate_batches
+from constants import DEFAULT_GENERATOR_DEVICES, DEFAULT_GENERATOR_FLOORS
+
+HISTORY_PATH = "/api/location/v1/history"
+
+
+class MockHistoryServer:
+    def __init__(self, rows_per_hour, rate=None, latency=0.0, error_rate=0.0, host="127.0.0.1", port=0, seed=0,
+                 devices=DEFAULT_GENERATOR_DEVICES, floors=DEFAULT_GENERATOR_FLOORS):
+        # rate is the most bytes a second each response is sent at, latency the seconds before the first byte and
+        # error_rate the share of requests answered with a 503
+        self.rows_per_hour = rows_per_hour
+        self.model = build_model(devices, floors, seed)
+        self.rate = rate
+        self.latency = latency
+        self.error_rate = error_rate
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self.handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        (host, port) = self.server.server_address[:2]
+        return f"http://{host}:{port}{HISTORY_PATH}"
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        logging.info(f"Mock history server listening on {self.url}.")
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def inject_error(self):
+        with self.lock:
+            self.requests += 1
+            if self.random.random() < self.error_rate:
+                self.errors += 1
+                return True
+            return False
+
+    def handler(self):
+        mock = self
+
+        class HistoryHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                logging.debug(f"Mock history server {self.address_string()} {format % args}")
+
+            def send_empty(self, status, headers=None):
+                self.send_response(status)
+                for (name, value) in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = parse_qs(url.query)
+                if url.path != HISTORY_PATH:
+                    return self.send_empty(404)
+                if not self.headers.get("Authorization", "").startswith("Bearer "):
+                    return self.send_empty(401)
+                try:
+                    (start_ms, end_ms) = (int(params["startTime"][0]), int(params["endTime"][0]))
+                except (KeyError, ValueError):
+                    return self.send_empty(400)
+                if mock.inject_error():
+                    return self.send_empty(503, {"Retry-After": "0"})
+                sleep(mock.latency)
+                rows = int(round(mock.rows_per_hour * max(end_ms - start_ms, 0) / 3600000))
+                self.send_response(200)
+                self.send_header("Content-Type", "text/csv")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                started = monotonic()
+                sent = 0
+                try:
+                    for block in generate_batches(start_ms, end_ms, rows, mock.model, mock.seed):
+                        self.wfile.write(f"{len(block):x}\r\n".encode() + block + b"\r\n")
+                        sent += len(block)
+                        if mock.rate:
+                            # Hold each response to the rate by waiting until the bytes sent are due
+                            sleep(max(0.0, sent / mock.rate - (monotonic() - started)))
+                    self.wfile.write(b"0\r\n\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    logging.debug("Mock history server client went away.")
+
+        return HistoryHandler
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(levelname)s:%(asctime)s:%(funcName)s():%(message)s',
+                        datefmt='%H:%M:%S',
+                        level=logging.INFO)
+    parser = ArgumentParser()
+    parser.add_argument("-rh", "--rows_per_hour", dest="rows_per_hour", type=float, default=100000,
+                        help="Rows of history served for each hour of a time window.")
+    parser.add_argument("-rt", "--rate", dest="rate", type=float,
+                        help="Most bytes a second to send each response at. Unlimited if not given.")
+    parser.add_argument("-l", "--latency", dest="latency", type=float, default=0.0,
+                        help="Seconds to wait before the first byte of each response.")
+    parser.add_argument("-e", "--error_rate", dest="error_rate", type=float, default=0.0,
+                        help="Share of requests from 0 to 1 answered with a 503.")
+    parser.add_argument("-p", "--port", dest="port", type=int, default=8080, help="Port to listen on.")
+    parser.add_argument("-d", "--devices", dest="devices", type=int, default=DEFAULT_GENERATOR_DEVICES,
+                        help="Number of distinct MAC addresses.")
+    parser.add_argument("-fl", "--floors", dest="floors", type=int, default=DEFAULT_GENERATOR_FLOORS,
+                        help="Number of floors.")
+    args = parser.parse_args()
+    server = MockHistoryServer(args.rows_per_hour, args.rate, args.latency, args.error_rate, port=args.port,
+                               devices=args.devices, floors=args.floors)
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        server.server.server_close()
@@ -0,0 +1,211 @@
+#
+# history_store.py loads history csv files into a local SQLite database indexed on macaddress, username, floorid and
+# sourcetimestamp so contact tracing questions are answered from the indexes instead of scanning the whole file.
+#
+# python history_store.py ingest client-history.csv -db history.db -tz Australia/Sydney
+# python history_store.py where 9c:ff:d0:aa:50:ff -db history.db -st 2020-05-25 -et 2020-05-26
+# python history_store.py contacts 9c:ff:d0:aa:50:ff -db history.db -st 2020-05-25 -et 2020-05-26 -m 15
+from argparse import ArgumentParser
+from datetime import datetime
+import csv
+import logging
+import os
+import sqlite3
+import sys
+import pandas as pd
+from tzlocal import get_localzone
+import pytz
+from get_date_range import convert_timestamp_millisecond
+from history_compression import open_history
+from constants import CONVERT_FILE_CHUNK_SIZE, DEFAULT_STORE_FILENAME, DEFAULT_CONTACT_MINUTES
+
+INDEX_COLUMNS = ["macaddress", "username", "floorid"]
+LOCATION_COLUMNS = ["sourcetimestamp", "macaddress", "username", "campusid", "buildingid", "floorid",
+                    "floorhierarchy", "coordinatex", "coordinatey"]
+
+
+def open_store(db_file):
+    conn = sqlite3.connect(db_file)
+    # Every row keeps the id of the file it was loaded from so loading the file again replaces its rows
+    conn.execute("CREATE TABLE IF NOT EXISTS history (ts_ms INTEGER, file_id INTEGER)")
+    conn.execute("CREATE TABLE IF NOT EXISTS ingested (id INTEGER PRIMARY KEY, filename TEXT UNIQUE, size INTEGER, "
+                 "mtime REAL, rows INTEGER)")
+    conn.execute("CREATE INDEX IF NOT EXISTS history_file_id ON history (file_id)")
+    return conn
+
+
+def store_columns(conn):
+    return [row[1] for row in conn.execute("PRAGMA table_info(history)")]
+
+
+def add_columns(conn, columns):
+    # Files written with different options have different columns, so the table grows to hold all of them
+    existing = store_columns(conn)
+    for col in columns:
+        if col not in existing:
+            conn.execute(f'ALTER TABLE history ADD COLUMN "{col}" TEXT')
+    for col in INDEX_COLUMNS:
+        if col in columns:
+            conn.execute(f'CREATE INDEX IF NOT EXISTS history_{col} ON history ("{col}", ts_ms)')
+    conn.execute("CREATE INDEX IF NOT EXISTS history_ts_ms ON history (ts_ms)")
+
+
+def timestamp_ms(col, timezone):
+    # Epoch milliseconds from a raw file or the local date time strings written by convert_history. Local times
+    # that happen twice when daylight saving ends are taken as standard time.
+    if col[col != ""].str.fullmatch(r"\d+").all():
+        return pd.to_numeric(col, errors="coerce")
+    local = pd.to_datetime(col, format="%Y-%m-%d %H:%M:%S", errors="coerce")
+    local = local.dt.tz_localize(str(timezone), ambiguous=False, nonexistent="shift_forward")
+    return (local.dt.tz_convert("UTC").dt.tz_localize(None) - pd.Timestamp(0)) // pd.Timedelta(milliseconds=1)
+
+
+def ingest_history(data_file, db_file, timezone, force=False):
+    # Load a raw or converted history csv into the store in chunks. A file that has already been loaded and has not
+    # changed since is skipped unless force is set. Loading a file again replaces the rows it loaded before in the same
+    # transaction. Returns the number of rows loaded.
+    try:
+        stat = os.stat(data_file)
+    except OSError as e:
+        logging.error(f"Unable to open csv file {data_file} to ingest. Got error {e}.")
+        return 0
+    conn = open_store(db_file)
+    rows = 0
+    try:
+        filename = os.path.abspath(data_file)
+        ingested = conn.execute("SELECT size, mtime FROM ingested WHERE filename = ?", (filename,)).fetchone()
+        if ingested == (stat.st_size, stat.st_mtime) and not force:
+            logging.info(f"File {data_file} has already been loaded into {db_file}.")
+            return 0
+        with conn, open_history(data_file) as f:
+            conn.execute("INSERT OR IGNORE INTO ingested (filename) VALUES (?)", (filename,))
+            (file_id,) = conn.execute("SELECT id FROM ingested WHERE filename = ?", (filename,)).fetchone()
+            replaced = conn.execute("DELETE FROM history WHERE file_id = ?", (file_id,)).rowcount
+            if replaced > 0:
+                logging.info(f"Replacing the {replaced:,} rows loaded from {data_file} before.")
+            for df in pd.read_csv(f, chunksize=CONVERT_FILE_CHUNK_SIZE, dtype=str, keep_default_na=False):
+                # Drop the row index column convert_history writes
+                df = df.loc[:, [col for col in df.columns if not col.startswith("Unnamed:")]]
+                if "sourcetimestamp" not in df.columns:
+                    logging.error(f"File {data_file} has no sourcetimestamp column.")
+                    conn.rollback()
+                    return 0
+                ts_ms = timestamp_ms(df["sourcetimestamp"], timezone).astype("Int64")
+                df.insert(0, "ts_ms", ts_ms.astype(object).where(ts_ms.notna(), None))
+                df.insert(1, "file_id", file_id)
+                add_columns(conn, df.columns)
+                columns = ", ".join(f'"{col}"' for col in df.columns)
+                values = ", ".join("?" for _ in df.columns)
+                conn.executemany(f"INSERT INTO history ({columns}) VALUES ({values})",
+                                 df.itertuples(index=False, name=None))
+                rows += len(df)
+                logging.info(f"Loaded {rows:,} rows of {data_file} into {db_file}.")
+            conn.execute("UPDATE ingested SET size = ?, mtime = ?, rows = ? WHERE id = ?",
+                         (stat.st_size, stat.st_mtime, rows, file_id))
+    except pd.errors.EmptyDataError as e:
+        logging.error(f"Unable to open csv file {data_file} to ingest. Got error {e}.")
+    except sqlite3.Error as e:
+        logging.error(f"Unable to load {data_file} into {db_file}. Got error {e}.")
+        rows = 0
+    finally:
+        conn.close()
+    return rows
+
+
+def time_range_ms(start, end, timezone):
+    # Query times without a time zone are local times of timezone
+    (start, end) = [t if t.tzinfo is not None else pytz.timezone(str(timezone)).localize(t) for t in (start, end)]
+    return convert_timestamp_millisecond(start), convert_timestamp_millisecond(end)
+
+
+def client_column(client):
+    # A client is looked up by MAC address when it looks like one, otherwise by username
+    return "macaddress" if client.count(":") == 5 else "username"
+
+
+def where_was(conn, client, start_ms, end_ms):
+    # Every location of the client between start_ms and end_ms in time order
+    columns = [col for col in LOCATION_COLUMNS if col in store_columns(conn)]
+    if client_column(client) not in columns:
+        return columns, []
+    cursor = conn.execute(f'SELECT {", ".join(columns)} FROM history '
+                          f'WHERE "{client_column(client)}" = ? AND ts_ms BETWEEN ? AND ? ORDER BY ts_ms',
+                          (client, start_ms, end_ms))
+    return columns, cursor.fetchall()
+
+
+def shared_floor(conn, client, start_ms, end_ms, minutes):
+    # Every other client seen on the same floor within minutes of the client between start_ms and end_ms, with the
+    # first and last time they were seen near each other
+    window_ms = minutes * 60 * 1000
+    column = client_column(client)
+    columns = ["macaddress", "username", "floorid", "floorhierarchy", "first_seen", "last_seen", "sightings"]
+    if not set(columns[:4]).issubset(store_columns(conn)):
+        return columns, []
+    cursor = conn.execute(f'SELECT o.macaddress, o.username, o.floorid, o.floorhierarchy, '
+                          f'MIN(o.sourcetimestamp), MAX(o.sourcetimestamp), COUNT(DISTINCT o.rowid) '
+                          f'FROM history x JOIN history o ON o.floorid = x.floorid '
+                          f'AND o.ts_ms BETWEEN x.ts_ms - ? AND x.ts_ms + ? '
+                          f'WHERE x."{column}" = ? AND x.ts_ms BETWEEN ? AND ? AND x.floorid != \'\' '
+                          f'AND o."{column}" != x."{column}" '
+                          f'GROUP BY o.macaddress, o.floorid ORDER BY MIN(o.ts_ms)',
+                          (window_ms, window_ms, client, start_ms, end_ms))
+    return columns, cursor.fetchall()
+
+
+def write_rows(columns, rows, f=sys.stdout):
+    writer = csv.writer(f)
+    writer.writerow(columns)
+    writer.writerows(rows)
+
+
+def get_timezone(timezone):
+    if timezone is None:
+        tz = get_localzone()
+        logging.debug(f"Using local timezone {tz}")
+    elif timezone not in pytz.all_timezones:
+        tz = get_localzone()
+        logging.error(f"Timezone {timezone} is not valid. Using local timezone {tz}")
+    else:
+        tz = timezone
+    return tz
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(levelname)s:%(asctime)s:%(funcName)s():%(message)s',
+                        datefmt='%H:%M:%S',
+                        level=logging.INFO)
+    parser = ArgumentParser()
+    parser.add_argument("-db", "--database", dest="database", default=DEFAULT_STORE_FILENAME,
+                        help="SQLite database file of the history store.")
+    parser.add_argument("-tz", "--timezone", dest="timezone",
+                        help="Time zone database name e.g. Australia/Sydney of converted files and query times.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    ingest = commands.add_parser("ingest", help="Load history csv files into the store.")
+    ingest.add_argument("filenames", nargs="+", help="Raw or converted history csv files.")
+    ingest.add_argument("--force", dest="force", default=False, action='store_true',
+                        help="Load files again even if they have not changed since they were loaded.")
+    for (command, help_text) in [("where", "Where a MAC address or username was between two times."),
+                                 ("contacts", "Who shared a floor with a MAC address or username.")]:
+        query = commands.add_parser(command, help=help_text)
+        query.add_argument("client", help="MAC address or username.")
+        query.add_argument("-st", "--start_time", dest="start_time", type=datetime.fromisoformat, required=True,
+                           help="Start time ISO format [YYY-MM-DDThh:mm:ss.s+TZD]")
+        query.add_argument("-et", "--end_time", dest="end_time", type=datetime.fromisoformat, required=True,
+                           help="End time ISO format [YYY-MM-DDThh:mm:ss.s+TZD]")
+        if command == "contacts":
+            query.add_argument("-m", "--minutes", dest="minutes", type=float, default=DEFAULT_CONTACT_MINUTES,
+                               help="Count clients seen on the same floor within this many minutes.")
+    args = parser.parse_args()
+    tz = get_timezone(args.timezone)
+    if args.command == "ingest":
+        for filename in args.filenames:
+            ingest_history(filename, args.database, tz, args.force)
+    else:
+        (start_ms, end_ms) = time_range_ms(args.start_time, args.end_time, tz)
+        store = open_store(args.database)
+        if args.command == "where":
+            write_rows(*where_was(store, args.client, start_ms, end_ms))
+        else:
+            write_rows(*shared_floor(store, args.client, start_ms, end_ms, args.minutes))
+        store.close()
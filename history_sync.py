@@ -0,0 +1,113 @@
+#
+# history_sync.py keeps the high-water mark of a dataset that is grown by --sync runs. Each run fetches the range from
+# the end of the last time window appended to the dataset up to now into a run file, which is appended to the dataset
+# once every window of the run is complete. The mark is kept in a JSON file next to the dataset.
+import json
+import logging
+import shutil
+from datetime import datetime, timedelta, timezone
+from os import path, remove, replace
+from history_compression import get_compression, compress_stream, open_history
+from history_manifest import load_manifest, windows_to_fetch, get_manifest_filename
+from constants import STITCH_BUFFER_SIZE, MAX_DAYS, SYNC_HORIZON_MARGIN_MINUTES
+
+
+def get_sync_filename(dataset_file):
+    return dataset_file + ".sync.json"
+
+
+def get_sync_run_filename(dataset_file):
+    # Keep the compression extension last so the run file is compressed the same way as the dataset
+    if get_compression(dataset_file) is None:
+        return dataset_file + ".sync-run"
+    (root, extension) = path.splitext(dataset_file)
+    return root + ".sync-run" + extension
+
+
+def load_sync_state(dataset_file):
+    sync_file = get_sync_filename(dataset_file)
+    if not path.isfile(sync_file):
+        logging.debug(f"No high-water mark {sync_file} found.")
+        return None
+    try:
+        with open(sync_file) as f:
+            return json.load(f)
+    except (IOError, ValueError) as e:
+        logging.error(f"Unable to read high-water mark {sync_file}. Got error {e}.")
+        return None
+
+
+def save_sync_state(state, dataset_file):
+    sync_file = get_sync_filename(dataset_file)
+    tmp_sync_file = sync_file + ".tmp"
+    try:
+        with open(tmp_sync_file, "w") as f:
+            json.dump(state, f, indent=2)
+        replace(tmp_sync_file, sync_file)
+    except IOError as e:
+        logging.error(f"Unable to write high-water mark {sync_file}. Got error {e}.")
+
+
+def get_sync_start(dataset_file):
+    # Returns the end of the last time window appended to the dataset, or None if it has never been synced. A mark
+    # older than the MAX_DAYS DNA Spaces keeps can never be fetched from, so the sync starts just inside the horizon
+    # instead and the rows in between are lost.
+    state = load_sync_state(dataset_file)
+    if state is None:
+        return None
+    start = datetime.fromisoformat(state["end"])
+    horizon = datetime.now(timezone.utc) - timedelta(days=MAX_DAYS, minutes=-SYNC_HORIZON_MARGIN_MINUTES)
+    if start < horizon:
+        logging.error(f"The high-water mark {state['end']} of {dataset_file} is more than {MAX_DAYS} days old. The "
+                      f"history from {start} to {horizon} can no longer be fetched. Syncing from {horizon}.")
+        return horizon.astimezone(start.tzinfo)
+    logging.info(f"Syncing {dataset_file} from {state['end']}.")
+    return start
+
+
+def append_history(run_file, dataset_file, compression_level=None):
+    # Append the rows of run_file to dataset_file, dropping the header. A compressed dataset gets them as a new gzip
+    # member or zstd frame. Returns False if the columns of the two files are not the same.
+    if not path.isfile(dataset_file):
+        replace(run_file, dataset_file)
+        return True
+    with open_history(dataset_file) as f:
+        dataset_header = f.readline()
+    with open_history(run_file) as source:
+        header = source.readline()
+        if header != dataset_header:
+            logging.error(f"Columns of {run_file} do not match {dataset_file}. Run with the same options each time.")
+            return False
+        with open(dataset_file, "ab") as f, compress_stream(f, get_compression(dataset_file), compression_level) as out:
+            shutil.copyfileobj(source, out, STITCH_BUFFER_SIZE)
+    remove(run_file)
+    return True
+
+
+def finish_sync_run(run_file, dataset_file, compression_level=None):
+    # Append the run to the dataset and move the high-water mark to the end of its last window. A run with windows
+    # that are not complete is thrown away so the next run fetches the same range again.
+    manifest = load_manifest(run_file)
+    if manifest is None or len(manifest["windows"]) == 0:
+        return False
+    appended = False
+    if windows_to_fetch(manifest):
+        logging.error(f"Not all time windows were fetched. {dataset_file} is unchanged and the next sync starts from "
+                      f"the same time.")
+    elif path.isfile(run_file) and append_history(run_file, dataset_file, compression_level):
+        state = load_sync_state(dataset_file) or {"rows": 0}
+        last_window = manifest["windows"][-1]
+        sourcetimestamps = [w["last_sourcetimestamp"] for w in manifest["windows"] if w["last_sourcetimestamp"]]
+        state.update({"end": last_window["end"],
+                      "end_ms": last_window["end_ms"],
+                      "last_sourcetimestamp": sourcetimestamps[-1] if sourcetimestamps else
+                      state.get("last_sourcetimestamp"),
+                      "rows": state["rows"] + sum(w["rows"] for w in manifest["windows"])})
+        save_sync_state(state, dataset_file)
+        logging.info(f"Appended {sum(w['rows'] for w in manifest['windows']):,} rows to {dataset_file}. "
+                     f"Synced up to {last_window['end']}.")
+        appended = True
+    for leftover_file in [run_file, get_manifest_filename(run_file)]:
+        if path.isfile(leftover_file):
+            remove(leftover_file)
+    return appended
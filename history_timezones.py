@@ -0,0 +1,128 @@
+#
+# history_timezones.py converts every row of the history to the local time of its own site, for tenants with campuses
+# in more than one time zone. Buildings and campuses are mapped to time zone names in a JSON file. A row uses the zone
+# of its buildingid, else of its campusid, else the default --timezone. The UTC offsets of every zone are worked out
+# once for the time range of the export as tables of the epoch ms each offset starts at. A chunk is then converted with
+# a single searchsorted over all of its rows, however many sites it has.
+#
+# {"buildings": {"7147effa7e389c41abc7a20dbaa2c6824": "Pacific/Auckland"},
+#  "campuses": {"b4537bffe15045978d758ed1812670f5": "Australia/Perth"}}
+import json
+import logging
+from time import time
+import numpy as np
+import pandas as pd
+import pytz
+from constants import MAX_DAYS, TIMEZONE_TABLE_PAD_DAYS
+
+HOUR_MS = 60 * 60 * 1000
+MINUTE_MS = 60 * 1000
+DAY_MS = 24 * HOUR_MS
+# The columns a row is mapped to its time zone by
+SITE_COLUMNS = ["buildingid", "campusid"]
+
+
+def zone_offsets(timezone, ms):
+    # The UTC offset in ms of timezone at each of the epoch ms
+    utc = pd.DatetimeIndex(ms.astype("datetime64[ms]").astype("datetime64[ns]"), tz="UTC")
+    return (utc.tz_convert(timezone).tz_localize(None).asi8 - utc.tz_localize(None).asi8) // 1000000
+
+
+def offset_table(timezone, start_ms, end_ms):
+    # The epoch ms each UTC offset of timezone starts at from the hour of start_ms to end_ms, with the offsets. The
+    # offset is looked up every hour and the minute of each change is found within the hour it happened in.
+    hours = np.arange(start_ms - start_ms % HOUR_MS, end_ms + HOUR_MS, HOUR_MS, dtype="int64")
+    offsets = zone_offsets(timezone, hours)
+    starts = [hours[0]]
+    table = [offsets[0]]
+    for hour in np.flatnonzero(offsets[1:] != offsets[:-1]):
+        minutes = np.arange(hours[hour], hours[hour + 1] + MINUTE_MS, MINUTE_MS, dtype="int64")
+        minute_offsets = zone_offsets(timezone, minutes)
+        change = np.flatnonzero(minute_offsets != offsets[hour])[0]
+        starts.append(minutes[change])
+        table.append(minute_offsets[change])
+    return np.array(starts, dtype="int64"), np.array(table, dtype="int64")
+
+
+class SiteTimezones:
+    def __init__(self, default, buildings=None, campuses=None):
+        # Zone 0 is the default for rows of sites that are not mapped
+        self.default = str(default)
+        buildings = buildings or {}
+        campuses = campuses or {}
+        self.zones = [self.default] + sorted((set(buildings.values()) | set(campuses.values())) - {self.default})
+        codes = {zone: code for (code, zone) in enumerate(self.zones)}
+        self.building_codes = {building: codes[zone] for (building, zone) in buildings.items()}
+        self.campus_codes = {campus: codes[zone] for (campus, zone) in campuses.items()}
+        self.tables = None
+        self.warned = False
+        # History from DNA Spaces is never more than MAX_DAYS old, so the tables of a fresh export are only built once
+        now_ms = int(time() * 1000)
+        self.cover(now_ms - MAX_DAYS * DAY_MS, now_ms)
+
+    def __str__(self):
+        return (f"{self.default} with {len(self.building_codes)} buildings and {len(self.campus_codes)} campuses in "
+                f"{len(self.zones)} time zones")
+
+    def cover(self, start_ms, end_ms):
+        # Returns the offset tables of every zone, built for TIMEZONE_TABLE_PAD_DAYS either side of start_ms to end_ms
+        # unless the tables already cover it. The tables of all zones are one sorted array of keys, the time since
+        # the start of the tables of each offset plus its zone times the span of the tables. They are replaced in one
+        # assignment as streaming conversion shares them between fetch threads.
+        tables = self.tables
+        if tables is not None and tables[0] <= start_ms and end_ms <= tables[1]:
+            return tables
+        if tables is not None:
+            (start_ms, end_ms) = (min(start_ms, tables[0]), max(end_ms, tables[1]))
+        zone_tables = [offset_table(zone, start_ms - TIMEZONE_TABLE_PAD_DAYS * DAY_MS,
+                                    end_ms + TIMEZONE_TABLE_PAD_DAYS * DAY_MS) for zone in self.zones]
+        table_start = int(zone_tables[0][0][0])
+        table_end = end_ms + TIMEZONE_TABLE_PAD_DAYS * DAY_MS
+        span = table_end - table_start + HOUR_MS
+        keys = np.concatenate([code * span + starts - table_start for (code, (starts, _)) in enumerate(zone_tables)])
+        offsets = np.concatenate([offsets for (_, offsets) in zone_tables])
+        logging.debug(f"Built UTC offset tables of {len(self.zones)} time zones with {len(keys)} offsets.")
+        self.tables = (table_start, table_end, span, keys, offsets)
+        return self.tables
+
+    def zone_codes(self, df):
+        codes = pd.Series(np.nan, index=df.index)
+        for (col, col_codes) in [("buildingid", self.building_codes), ("campusid", self.campus_codes)]:
+            if col in df.columns and col_codes:
+                codes = codes.fillna(df[col].map(col_codes).astype("float64"))
+        if "buildingid" not in df.columns and "campusid" not in df.columns and not self.warned:
+            logging.error(f"The history has no buildingid or campusid column. Converting to {self.default}.")
+            self.warned = True
+        return codes.fillna(0).to_numpy(dtype="int64")
+
+    def local_datetimes(self, ms, missing, df):
+        # Naive local datetime64 values of the epoch ms, each in the time zone of the site of its row of df. Missing
+        # values become NaT.
+        if missing.all():
+            return np.full(len(ms), np.datetime64("NaT"), dtype="datetime64[ns]")
+        present = ms[~missing]
+        (table_start, _, span, table_keys, offsets) = self.cover(int(present.min()), int(present.max()))
+        ms = np.where(missing, table_start, ms)
+        keys = self.zone_codes(df) * span + ms - table_start
+        local = ms + offsets[np.searchsorted(table_keys, keys, side="right") - 1]
+        return np.where(missing, np.datetime64("NaT"), local.astype("datetime64[ms]")).astype("datetime64[ns]")
+
+
+def load_site_timezones(site_file, default):
+    # A JSON object mapping the ids of "buildings" and/or "campuses" to time zone names. Returns None if the file
+    # cannot be read or names a time zone that does not exist.
+    try:
+        with open(site_file) as f:
+            sites = json.load(f)
+    except (IOError, ValueError) as e:
+        logging.error(f"Unable to read site time zones file {site_file}. Got error {e}.")
+        return None
+    buildings = sites.get("buildings", {})
+    campuses = sites.get("campuses", {})
+    for zone in set(buildings.values()) | set(campuses.values()):
+        try:
+            pytz.timezone(zone)
+        except pytz.UnknownTimeZoneError:
+            logging.error(f"Time zone {zone} in {site_file} is not valid.")
+            return None
+    return SiteTimezones(default, buildings, campuses)
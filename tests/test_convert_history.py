@@ -1,4 +1,9 @@
-from convert_history import change_timezone, timestamp_to_date, convert_history
+from convert_history import change_timezone, timestamp_to_date, convert_history, convert_lines, local_datetimes, \
+    format_datetimes, chunk_byte_ranges, get_chunk_size
+from history_compression import open_history
+from history_metrics import run_metrics
+from time import perf_counter
+import pytest
 import pandas as pd
 import numpy as np
 import logging
@@ -27,6 +32,21 @@ def test_timestamp_to_date():
     assert (df.date[0].strftime("%Y-%m-%d %H:%M.%S") == '2020-05-21 00:01.27')
 
 
+def test_local_datetimes():
+    col = pd.Series([1590019287571, 0, np.nan, 1601737200000, 1601740800000])
+    local = local_datetimes(col, "Australia/Sydney")
+    assert str(local[0]) == "2020-05-21T10:01:27.571000000"
+    assert np.isnat(local[1]) and np.isnat(local[2])
+    # Daylight saving starts in Sydney at 2020-10-04 02:00 local time
+    assert str(local[3]) == "2020-10-04T01:00:00.000000000"
+    assert str(local[4]) == "2020-10-04T03:00:00.000000000"
+
+
+def test_format_datetimes():
+    values = np.array(["2020-05-21T10:01:27.571", "NaT"], dtype="datetime64[ms]")
+    assert list(format_datetimes(values)) == ["2020-05-21 10:01:27", ""]
+
+
 def test_convert_history():
     logging.basicConfig(format='%(levelname)s:%(asctime)s:%(funcName)s():%(message)s',
                         datefmt='%H:%M:%S',
@@ -50,3 +70,193 @@ def test_convert_history():
         os.remove(new_filename + ".old")
     except OSError as e:
         logging.error("Unable to delete test files. Got error", e)
+
+
+def test_convert_lines():
+    header = b"tenantid,sourcetimestamp,firstactiveat,changedon,coordinatex,ipaddress"
+    lines = [b'16655,1590019287571,0,1590019287571,13.3026,"10.10.10.10, fe80::1"',
+             b'16655,1590019287571,1590019287571,,1.50,']
+    (converted, rows) = convert_lines(header, lines, "Australia/Sydney")
+    assert rows == 2
+    assert converted.decode().splitlines() == [
+        '16655,2020-05-21 10:01:27,,2020-05-21 10:01:27,13.3026,"10.10.10.10, fe80::1"',
+        '16655,2020-05-21 10:01:27,2020-05-21 10:01:27,,1.50,']
+    # Only the rows kept by the filter are counted
+    assert convert_lines(header, lines, None, {"columns": None, "rows": {"coordinatex": {"1.50"}}})[1] == 1
+
+
+def test_chunk_byte_ranges(tmpdir):
+    test_filename = os.path.join(str(tmpdir), "temp.csv")
+    with open(test_filename, "w") as f:
+        f.write("a,b\n" + "".join(f"{i},{i}\n" for i in range(7)))
+    (header, ranges) = chunk_byte_ranges(test_filename, 3)
+    assert header == b"a,b\n"
+    assert ranges == [(4, 16), (16, 28), (28, 32)]
+    with open(test_filename, "w") as f:
+        f.write("a,b\n" + "".join(f"{i},{i}\n" for i in range(6)) + "6,6")
+    assert chunk_byte_ranges(test_filename, 3)[1] == [(4, 16), (16, 28), (28, 31)]
+
+
+def test_convert_history_jobs(tmpdir, monkeypatch):
+    monkeypatch.setattr("convert_history.CONVERT_FILE_CHUNK_SIZE", 3)
+    df = pd.DataFrame({"sourcetimestamp": [1590019287571 + i for i in range(10)],
+                       "firstactiveat": [0, 1590019287571] * 5,
+                       "changedon": [1590019287571] * 10,
+                       # Each chunk infers its own dtype for this column so chunks must line up with the serial path
+                       "maxdetectedslot": [1, "", 2, 3, 4, 5, "", "", "", 6],
+                       "ipaddress": ["10.10.10.10, fe80::1"] * 10})
+    output = []
+    for jobs in [1, 2]:
+        test_filename = os.path.join(str(tmpdir), f"temp{jobs}.csv")
+        df.to_csv(test_filename, index=False)
+        run_metrics.reset()
+        started = perf_counter()
+        assert convert_history(test_filename, "Australia/Sydney", False, jobs=jobs) == test_filename
+        # The seconds of chunks converted at the same time are not counted twice
+        assert run_metrics.report()["convert"]["rows"] == 10
+        assert run_metrics.report()["convert"]["seconds"] <= perf_counter() - started
+        with open(test_filename) as f:
+            output.append(f.read())
+    assert output[0] == output[1]
+    assert output[0].splitlines()[0] == ",sourcetimestamp,firstactiveat,changedon,maxdetectedslot,ipaddress"
+    assert len(output[0].splitlines()) == 11
+    # A file with only a header keeps its converted header, and an empty file is not converted
+    for jobs in [1, 2]:
+        test_filename = os.path.join(str(tmpdir), f"header{jobs}.csv")
+        df.head(0).to_csv(test_filename, index=False)
+        assert convert_history(test_filename, "Australia/Sydney", False, jobs=jobs) == test_filename
+        with open(test_filename) as f:
+            assert f.read() == output[0].splitlines()[0] + "\n"
+        test_filename = os.path.join(str(tmpdir), f"empty{jobs}.csv")
+        open(test_filename, "w").close()
+        assert convert_history(test_filename, "Australia/Sydney", False, jobs=jobs) is None
+
+
+def test_convert_history_max_memory(tmpdir, monkeypatch):
+    n = 250
+    df = pd.DataFrame({"sourcetimestamp": [1590019287571 + i for i in range(n)],
+                       "ssid": ["Guest", "Staff"] * (n // 2),
+                       "maxdetectedrssi": [-60, ""] * (n // 2),
+                       "floorhierarchy": ["Campus>Building>Level 1"] * n})
+    test_filename = os.path.join(str(tmpdir), "temp.csv")
+    df.to_csv(test_filename, index=False)
+    assert get_chunk_size(test_filename, None) == 10000
+    # Tiny budgets still convert some rows at a time and the chunk grows with the budget
+    assert get_chunk_size(test_filename, 1) == 100
+    large = get_chunk_size(test_filename, 512 * 1024 ** 2)
+    assert get_chunk_size(test_filename, 1024 * 1024 ** 2) in (2 * large, 2 * large + 1)
+    assert get_chunk_size(test_filename, 1024 * 1024 ** 2, chunks=2) == large
+    # csv keeps the numbers as text, which takes more memory than the numeric columns of the columnar formats
+    assert large < get_chunk_size(test_filename, 512 * 1024 ** 2, columnar=True)
+    output = []
+    for max_memory in [None, 1]:
+        df.to_csv(test_filename, index=False)
+        assert convert_history(test_filename, "Australia/Sydney", False, max_memory=max_memory) == test_filename
+        with open(test_filename) as f:
+            output.append(f.read())
+    assert output[0] == output[1]
+    # With -j the budget is shared by every chunk the parallel conversion keeps in flight
+    sizes = []
+    monkeypatch.setattr("convert_history.get_chunk_size", lambda *args, **kwargs: sizes.append(args) or 100)
+    df.to_csv(test_filename, index=False)
+    assert convert_history(test_filename, "Australia/Sydney", False, jobs=2, max_memory=1024 ** 2) == test_filename
+    assert sizes[0][3] == 4
+    # Integer columns with missing values are not written as floats
+    assert output[0].splitlines()[1] == "0,2020-05-21 10:01:27,Guest,-60,Campus>Building>Level 1"
+    assert output[0].splitlines()[2] == "1,2020-05-21 10:01:27,Staff,,Campus>Building>Level 1"
+
+
+def test_convert_history_exact_text(tmpdir):
+    # Only the date columns are converted. Every other column is written exactly as it was read, with history_dict
+    # category columns too and for every way of converting csv.
+    raw = ("sourcetimestamp,coordinatex,coordinatey,maxdetectedrssi,associatedaprssi,ssid,username,extra\n"
+           "1590019287571,123.456789,1234567.891,2,-60.5,NA,null,007\n"
+           ",0.10,-0,,-61,Guest,,1e3\n")
+    expected = [",sourcetimestamp,coordinatex,coordinatey,maxdetectedrssi,associatedaprssi,ssid,username,extra",
+                "0,2020-05-21 10:01:27,123.456789,1234567.891,2,-60.5,NA,null,007",
+                "1,,0.10,-0,,-61,Guest,,1e3"]
+    for (jobs, history_filter) in [(1, None), (2, None), (1, {"columns": None, "rows": {"ssid": {"NA", "Guest"}}})]:
+        test_filename = os.path.join(str(tmpdir), "temp.csv")
+        with open(test_filename, "w") as f:
+            f.write(raw)
+        assert convert_history(test_filename, "Australia/Sydney", False, jobs=jobs, history_filter=history_filter) == \
+            test_filename
+        with open(test_filename) as f:
+            assert f.read().splitlines() == expected
+
+
+@pytest.mark.parametrize("extension", [".gz", ".zst"])
+def test_convert_history_compressed(tmpdir, extension):
+    if extension == ".zst":
+        pytest.importorskip("zstandard")
+    df = pd.DataFrame({"sourcetimestamp": [1590019287571 + i for i in range(10)],
+                       "firstactiveat": [0, 1590019287571] * 5,
+                       "changedon": [1590019287571] * 10})
+    plain_filename = os.path.join(str(tmpdir), "temp.csv")
+    df.to_csv(plain_filename, index=False)
+    assert convert_history(plain_filename, "Australia/Sydney", False) == plain_filename
+    test_filename = os.path.join(str(tmpdir), "temp.csv" + extension)
+    with open_history(test_filename, "wt") as f:
+        df.to_csv(f, index=False)
+    # Compressed files cannot be split into byte ranges so jobs falls back to a single process
+    assert convert_history(test_filename, "Australia/Sydney", False, jobs=2, compression_level=1) == test_filename
+    with open_history(test_filename, "rt") as f, open(plain_filename, newline="") as plain:
+        assert f.read() == plain.read()
+    assert not os.path.isfile(test_filename + ".old")
+
+
+def test_convert_history_filtered(tmpdir, monkeypatch):
+    monkeypatch.setattr("convert_history.CONVERT_FILE_CHUNK_SIZE", 3)
+    df = pd.DataFrame({"macaddress": [f"00:00:00:00:00:{i:02x}" for i in range(10)],
+                       "floorid": ["floor1", "floor2"] * 5,
+                       "sourcetimestamp": [1590019287571 + i for i in range(10)],
+                       "firstactiveat": [1590019287571] * 10,
+                       "changedon": [1590019287571] * 10})
+    filtered_filename = os.path.join(str(tmpdir), "filtered.csv")
+    df.to_csv(filtered_filename, index=False)
+    history_filter = {"columns": ["macaddress", "sourcetimestamp"], "rows": {"floorid": {"floor2"}}}
+    assert convert_history(filtered_filename, "Australia/Sydney", False, history_filter=history_filter) == \
+        filtered_filename
+    test_filename = os.path.join(str(tmpdir), "temp.csv")
+    df.to_csv(test_filename, index=False)
+    convert_history(test_filename, "Australia/Sydney", False)
+    converted = pd.read_csv(test_filename, index_col=0)
+    # The same rows and row numbers as filtering the whole converted file
+    expected = converted.loc[converted.floorid == "floor2", ["macaddress", "sourcetimestamp"]]
+    pd.testing.assert_frame_equal(pd.read_csv(filtered_filename, index_col=0), expected)
+
+
+@pytest.mark.parametrize("output_format", ["parquet", "feather"])
+def test_convert_history_columnar(tmpdir, output_format):
+    pa = pytest.importorskip("pyarrow")
+    test_filename = os.path.join(str(tmpdir), "temp.csv")
+    df = pd.DataFrame({"tenantid": ["16655"] * 3,
+                       "floorid": ["floor1", "floor2", "floor1"],
+                       "coordinatex": [13.3026, 1.5, 2.25],
+                       "sourcetimestamp": [1590019287571, 1590019288571, 1590105687571],
+                       "firstactiveat": [0, 1590019287571, 1590019287571],
+                       "changedon": [1590019287571, 1590019287571, 1590019287571],
+                       "maxdetectedrssi": [-52, -60, ""],
+                       "username": ["a", "", "c"]})
+    df.to_csv(test_filename, index=False)
+    out_file = convert_history(test_filename, "Australia/Sydney", False, output_format)
+    assert out_file == os.path.join(str(tmpdir), "temp." + output_format)
+    assert not os.path.isfile(test_filename)
+    if output_format == "parquet":
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(out_file)
+        # The third row is on the next day so it gets its own row group
+        assert parquet_file.num_row_groups == 2
+        table = parquet_file.read()
+    else:
+        table = pa.ipc.open_file(out_file).read_all()
+    assert table.schema.field("tenantid").type == pa.dictionary(pa.int32(), pa.string())
+    assert table.schema.field("coordinatex").type == pa.float32()
+    assert table.schema.field("maxdetectedrssi").type == pa.int16()
+    assert table.schema.field("sourcetimestamp").type == pa.timestamp("ms", tz="Australia/Sydney")
+    df_new = table.to_pandas()
+    assert df_new.sourcetimestamp[0].strftime("%Y-%m-%d %H:%M:%S") == "2020-05-21 10:01:27"
+    assert pd.isnull(df_new.firstactiveat[0])
+    assert df_new.maxdetectedrssi[0] == -52
+    assert pd.isnull(df_new.maxdetectedrssi[2])
+    assert list(df_new.username) == ["a", "", "c"]
@@ -0,0 +1,78 @@
+from dnaspaces_client import DnaSpacesClient, get_retry_after
+from constants import URL, MAX_BACKOFF_SECONDS, BACKOFF_BASE_SECONDS
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+import httpretty
+import requests
+
+
+def test_get_retry_after():
+    response = requests.Response()
+    response.status_code = 429
+    assert get_retry_after(response) is None
+    response.headers["Retry-After"] = "30"
+    assert get_retry_after(response) == 30
+    response.headers["Retry-After"] = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=60), usegmt=True)
+    assert 50 < get_retry_after(response) <= 60
+    response.headers["Retry-After"] = "soon"
+    assert get_retry_after(response) is None
+    response.status_code = 500
+    response.headers["Retry-After"] = "30"
+    assert get_retry_after(response) is None
+    assert get_retry_after(None) is None
+
+
+def test_backoff_delay():
+    with DnaSpacesClient("TEST_TOKEN") as client:
+        for attempts in range(1, 10):
+            assert 0 <= client.backoff_delay(attempts) <= min(MAX_BACKOFF_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempts)
+        response = requests.Response()
+        response.status_code = 503
+        response.headers["Retry-After"] = "7"
+        assert client.backoff_delay(1, response) == 7
+        response.headers["Retry-After"] = str(MAX_BACKOFF_SECONDS * 10)
+        assert client.backoff_delay(1, response) == MAX_BACKOFF_SECONDS
+
+
+def test_get_history(monkeypatch):
+    delays = []
+    closed = []
+    monkeypatch.setattr("dnaspaces_client.sleep", lambda seconds: delays.append(seconds))
+    close = requests.Response.close
+
+    def close_response(response):
+        closed.append(response.status_code)
+        close(response)
+
+    monkeypatch.setattr(requests.Response, "close", close_response)
+    httpretty.enable()
+    httpretty.register_uri(httpretty.GET, URL, responses=[
+        httpretty.Response(body="busy", status=429, adding_headers={"Retry-After": "3"}),
+        httpretty.Response(body="busy", status=503),
+        httpretty.Response(body="tenantid\n16655", status=200),
+    ])
+    with DnaSpacesClient("TEST_TOKEN") as client:
+        response = client.get_history({"startTime": 1, "endTime": 2})
+        assert response.status_code == 200
+        assert delays[0] == 3
+        assert len(delays) == 2
+        # The responses that are retried are closed before waiting
+        assert closed == [429, 503]
+        request = httpretty.last_request()
+        assert request.headers["Authorization"] == "Bearer TEST_TOKEN"
+        assert "gzip" in request.headers["Accept-Encoding"]
+        httpretty.reset()
+        httpretty.register_uri(httpretty.GET, URL, status=400)
+        delays.clear()
+        # A bad request fails the same way every time so it is not retried
+        assert client.get_history({"startTime": 1, "endTime": 2}).status_code == 400
+        assert delays == []
+        httpretty.reset()
+        httpretty.register_uri(httpretty.GET, URL, status=500)
+        closed.clear()
+        assert client.get_history({"startTime": 1, "endTime": 2}, max_retries=3).status_code == 500
+        assert len(delays) == 2
+        # The last response is returned open so its message can be read
+        assert closed == [500, 500]
+    httpretty.disable()
+    httpretty.reset()
@@ -1,5 +1,5 @@
 from dnaspaces_get_history import get_arguments, get_config, check_file_writable, get_filename, \
-    get_client_history, valid_date, main
+    get_client_history, valid_date, main, load_tenants, get_tenants_history
 import pytz
 import os
 from datetime import datetime, timedelta, timezone
@@ -7,6 +7,14 @@ from stat import S_IREAD, S_IRGRP, S_IROTH, S_IWUSR
 import httpretty
 from constants import URL
 import pandas as pd
+import json
+from history_manifest import load_manifest, save_manifest
+from history_compression import open_history
+from history_cache import HistoryCache
+from history_sync import load_sync_state, save_sync_state
+import pytest
+import subprocess
+import sys
 
 
 def test_get_client_history(tmpdir):
@@ -52,6 +60,273 @@ def test_get_client_history(tmpdir):
     httpretty.reset()
 
 
+def test_get_client_history_workers(tmpdir):
+    tmpdir = str(tmpdir)
+    test_filename = os.path.join(tmpdir, 'temp.csv')
+    httpretty.enable()
+    httpretty.register_uri(
+        httpretty.GET,
+        URL,
+        body='tenantid,macaddress,sourcetimestamp\n'
+             '16655,9c:ff:d0:aa:50:ff,1589086604182\n'
+             '16655,9c:ff:d0:aa:50:ee,1589086604183',
+        status=200,
+        content_type="text/csv",
+    )
+    end = datetime.now(timezone.utc)
+    windows = [(end - timedelta(days=3), end - timedelta(days=2)),
+               (end - timedelta(days=2), end - timedelta(days=1)),
+               (end - timedelta(days=1), end)]
+    os.environ["TOKEN"] = "TEST_TOKEN"
+    assert get_client_history(windows, test_filename, workers=3) == 9
+    df = pd.read_csv(test_filename)
+    assert df.shape == (6, 3)
+    assert list(df.columns) == ["tenantid", "macaddress", "sourcetimestamp"]
+    assert [f for f in os.listdir(tmpdir) if f.endswith(".part")] == []
+    del os.environ["TOKEN"]
+    httpretty.disable()
+    httpretty.reset()
+
+
+def test_get_client_history_dedup(tmpdir):
+    tmpdir = str(tmpdir)
+    test_filename = os.path.join(tmpdir, 'temp.csv')
+
+    def history_callback(request, uri, response_headers):
+        # Every window returns the rows at both of its endpoints, so the rows at a shared endpoint come back twice
+        start = int(request.querystring["startTime"][0])
+        end = int(request.querystring["endTime"][0])
+        rows = [f"16655,9c:ff:d0:aa:50:ff,floor1,{start}", f"16655,9c:ff:d0:aa:50:ee,floor1,{start + 1}"] + \
+               [f"16655,9c:ff:d0:aa:50:{i:02x},floor1,{start + 60000 * i}" for i in range(1, 30)] + \
+               [f"16655,9c:ff:d0:aa:50:ff,floor1,{end}"]
+        return [200, response_headers, "tenantid,macaddress,floorid,sourcetimestamp\n" + "\n".join(rows)]
+
+    httpretty.enable()
+    httpretty.register_uri(httpretty.GET, URL, body=history_callback, content_type="text/csv")
+    end = datetime.now(timezone.utc)
+    windows = [(end - timedelta(days=3), end - timedelta(days=2)),
+               (end - timedelta(days=2), end - timedelta(days=1)),
+               (end - timedelta(days=1), end)]
+    os.environ["TOKEN"] = "TEST_TOKEN"
+    # However few recent rows are checked, the rows at the shared endpoints are only kept once
+    for (workers, dedup_rows) in [(1, 100), (3, 100), (1, 2), (3, 2)]:
+        assert get_client_history(windows, test_filename, workers=workers, dedup_rows=dedup_rows) == 97
+        df = pd.read_csv(test_filename)
+        assert not df.duplicated().any()
+        assert sum(window["duplicates"] for window in load_manifest(test_filename)["windows"]) == 2
+    assert get_client_history(windows, test_filename) == 99
+    del os.environ["TOKEN"]
+    httpretty.disable()
+    httpretty.reset()
+
+
+def test_get_client_history_resume(tmpdir):
+    tmpdir = str(tmpdir)
+    test_filename = os.path.join(tmpdir, 'temp.csv')
+    body = 'tenantid,macaddress,sourcetimestamp\n16655,{},{}'
+
+    def history_callback(request, uri, response_headers):
+        return [200, response_headers, body.format(request.querystring["startTime"][0], "first")]
+
+    httpretty.enable()
+    httpretty.register_uri(httpretty.GET, URL, body=history_callback, content_type="text/csv")
+    end = datetime.now(timezone.utc)
+    windows = [(end - timedelta(days=3), end - timedelta(days=2)),
+               (end - timedelta(days=2), end - timedelta(days=1)),
+               (end - timedelta(days=1), end)]
+    os.environ["TOKEN"] = "TEST_TOKEN"
+    assert get_client_history(windows, test_filename) == 6
+    manifest = load_manifest(test_filename)
+    assert [w["status"] for w in manifest["windows"]] == ["complete"] * 3
+    assert [w["rows"] for w in manifest["windows"]] == [1] * 3
+    assert manifest["windows"][2]["last_sourcetimestamp"] == "first"
+    manifest["windows"][1]["status"] = "incomplete"
+    save_manifest(manifest, test_filename)
+
+    def resume_callback(request, uri, response_headers):
+        return [200, response_headers, body.format(request.querystring["startTime"][0], "second")]
+
+    httpretty.reset()
+    httpretty.register_uri(httpretty.GET, URL, body=resume_callback, content_type="text/csv")
+    assert get_client_history([], test_filename, resume=True) == 2
+    df = pd.read_csv(test_filename)
+    assert list(df.sourcetimestamp) == ["first", "second", "first"]
+    assert list(df.macaddress) == sorted(df.macaddress)
+    assert [w["status"] for w in load_manifest(test_filename)["windows"]] == ["complete"] * 3
+    del os.environ["TOKEN"]
+    httpretty.disable()
+    httpretty.reset()
+
+
+@pytest.mark.parametrize("extension", [".gz", ".zst"])
+def test_get_client_history_compressed(tmpdir, extension):
+    if extension == ".zst":
+        pytest.importorskip("zstandard")
+    tmpdir = str(tmpdir)
+    test_filename = os.path.join(tmpdir, 'temp.csv' + extension)
+    body = 'tenantid,macaddress,sourcetimestamp\n16655,{},{}\n'
+
+    def history_callback(request, uri, response_headers):
+        return [200, response_headers, body.format(request.querystring["startTime"][0], "first")]
+
+    httpretty.enable()
+    httpretty.register_uri(httpretty.GET, URL, body=history_callback, content_type="text/csv")
+    end = datetime.now(timezone.utc)
+    windows = [(end - timedelta(days=3), end - timedelta(days=2)),
+               (end - timedelta(days=2), end - timedelta(days=1)),
+               (end - timedelta(days=1), end)]
+    os.environ["TOKEN"] = "TEST_TOKEN"
+    assert get_client_history(windows, test_filename, compression_level=1) == 6
+    with open_history(test_filename) as f:
+        assert f.readline() == b"tenantid,macaddress,sourcetimestamp\n"
+    manifest = load_manifest(test_filename)
+    manifest["windows"][1]["status"] = "incomplete"
+    save_manifest(manifest, test_filename)
+
+    def resume_callback(request, uri, response_headers):
+        return [200, response_headers, body.format(request.querystring["startTime"][0], "second")]
+
+    httpretty.reset()
+    httpretty.register_uri(httpretty.GET, URL, body=resume_callback, content_type="text/csv")
+    assert get_client_history([], test_filename, resume=True) == 2
+    with open_history(test_filename) as f:
+        df = pd.read_csv(f)
+    assert list(df.sourcetimestamp) == ["first", "second", "first"]
+    assert list(df.macaddress) == sorted(df.macaddress)
+    assert [f for f in os.listdir(tmpdir) if f.endswith(".part")] == []
+    del os.environ["TOKEN"]
+    httpretty.disable()
+    httpretty.reset()
+
+
+def test_get_client_history_cache(tmpdir):
+    tmpdir = str(tmpdir)
+    test_filename = os.path.join(tmpdir, 'temp.csv')
+    requests_made = []
+
+    def history_callback(request, uri, response_headers):
+        requests_made.append(request.querystring["startTime"][0])
+        return [200, response_headers, 'tenantid,macaddress,sourcetimestamp\n16655,{},1589086604182\n'.format(
+            request.querystring["startTime"][0])]
+
+    httpretty.enable()
+    httpretty.register_uri(httpretty.GET, URL, body=history_callback, content_type="text/csv")
+    end = datetime.now(timezone.utc)
+    windows = [(end - timedelta(days=3), end - timedelta(days=2)),
+               (end - timedelta(days=2), end - timedelta(days=1)),
+               (end - timedelta(days=1), end)]
+    cache = HistoryCache(os.path.join(tmpdir, "cache"), 1024 * 1024)
+    os.environ["TOKEN"] = "TEST_TOKEN"
+    assert get_client_history(windows[:2], test_filename, cache=cache) == 4
+    assert len(requests_made) == 2
+    # The first two windows come from the cache and the last one ends now so it is never cached
+    with open(test_filename, "rb") as f:
+        first_output = f.read()
+    assert get_client_history(windows, test_filename, workers=2, cache=cache) == 6
+    assert len(requests_made) == 3
+    with open(test_filename, "rb") as f:
+        assert f.read().startswith(first_output)
+    assert get_client_history(windows, test_filename, cache=cache) == 6
+    assert len(requests_made) == 4
+    del os.environ["TOKEN"]
+    httpretty.disable()
+    httpretty.reset()
+
+
+def test_get_client_history_adaptive(tmpdir, monkeypatch):
+    tmpdir = str(tmpdir)
+    test_filename = os.path.join(tmpdir, 'temp.csv')
+    monkeypatch.setattr("dnaspaces_client.sleep", lambda seconds: None)
+
+    def history_callback(request, uri, response_headers):
+        start_ms = int(request.querystring["startTime"][0])
+        end_ms = int(request.querystring["endTime"][0])
+        # Pretend the service can only cope with windows of 6 hours or less
+        if end_ms - start_ms > 6 * 60 * 60 * 1000:
+            return [503, response_headers, "busy"]
+        return [200, response_headers, f"tenantid,sourcetimestamp\n16655,{start_ms}"]
+
+    httpretty.enable()
+    httpretty.register_uri(httpretty.GET, URL, body=history_callback, content_type="text/csv")
+    end = datetime.now(timezone.utc)
+    os.environ["TOKEN"] = "TEST_TOKEN"
+    for workers in [1, 2]:
+        lines = get_client_history([(end - timedelta(days=1), end)], test_filename, workers, adaptive=True)
+        manifest = load_manifest(test_filename)
+        windows = manifest["windows"]
+        assert lines == 2 * len(windows)
+        assert all(w["status"] == "complete" for w in windows)
+        assert all(w["end_ms"] - w["start_ms"] <= 6 * 60 * 60 * 1000 for w in windows)
+        assert all(windows[i]["end_ms"] == windows[i + 1]["start_ms"] for i in range(len(windows) - 1))
+        df = pd.read_csv(test_filename)
+        assert list(df.sourcetimestamp) == [w["start_ms"] for w in windows]
+    del os.environ["TOKEN"]
+    httpretty.disable()
+    httpretty.reset()
+
+
+def test_get_client_history_stream_convert(tmpdir):
+    tmpdir = str(tmpdir)
+    test_filename = os.path.join(tmpdir, 'temp.csv')
+    httpretty.enable()
+    httpretty.register_uri(
+        httpretty.GET,
+        URL,
+        body='tenantid,macaddress,sourcetimestamp,firstactiveat,changedon,ipaddress\n'
+             '16655,9c:ff:d0:aa:50:ff,1589086604182,1589072492071,0,"10.10.10.10, fe80:0000:0000:0000:9c:ee"',
+        status=200,
+        content_type="text/csv",
+    )
+    end = datetime.now(timezone.utc)
+    os.environ["TOKEN"] = "TEST_TOKEN"
+    windows = [(end - timedelta(days=2), end - timedelta(days=1)), (end - timedelta(days=1), end)]
+    assert get_client_history(windows, test_filename, convert_timezone="Australia/Sydney") == 4
+    with open(test_filename) as f:
+        assert f.read() == ('tenantid,macaddress,sourcetimestamp,firstactiveat,changedon,ipaddress\n' +
+                            '16655,9c:ff:d0:aa:50:ff,2020-05-10 14:56:44,2020-05-10 11:01:32,,'
+                            '"10.10.10.10, fe80:0000:0000:0000:9c:ee"\n' * 2)
+    manifest = load_manifest(test_filename)
+    assert manifest["windows"][1]["last_sourcetimestamp"] == "1589086604182"
+    del os.environ["TOKEN"]
+    httpretty.disable()
+    httpretty.reset()
+
+
+def test_get_tenants_history(tmpdir):
+    tmpdir = str(tmpdir)
+
+    def history_callback(request, uri, response_headers):
+        token = request.headers["Authorization"].split(" ")[1]
+        return [200, response_headers, f"tenantid,sourcetimestamp\n{token},{request.querystring['startTime'][0]}"]
+
+    httpretty.enable()
+    httpretty.register_uri(httpretty.GET, URL, body=history_callback, content_type="text/csv")
+    tenants_file = os.path.join(tmpdir, "tenants.json")
+    with open(tenants_file, "w") as f:
+        json.dump([{"name": "campus-a", "token_env": "TOKEN_A", "filename": os.path.join(tmpdir, "a.csv")},
+                   {"name": "campus-b", "token_env": "TOKEN_B", "filename": os.path.join(tmpdir, "b.csv")},
+                   {"name": "campus-c", "token_env": "TOKEN_C"}], f)
+    os.environ["TOKEN_A"] = "TENANT_A"
+    os.environ["TOKEN_B"] = "TENANT_B"
+    tenants = load_tenants(tenants_file)
+    assert [t["token"] for t in tenants] == ["TENANT_A", "TENANT_B", ""]
+    assert tenants[2]["filename"].startswith("client-history-campus-c-")
+    end = datetime.now(timezone.utc)
+    windows = [(end - timedelta(days=3), end - timedelta(days=2)),
+               (end - timedelta(days=2), end - timedelta(days=1)),
+               (end - timedelta(days=1), end)]
+    lines = get_tenants_history(tenants, windows, workers=2, global_workers=3)
+    assert lines == {os.path.join(tmpdir, "a.csv"): 6, os.path.join(tmpdir, "b.csv"): 6}
+    for (name, token) in [("a.csv", "TENANT_A"), ("b.csv", "TENANT_B")]:
+        df = pd.read_csv(os.path.join(tmpdir, name))
+        assert list(df.tenantid) == [token] * 3
+        assert list(df.sourcetimestamp) == sorted(df.sourcetimestamp)
+    del os.environ["TOKEN_A"]
+    del os.environ["TOKEN_B"]
+    httpretty.disable()
+    httpretty.reset()
+
+
 def test_main(tmpdir):
     tmpdir = str(tmpdir)
     test_filename = os.path.join(tmpdir, 'temp.csv')
@@ -79,6 +354,160 @@ def test_main(tmpdir):
     assert main(["-st", start_str, "-et", end_str, "-f", test_filename]) is False
     os.environ["TOKEN"] = "TEST_TOKEN"
     assert main(["-st", start_str, "-et", end_str, "-f", test_filename])
+    assert load_manifest(test_filename)["converted"]
+    assert main(["-st", start_str, "-et", end_str, "-f", test_filename, "-r"]) is False
+    assert main(["-st", start_str, "-et", end_str, "-f", test_filename, "-s", "-tz", "Australia/Sydney"])
+    df = pd.read_csv(test_filename)
+    assert df.shape == (1, 25)
+    assert df.sourcetimestamp[0] == "2020-05-10 14:56:44"
+    del os.environ["TOKEN"]
+    httpretty.disable()
+    httpretty.reset()
+
+
+def test_main_resume(tmpdir):
+    tmpdir = str(tmpdir)
+    test_filename = os.path.join(tmpdir, 'temp.csv')
+    failing = []
+
+    def history_callback(request, uri, response_headers):
+        start_ms = int(request.querystring["startTime"][0])
+        if start_ms in failing:
+            return [400, response_headers, "Bad request"]
+        return [200, response_headers, f'tenantid,macaddress,sourcetimestamp\n16655,9c:ff:d0:aa:50:ff,{start_ms}\n']
+
+    httpretty.enable()
+    httpretty.register_uri(httpretty.GET, URL, body=history_callback, content_type="text/csv")
+    os.environ["TOKEN"] = "TEST_TOKEN"
+    end = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    starts = [end - timedelta(days=2), end - timedelta(days=1)]
+    starts_ms = [int(start.timestamp() * 1000) for start in starts]
+    args = ["-st", starts[0].isoformat(), "-et", end.isoformat(), "-f", test_filename, "-tz", "Australia/Sydney"]
+    failing.append(starts_ms[1])
+    # The second window fails so the file is left raw for the resume to fetch the rest of and convert
+    assert main(args)
+    assert not load_manifest(test_filename)["converted"]
+    assert list(pd.read_csv(test_filename).sourcetimestamp) == starts_ms[:1]
+    failing.clear()
+    assert main(args + ["-r"])
+    assert load_manifest(test_filename)["converted"]
+    df = pd.read_csv(test_filename, index_col=0)
+    assert list(df.sourcetimestamp) == [pd.Timestamp(start).tz_convert("Australia/Sydney").strftime("%Y-%m-%d %H:%M:%S")
+                                        for start in starts]
+    del os.environ["TOKEN"]
+    httpretty.disable()
+    httpretty.reset()
+
+
+def test_main_sync(tmpdir):
+    tmpdir = str(tmpdir)
+    test_filename = os.path.join(tmpdir, 'temp.csv')
+    start_times = []
+
+    def history_callback(request, uri, response_headers):
+        start_times.append(int(request.querystring["startTime"][0]))
+        return [200, response_headers, 'tenantid,macaddress,sourcetimestamp\n16655,9c:ff:d0:aa:50:ff,1589086604182\n']
+
+    httpretty.enable()
+    httpretty.register_uri(httpretty.GET, URL, body=history_callback, content_type="text/csv")
+    start_str = (datetime.now(timezone.utc) - timedelta(hours=47)).isoformat()
+    os.environ["TOKEN"] = "TEST_TOKEN"
+    assert main(["-st", start_str, "-f", test_filename, "-nc", "--sync"])
+    assert len(start_times) == 2
+    state = load_sync_state(test_filename)
+    assert state["rows"] == 2
+    # The next run starts where the last one finished, whatever the start time says, and appends to the file
+    assert main(["-st", start_str, "-f", test_filename, "-nc", "--sync"])
+    assert start_times[2] == state["end_ms"]
+    assert len(start_times) == 3
+    assert load_sync_state(test_filename)["rows"] == 3
+    df = pd.read_csv(test_filename)
+    assert df.shape == (3, 3)
+    assert list(df.sourcetimestamp) == [1589086604182] * 3
+    assert sorted(os.listdir(tmpdir)) == ["temp.csv", "temp.csv.sync.json"]
+    # Nothing is appended and the mark stays put when a window fails
+    httpretty.reset()
+    httpretty.register_uri(httpretty.GET, URL, status=400)
+    state = load_sync_state(test_filename)
+    main(["-f", test_filename, "-nc", "--sync"])
+    assert load_sync_state(test_filename) == state
+    assert pd.read_csv(test_filename).shape == (3, 3)
+    # A sync paused for longer than DNA Spaces keeps the history starts again from as far back as it can
+    httpretty.reset()
+    httpretty.register_uri(httpretty.GET, URL, body=history_callback, content_type="text/csv")
+    state["end"] = (datetime.now(timezone.utc) - timedelta(days=31)).isoformat()
+    save_sync_state(state, test_filename)
+    assert main(["-f", test_filename, "-nc", "--sync"])
+    state = load_sync_state(test_filename)
+    assert state["rows"] == 3 + 30
+    assert datetime.fromisoformat(state["end"]) > datetime.now(timezone.utc) - timedelta(hours=1)
+    del os.environ["TOKEN"]
+    httpretty.disable()
+    httpretty.reset()
+
+
+def test_main_filtered(tmpdir):
+    tmpdir = str(tmpdir)
+    test_filename = os.path.join(tmpdir, 'temp.csv')
+    httpretty.enable()
+    httpretty.register_uri(
+        httpretty.GET,
+        URL,
+        body='tenantid,macaddress,floorid,ssid,sourcetimestamp,firstactiveat,changedon\n'
+             '16655,9c:ff:d0:aa:50:ff,floor1,Test-WiFi,1589086604182,1589072492071,1589086604182\n'
+             '16655,9c:ff:d0:aa:50:ee,floor2,Test-WiFi,1589086604183,1589072492071,1589086604182\n'
+             '16655,9c:ff:d0:aa:50:dd,floor1,Other,1589086604184,1589072492071,1589086604182\n',
+        status=200,
+        content_type="text/csv",
+    )
+    end = datetime.now(timezone.utc)
+    start_str = (end - timedelta(hours=12)).isoformat()
+    os.environ["TOKEN"] = "TEST_TOKEN"
+    assert main(["-st", start_str, "-f", test_filename, "-nc", "--floor", "floor1", "--ssid", "Test-WiFi",
+                 "--columns", "macaddress,sourcetimestamp"])
+    df = pd.read_csv(test_filename)
+    assert list(df.columns) == ["macaddress", "sourcetimestamp"]
+    assert list(df.macaddress) == ["9c:ff:d0:aa:50:ff"]
+    assert load_manifest(test_filename)["windows"][0]["last_sourcetimestamp"] == "1589086604184"
+    # The rows are the rows written, not the rows received
+    assert load_manifest(test_filename)["windows"][0]["rows"] == 1
+    assert main(["-st", start_str, "-f", test_filename, "-s", "-tz", "Australia/Sydney", "--floor", "floor1",
+                 "-w", "2"])
+    df = pd.read_csv(test_filename)
+    assert list(df.macaddress) == ["9c:ff:d0:aa:50:ff", "9c:ff:d0:aa:50:dd"]
+    assert sum(window["rows"] for window in load_manifest(test_filename)["windows"]) == 2
+    assert list(df.sourcetimestamp) == ["2020-05-10 14:56:44"] * 2
+    del os.environ["TOKEN"]
+    httpretty.disable()
+    httpretty.reset()
+
+
+def test_main_filtered_site_timezones(tmpdir):
+    tmpdir = str(tmpdir)
+    test_filename = os.path.join(tmpdir, 'temp.csv')
+    site_filename = os.path.join(tmpdir, 'sites.json')
+    with open(site_filename, "w") as f:
+        json.dump({"buildings": {"building2": "Pacific/Auckland"}}, f)
+    httpretty.enable()
+    httpretty.register_uri(
+        httpretty.GET,
+        URL,
+        body='tenantid,macaddress,buildingid,floorid,sourcetimestamp\n'
+             '16655,9c:ff:d0:aa:50:ff,building1,floor1,1589086604182\n'
+             '16655,9c:ff:d0:aa:50:ee,building2,floor1,1589086604182\n',
+        status=200,
+        content_type="text/csv",
+    )
+    start_str = (datetime.now(timezone.utc) - timedelta(hours=12)).isoformat()
+    os.environ["TOKEN"] = "TEST_TOKEN"
+    # The buildingid left out by --columns is still read to find the time zone of each row, whether the rows are
+    # converted as they stream in or afterwards
+    for stream in [["-s"], []]:
+        assert main(["-st", start_str, "-f", test_filename, "-tz", "Australia/Sydney", "-stz", site_filename,
+                     "--columns", "macaddress,sourcetimestamp"] + stream)
+        df = pd.read_csv(test_filename, index_col=None if stream else 0)
+        assert list(df.columns) == ["macaddress", "sourcetimestamp"]
+        assert list(df.sourcetimestamp) == ["2020-05-10 14:56:44", "2020-05-10 16:56:44"]
     del os.environ["TOKEN"]
     httpretty.disable()
     httpretty.reset()
@@ -134,3 +563,26 @@ def test_valid_date():
     assert valid_date(datetime.now())
     assert valid_date("not date") is False
 
+
+
+# Most seconds the imports of a run with -nc may take. Without pandas and numpy they take about a fifth of this.
+NO_CONVERT_IMPORT_BUDGET_SECONDS = 0.6
+
+
+def test_no_convert_import_time(tmpdir):
+    from history_mock_server import MockHistoryServer
+    script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "dnaspaces_get_history.py")
+    end = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0) - timedelta(hours=1)
+    with MockHistoryServer(rows_per_hour=100) as server:
+        env = dict(os.environ, DNASPACES_URL=server.url, TOKEN="TEST_TOKEN")
+        result = subprocess.run([sys.executable, "-X", "importtime", script, "-nc", "-st",
+                                 (end - timedelta(hours=1)).isoformat(), "-et", end.isoformat(), "-f", "temp.csv"],
+                                cwd=str(tmpdir), env=env, capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0
+    assert len(pd.read_csv(os.path.join(str(tmpdir), "temp.csv"))) == 100
+    # Lines are "import time: self | cumulative | package", with nested imports indented under their parent
+    imports = [line.split("|") for line in result.stderr.splitlines() if line.startswith("import time:")][1:]
+    modules = [name.strip() for (_, _, name) in imports]
+    assert not [module for module in modules if module.split(".")[0] in ["pandas", "numpy", "pyarrow"]]
+    seconds = sum(int(cumulative) for (_, cumulative, name) in imports if not name.startswith("  ")) / 1e6
+    assert seconds < NO_CONVERT_IMPORT_BUDGET_SECONDS
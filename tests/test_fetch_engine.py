@@ -0,0 +1,60 @@
+from fetch_engine import write_response_blocks
+import io
+import requests
+
+
+class BlockResponse:
+    # Stands in for a streamed requests response, handing back the body in fixed size blocks
+    def __init__(self, body, block_size, error=None):
+        self.body = body
+        self.block_size = block_size
+        self.error = error
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.body), self.block_size):
+            yield self.body[i:i + self.block_size]
+        if self.error is not None:
+            raise self.error
+
+
+def test_write_response_blocks():
+    body = b"tenantid,macaddress,sourcetimestamp\n16655,9c:ff:d0:aa:50:ff,1589086604182\n" \
+           b"16655,9c:ff:d0:aa:50:fe,1589086604183\n"
+    for block_size in [1, 7, 36, 37, len(body)]:
+        f = io.BytesIO()
+        stats = write_response_blocks(BlockResponse(body, block_size), f, True)
+        assert f.getvalue() == body
+        assert stats["lines"] == 3
+        assert stats["bytes"] == len(body) - len(b"tenantid,macaddress,sourcetimestamp\n")
+        assert stats["header"] == "tenantid,macaddress,sourcetimestamp"
+        assert stats["last_line"] == "16655,9c:ff:d0:aa:50:fe,1589086604183"
+        assert stats["complete"]
+        f = io.BytesIO()
+        write_response_blocks(BlockResponse(body, block_size), f, False)
+        assert f.getvalue() == body[len(b"tenantid,macaddress,sourcetimestamp\n"):]
+
+
+def test_write_response_blocks_newline():
+    f = io.BytesIO()
+    stats = write_response_blocks(BlockResponse(b"tenantid,sourcetimestamp\n16655,1589086604182", 5), f, False)
+    assert f.getvalue() == b"16655,1589086604182\n"
+    assert stats["lines"] == 2
+    assert stats["bytes"] == len(f.getvalue())
+    f = io.BytesIO()
+    stats = write_response_blocks(BlockResponse(b"tenantid,sourcetimestamp", 5), f, True)
+    assert f.getvalue() == b"tenantid,sourcetimestamp\n"
+    assert stats["lines"] == 1
+    assert stats["bytes"] == 0
+
+
+def test_write_response_blocks_broken_stream():
+    body = b"tenantid,sourcetimestamp\n16655,1589086604182\n16655,15890"
+    f = io.BytesIO()
+    stats = write_response_blocks(BlockResponse(body, 10, requests.exceptions.ChunkedEncodingError("broken")), f,
+                                  True)
+    assert not stats["complete"]
+    # The row that was cut off is not written and the last line is the last whole row
+    assert f.getvalue() == b"tenantid,sourcetimestamp\n16655,1589086604182\n"
+    assert stats["lines"] == 2
+    assert stats["bytes"] == len(b"16655,1589086604182\n")
+    assert stats["last_line"] == "16655,1589086604182"
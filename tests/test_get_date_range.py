@@ -1,9 +1,10 @@
 import pytest
 from datetime import datetime, timedelta, timezone
-from get_date_range import valid_time, split_dates, add_timezone, convert_timestamp_millisecond, get_date_range
+from get_date_range import valid_time, split_dates, add_timezone, convert_timestamp_millisecond, get_date_range, \
+    bisect_window, merge_windows
 from tzlocal import get_localzone
 import pytz
-from constants import MAX_DAYS, HOURLY_TIME_CHUNK_SIZE
+from constants import MAX_DAYS, HOURLY_TIME_CHUNK_SIZE, MIN_HOURLY_TIME_CHUNK_SIZE
 import time
 
 
@@ -31,6 +32,37 @@ def test_split_dates():
     assert len(split_dates(start, end)) == 10*(24/HOURLY_TIME_CHUNK_SIZE)
     assert split_dates(start, end)[0] == (start, start + timedelta(hours=HOURLY_TIME_CHUNK_SIZE))
     assert split_dates(start, end)[-1] == (start + timedelta(days=9, hours=24-HOURLY_TIME_CHUNK_SIZE), end)
+    # Aligned windows are the same for runs with different start times apart from the first one
+    aligned = split_dates(start, end, aligned=True)
+    later = split_dates(start + timedelta(hours=5), end, aligned=True)
+    assert aligned[0][0] == start and aligned[-1][1] == end
+    assert all(window_end == next_start for ((_, window_end), (next_start, _)) in zip(aligned, aligned[1:]))
+    assert aligned[1][0].timestamp() % (HOURLY_TIME_CHUNK_SIZE * 3600) == 0
+    assert later[1:] == [window for window in aligned if window[0] >= later[1][0]]
+    sydney = pytz.timezone("Australia/Sydney")
+    local_start = start.astimezone(sydney)
+    assert split_dates(local_start, end, aligned=True)[1][0] == aligned[1][0]
+    assert split_dates(local_start, end, aligned=True)[1][0].tzinfo.zone == "Australia/Sydney"
+
+
+def test_bisect_window():
+    end = datetime.now(timezone.utc)
+    start = end - timedelta(days=1)
+    halves = bisect_window(start, end)
+    assert halves == [(start, start + timedelta(hours=12)), (start + timedelta(hours=12), end)]
+    small_start = end - timedelta(hours=MIN_HOURLY_TIME_CHUNK_SIZE)
+    assert bisect_window(small_start, end) == [(small_start, end)]
+
+
+def test_merge_windows():
+    end = datetime.now(timezone.utc)
+    middle = end - timedelta(hours=6)
+    start = end - timedelta(hours=12)
+    assert merge_windows((start, middle), (middle, end)) == [(start, end)]
+    assert merge_windows((start, middle - timedelta(hours=1)), (middle, end)) == \
+        [(start, middle - timedelta(hours=1)), (middle, end)]
+    long_start = end - timedelta(hours=HOURLY_TIME_CHUNK_SIZE + 1)
+    assert merge_windows((long_start, middle), (middle, end)) == [(long_start, middle), (middle, end)]
 
 
 def test_add_timezone():
@@ -0,0 +1,65 @@
+from history_cache import HistoryCache, CachedResponse, get_tenant_key
+from time import time
+import requests
+import pytest
+import os
+
+DAY_MS = 24 * 60 * 60 * 1000
+
+
+def live_response(body, error=None):
+    def blocks(chunk_size):
+        for i in range(0, len(body), chunk_size):
+            yield body[i:i + chunk_size]
+        if error is not None:
+            raise error
+    return CachedResponse(blocks)
+
+
+def test_get_tenant_key():
+    assert get_tenant_key("TEST_TOKEN") == get_tenant_key("TEST_TOKEN")
+    assert get_tenant_key("TEST_TOKEN") != get_tenant_key("OTHER_TOKEN")
+    assert "TEST_TOKEN" not in get_tenant_key("TEST_TOKEN")
+
+
+def test_history_cache(tmpdir):
+    cache = HistoryCache(str(tmpdir), 1024)
+    end_ms = int(time() * 1000) - DAY_MS
+    payload = {"startTime": end_ms - DAY_MS, "endTime": end_ms}
+    body = b"tenantid,sourcetimestamp\n16655,1589086604182\n16655,1589086604183\n"
+    assert cache.get_response("tenant", payload) is None
+    response = cache.store_response("tenant", payload, live_response(body))
+    assert list(response.iter_lines(chunk_size=7)) == body.splitlines()
+    assert b"".join(cache.get_response("tenant", payload).iter_content(5)) == body
+    assert cache.get_response("other", payload) is None
+    # A broken stream is never cached
+    payload = {"startTime": end_ms, "endTime": end_ms + DAY_MS // 2}
+    response = cache.store_response("tenant", payload, live_response(body, requests.exceptions.ChunkedEncodingError()))
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        list(response.iter_content(8))
+    assert cache.get_response("tenant", payload) is None
+    assert [f for f in os.listdir(os.path.join(str(tmpdir), "tenant")) if f.endswith(".tmp")] == []
+    # Windows that ended only recently are not cached
+    payload = {"startTime": int(time() * 1000) - DAY_MS, "endTime": int(time() * 1000)}
+    response = live_response(body)
+    assert cache.store_response("tenant", payload, response) is response
+
+
+def test_history_cache_evict(tmpdir):
+    body = b"x" * 100
+    cache = HistoryCache(str(tmpdir), 300)
+    now_ms = int(time() * 1000)
+    old = {"startTime": now_ms - 60 * DAY_MS, "endTime": now_ms - 59 * DAY_MS}
+    first = {"startTime": now_ms - 3 * DAY_MS, "endTime": now_ms - 2 * DAY_MS}
+    second = {"startTime": now_ms - 2 * DAY_MS, "endTime": now_ms - DAY_MS}
+    for (payload, mtime) in [(old, 1), (first, 2), (second, 3)]:
+        list(cache.store_response("tenant", payload, live_response(body)).iter_content(64))
+        os.utime(cache.get_window_filename("tenant", payload), (mtime, mtime))
+    # Using the first window makes the second the least recently used. The old window cannot be fetched again so it
+    # is kept even though it was used longest ago.
+    cache.get_response("tenant", first)
+    cache.max_bytes = 250
+    cache.evict()
+    assert cache.get_response("tenant", old) is not None
+    assert cache.get_response("tenant", first) is not None
+    assert cache.get_response("tenant", second) is None
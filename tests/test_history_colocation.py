@@ -0,0 +1,94 @@
+from history_colocation import colocate_history, neighbour_pairs, merge_contacts, cell_keys
+import numpy as np
+import pandas as pd
+import os
+
+
+def test_neighbour_pairs():
+    floors = np.array([0, 0, 0, 1, 0, 0], dtype="int64")
+    keys = cell_keys(floors, np.array([0.5, 1.5, 4.5, 0.5, 0.5, 0.5]), np.array([0.5] * 6), 1.0)
+    slices = np.array([5, 5, 5, 5, 4, 7], dtype="int64")
+    (i, j) = neighbour_pairs(keys[:1], slices[:1], keys, slices)
+    # Same cell and the next cell on the same floor, not two cells away or on another floor, and in the same or the
+    # previous time slice, not two slices later
+    assert sorted(j) == [0, 1, 4]
+
+
+def test_merge_contacts():
+    contacts = pd.DataFrame({"mac_a": ["a"] * 3, "mac_b": ["b"] * 3, "floor": ["floor1"] * 3,
+                             "start": [0, 50000, 200000], "end": [10000, 60000, 200000], "sightings": [1, 1, 1]})
+    merged = merge_contacts(contacts, 60000)
+    assert list(merged["start"]) == [0, 200000]
+    assert list(merged["end"]) == [60000, 200000]
+    assert list(merged["sightings"]) == [2, 1]
+
+
+def brute_force_pairs(df, radius, tolerance_ms):
+    pairs = set()
+    sightings = 0
+    rows = list(df.itertuples(index=False))
+    for (a, row_a) in enumerate(rows):
+        for row_b in rows[:a]:
+            if row_a.macaddress != row_b.macaddress and row_a.floorid == row_b.floorid and \
+                    abs(row_a.sourcetimestamp - row_b.sourcetimestamp) <= tolerance_ms and \
+                    np.hypot(row_a.coordinatex - row_b.coordinatex, row_a.coordinatey - row_b.coordinatey) <= radius:
+                pairs.add(tuple(sorted([row_a.macaddress, row_b.macaddress])))
+                sightings += 1
+    return pairs, sightings
+
+
+def test_colocate_history(tmpdir, monkeypatch):
+    # Small chunks so contacts and kept rows carry over between chunks
+    monkeypatch.setattr("history_colocation.CONVERT_FILE_CHUNK_SIZE", 37)
+    rng = np.random.default_rng(1)
+    n = 400
+    df = pd.DataFrame({"macaddress": [f"00:00:00:00:00:{i:02x}" for i in rng.integers(0, 30, n)],
+                       "floorid": rng.choice(["floor1", "floor2"], n),
+                       "coordinatex": rng.uniform(0, 20, n).round(2),
+                       "coordinatey": rng.uniform(0, 20, n).round(2),
+                       "sourcetimestamp": 1589086604182 + np.sort(rng.integers(0, 3600000, n))})
+    data_file = os.path.join(str(tmpdir), "temp.csv")
+    out_file = os.path.join(str(tmpdir), "contacts.csv")
+    df.to_csv(data_file, index=False)
+    (total, skipped) = colocate_history(data_file, out_file, "Australia/Sydney", radius=2.0, tolerance_seconds=60)
+    assert skipped == 0
+    contacts = pd.read_csv(out_file)
+    assert len(contacts) == total
+    (pairs, sightings) = brute_force_pairs(df, 2.0, 60000)
+    assert set(zip(contacts.macaddress_a, contacts.macaddress_b)) == pairs
+    assert contacts.sightings.sum() == sightings
+    assert (contacts.duration_seconds >= 0).all()
+    # Contacts of one pair never overlap or come within the tolerance of each other
+    for (_, pair) in contacts.groupby(["macaddress_a", "macaddress_b", "floorid"]):
+        starts = pd.to_datetime(pair.start).sort_values()
+        ends = pd.to_datetime(pair.end)[starts.index]
+        assert ((starts.values[1:] - ends.values[:-1]) > np.timedelta64(60, "s")).all()
+    mac = df.macaddress[0]
+    assert colocate_history(data_file, out_file, "Australia/Sydney", 2.0, 60, mac)[0] > 0
+    contacts = pd.read_csv(out_file)
+    assert ((contacts.macaddress_a == mac) | (contacts.macaddress_b == mac)).all()
+
+
+def test_colocate_history_out_of_order(tmpdir, monkeypatch):
+    monkeypatch.setattr("history_colocation.CONVERT_FILE_CHUNK_SIZE", 37)
+    rng = np.random.default_rng(2)
+    n = 400
+    df = pd.DataFrame({"macaddress": [f"00:00:00:00:00:{i:02x}" for i in rng.integers(0, 10, n)],
+                       "floorid": "floor1",
+                       "coordinatex": rng.uniform(0, 5, n).round(2),
+                       "coordinatey": rng.uniform(0, 5, n).round(2),
+                       "sourcetimestamp": 1589086604182 + np.sort(rng.integers(0, 3600000, n))})
+    # Row 50 turns up three chunks late, further out of order than any row before it. Row 150 then turns up nearly as
+    # late, which the kept rows now reach back to.
+    order = list(range(n))
+    for (row, position) in [(50, 160), (150, 220)]:
+        order.remove(row)
+        order.insert(position, row)
+    data_file = os.path.join(str(tmpdir), "temp.csv")
+    out_file = os.path.join(str(tmpdir), "contacts.csv")
+    df.iloc[order].to_csv(data_file, index=False)
+    (total, skipped) = colocate_history(data_file, out_file, "Australia/Sydney", radius=2.0, tolerance_seconds=60)
+    assert skipped == 1
+    contacts = pd.read_csv(out_file)
+    (pairs, sightings) = brute_force_pairs(df.drop(index=50), 2.0, 60000)
+    assert contacts.sightings.sum() == sightings
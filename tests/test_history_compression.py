@@ -0,0 +1,32 @@
+from history_compression import get_compression, strip_compression_extension, compress_stream, open_history, \
+    check_compression
+import pytest
+import os
+
+
+def test_get_compression():
+    assert get_compression("history.csv.gz") == "gzip"
+    assert get_compression("history.csv.ZST") == "zstd"
+    assert get_compression("history.csv") is None
+    assert strip_compression_extension("history.csv.gz") == "history.csv"
+    assert strip_compression_extension("history.csv") == "history.csv"
+    assert check_compression("history.csv.gz")
+
+
+@pytest.mark.parametrize("extension", [".csv", ".csv.gz", ".csv.zst"])
+def test_compress_stream(tmpdir, extension):
+    if extension == ".csv.zst":
+        pytest.importorskip("zstandard")
+    test_filename = os.path.join(str(tmpdir), "temp" + extension)
+    # One member or frame per window, concatenated in the same file, reads back as a single stream
+    with open(test_filename, "wb") as f:
+        for window in range(3):
+            with compress_stream(f, get_compression(test_filename)) as out:
+                out.write(f"line{window}\n".encode())
+        assert not f.closed
+    with open_history(test_filename, "rt") as f:
+        assert f.read() == "line0\nline1\nline2\n"
+    with open_history(test_filename, "wt", level=1) as f:
+        f.write("tenantid,sourcetimestamp\r\n")
+    with open_history(test_filename) as f:
+        assert f.readline() == b"tenantid,sourcetimestamp\r\n"
@@ -0,0 +1,103 @@
+from history_daemon import HistoryDaemon, load_jobs, export_arguments, FINISHED, FAILED
+from history_mock_server import MockHistoryServer
+from datetime import datetime, timedelta, timezone
+from time import sleep
+import pandas as pd
+import requests
+import json
+import os
+
+AUTH = {"Authorization": "Bearer TEST_DAEMON_TOKEN"}
+
+
+def wait_for_run(daemon, run_id):
+    for _ in range(200):
+        run = requests.get(f"{daemon.url}/runs/{run_id}", headers=AUTH).json()
+        if run["state"] in [FINISHED, FAILED]:
+            return run
+        sleep(0.05)
+    raise AssertionError(f"Run {run_id} did not finish.")
+
+
+def test_load_jobs(tmpdir):
+    jobs_file = os.path.join(str(tmpdir), "jobs.json")
+    with open(jobs_file, "w") as f:
+        json.dump({"jobs": [{"name": "sydney", "args": ["-f", "sydney.csv", "--sync"], "every_minutes": 15},
+                            {"name": "bad", "args": ["--no_such_option"]},
+                            {"name": "auckland", "args": ["-f", "auckland.csv"]}]}, f)
+    jobs = load_jobs(jobs_file)
+    assert [job["name"] for job in jobs] == ["sydney", "auckland"]
+    assert [job["every_minutes"] for job in jobs] == [15, 5]
+    assert load_jobs(os.path.join(str(tmpdir), "missing.json")) == []
+
+
+def test_export_arguments(tmpdir):
+    export_dir = str(tmpdir)
+    (cmd_args, error) = export_arguments(["-f", "export.csv", "-mj", "reports/metrics.json"], export_dir)
+    assert error is None
+    assert cmd_args.filename == os.path.join(os.path.realpath(export_dir), "export.csv")
+    assert cmd_args.metrics_json == os.path.join(os.path.realpath(export_dir), "reports", "metrics.json")
+    (cmd_args, error) = export_arguments(["-nc"], export_dir)
+    assert error is None and os.path.dirname(cmd_args.filename) == os.path.realpath(export_dir)
+    # Nothing is written outside the export directory
+    for args in [["-f", "../export.csv"], ["-f", "/etc/passwd"], ["-f", "export.csv", "-mp", "/tmp/history.prom"],
+                 ["-f", "export.csv", "-cd", ".."], ["-t", "tenants.json"]]:
+        assert export_arguments(args, export_dir)[1] is not None
+    assert export_arguments(["-f", "export.csv"], None)[1] is not None
+    assert export_arguments("-f export.csv", export_dir)[1] is not None
+
+
+def test_history_daemon(tmpdir, monkeypatch):
+    sync_file = os.path.join(str(tmpdir), "sync.csv")
+    export_dir = os.path.join(str(tmpdir), "exports")
+    os.mkdir(export_dir)
+    export_file = os.path.join(export_dir, "export.csv")
+    end = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0) - timedelta(hours=1)
+    start = end - timedelta(hours=2)
+    jobs = [{"name": "sync", "args": ["-st", start.isoformat(), "-f", sync_file, "-nc", "--sync"],
+             "every_minutes": 60}]
+    with MockHistoryServer(rows_per_hour=100) as server:
+        monkeypatch.setenv("DNASPACES_URL", server.url)
+        monkeypatch.setenv("TOKEN", "TEST_TOKEN")
+        with HistoryDaemon(jobs, "TEST_DAEMON_TOKEN", port=0, export_dir=export_dir) as daemon:
+            # The job runs as soon as the daemon starts
+            status = requests.get(f"{daemon.url}/status", headers=AUTH).json()
+            assert [job["name"] for job in status["jobs"]] == ["sync"]
+            run = wait_for_run(daemon, 1)
+            assert run["state"] == FINISHED and run["fetched"]
+            assert run["metrics"]["convert"]["rows"] == 0
+            # An ad-hoc export runs on the same session
+            response = requests.post(f"{daemon.url}/exports", headers=AUTH,
+                                     json={"args": ["-st", start.isoformat(), "-et", end.isoformat(), "-f",
+                                                    "export.csv", "-tz", "Australia/Sydney"]})
+            assert response.status_code == 202
+            run = wait_for_run(daemon, response.json()["id"])
+            assert run["state"] == FINISHED
+            assert run["metrics"]["convert"]["rows"] == 200
+            assert len(daemon.clients.clients) == 1
+            # Starting the job again only fetches the time since its last run
+            response = requests.post(f"{daemon.url}/jobs/sync/run", headers=AUTH)
+            assert response.status_code == 202
+            run = wait_for_run(daemon, response.json()["id"])
+            assert run["state"] == FINISHED and run["job"] == "sync"
+            assert requests.post(f"{daemon.url}/jobs/missing/run", headers=AUTH).status_code == 404
+            assert requests.post(f"{daemon.url}/exports", headers=AUTH,
+                                 json={"args": ["--no_such_option"]}).status_code == 400
+            assert requests.post(f"{daemon.url}/exports", headers=AUTH,
+                                 json={"args": ["-f", sync_file]}).status_code == 400
+            assert requests.get(f"{daemon.url}/runs/99", headers=AUTH).status_code == 404
+            # Requests without the token, or exports without a JSON content type, are turned away
+            assert requests.get(f"{daemon.url}/status").status_code == 401
+            assert requests.post(f"{daemon.url}/jobs/sync/run",
+                                 headers={"Authorization": "Bearer wrong"}).status_code == 401
+            body = json.dumps({"args": ["-f", "export.csv"]})
+            assert requests.post(f"{daemon.url}/exports", data=body,
+                                 headers={"Content-Type": "text/plain"}).status_code == 401
+            assert requests.post(f"{daemon.url}/exports", data=body,
+                                 headers=dict(AUTH, **{"Content-Type": "text/plain"})).status_code == 415
+            assert [run["id"] for run in requests.get(f"{daemon.url}/status", headers=AUTH).json()["runs"]] == \
+                [1, 2, 3]
+    assert len(pd.read_csv(sync_file)) >= 200
+    df = pd.read_csv(export_file)
+    assert len(df) == 200
+    assert df.sourcetimestamp.str.startswith("20").all()
@@ -0,0 +1,50 @@
+from history_dedup import RecentRows, key_indexes, row_key
+
+
+def test_key_indexes():
+    assert key_indexes("tenantid,macaddress,floorid,sourcetimestamp") == [1, 3, 2]
+    assert key_indexes("tenantid,macaddress,sourcetimestamp") is None
+
+
+def test_row_key():
+    indexes = key_indexes("ipaddress,macaddress,sourcetimestamp,floorid,ssid")
+    line = b'"10.10.10.10, fe80::1",9c:ff:d0:aa:50:ff,1589086604182,floor1,Test-WiFi'
+    assert row_key(line, indexes, 3) == (b"9c:ff:d0:aa:50:ff", b"1589086604182", b"floor1")
+    assert row_key(b"10.10.10.10,9c:ff:d0:aa:50:ff,1589086604182,floor1", indexes, 3) == row_key(line, indexes, 3)
+    assert row_key(b"10.10.10.10,9c:ff:d0:aa:50:ff", indexes, 3) is None
+
+
+def test_recent_rows():
+    indexes = key_indexes("macaddress,sourcetimestamp,floorid")
+    lines = [f"mac{i},{1589086000000 + i},floor1".encode() for i in range(10)]
+    recent = RecentRows(size=5)
+    first = recent.start_window({"start_ms": 1589080000000, "end_ms": 1589082000000})
+    assert recent.drop_repeats(indexes, lines[:5] + lines[:1], first) == (lines[:5], 1)
+    recent.finish_window(first)
+    # Only the last 5 rows of a window are remembered, so the first row is no longer a repeat once two more are seen
+    second = recent.start_window({"start_ms": 1589087000000, "end_ms": 1589088000000})
+    assert recent.drop_repeats(indexes, lines[:7] + lines[6:7], second) == (lines[:7], 1)
+    assert recent.drop_repeats(indexes, lines[1:2] + lines[6:7], second) == (lines[1:2], 1)
+    assert recent.drop_repeats(indexes, [b"short,line"], second) == ([b"short,line"], 0)
+    assert recent.drop_repeats(None, lines[6:8], second) == (lines[6:8], 0)
+    assert len(recent.windows[second]["seen"]) == len(recent.windows[second]["order"]) == 5
+    recent.finish_window(second)
+    assert recent.windows == {}
+
+
+def test_recent_rows_edges():
+    indexes = key_indexes("macaddress,sourcetimestamp,floorid")
+    lines = [f"mac{i},{1589086000000 + i * 400},floor1".encode() for i in range(10)]
+    recent = RecentRows(size=1)
+    # The rows within a second of the shared edge are repeats in the next window however many rows come in between
+    first = recent.start_window({"start_ms": 1589085000000, "end_ms": 1589086000000})
+    assert recent.drop_repeats(indexes, lines, first) == (lines, 0)
+    second = recent.start_window({"start_ms": 1589086000000, "end_ms": 1589087000000})
+    assert recent.drop_repeats(indexes, lines[::-1], second) == (lines[:2:-1], 3)
+    # The rows of a window that is thrown away are kept when it is fetched again
+    recent.discard(first)
+    third = recent.start_window({"start_ms": 1589085000000, "end_ms": 1589086000000})
+    assert recent.drop_repeats(indexes, lines[:3], third) == (lines[:3], 0)
+    recent.discard(third)
+    assert recent.drop_repeats(indexes, lines[:3], recent.start_window(
+        {"start_ms": 1589085500000, "end_ms": 1589086000000})) == (lines[:3], 0)
@@ -0,0 +1,77 @@
+from history_dwell import dwell_history, merge_segments
+from history_store import timestamp_ms
+import numpy as np
+import pandas as pd
+import os
+
+
+def test_merge_segments():
+    pieces = pd.DataFrame({"mac": ["a"] * 4 + ["b"], "building": ["b1"] * 5,
+                           "floor": ["floor1", "floor1", "floor1", "floor2", "floor1"],
+                           "start": [0, 10000, 20000, 30000, 0], "end": [0, 10000, 20000, 30000, 0],
+                           "sum_x": [1.0, 1.5, 9.0, 9.0, 1.0], "sum_y": [1.0] * 5, "samples": [1] * 5})
+    for axis in ["x", "y"]:
+        pieces[f"first_{axis}"] = pieces[f"sum_{axis}"]
+        pieces[f"last_{axis}"] = pieces[f"sum_{axis}"]
+    segments = merge_segments(pieces, radius=1.0, gap_ms=60000)
+    # a dwells at 1,1 then moves away, then changes floor. b is on its own.
+    assert list(segments["samples"]) == [2, 1, 1, 1]
+    assert list(segments["end"]) == [10000, 20000, 30000, 0]
+    assert segments["sum_x"][0] / segments["samples"][0] == 1.25
+    # Pieces further apart than the gap are separate segments
+    assert len(merge_segments(pieces[:2], radius=1.0, gap_ms=5000)) == 2
+
+
+def brute_force_segments(df, radius, gap_ms):
+    segments = []
+    for (mac, rows) in df.sort_values(["macaddress", "sourcetimestamp"], kind="stable").groupby("macaddress"):
+        previous = None
+        for row in rows.itertuples(index=False):
+            if previous is None or row.floorid != previous.floorid or \
+                    row.sourcetimestamp - previous.sourcetimestamp > gap_ms or \
+                    np.hypot(row.coordinatex - previous.coordinatex, row.coordinatey - previous.coordinatey) > radius:
+                segments.append([mac, row.floorid, row.sourcetimestamp, 0])
+            segments[-1][3] += 1
+            previous = row
+    return sorted((mac, floor, start, samples) for (mac, floor, start, samples) in segments)
+
+
+def test_dwell_history(tmpdir, monkeypatch):
+    # Small chunks so segments and occupancy intervals carry over between chunks
+    monkeypatch.setattr("history_dwell.CONVERT_FILE_CHUNK_SIZE", 37)
+    rng = np.random.default_rng(2)
+    n = 600
+    floors = rng.choice(["floor1", "floor2"], n)
+    df = pd.DataFrame({"macaddress": [f"00:00:00:00:00:{i:02x}" for i in rng.integers(0, 8, n)],
+                       "buildingid": "building1",
+                       "floorid": floors,
+                       # Mostly standing still with the odd move
+                       "coordinatex": np.where(rng.random(n) < 0.8, 5.0, rng.uniform(0, 20, n)).round(2),
+                       "coordinatey": 5.0,
+                       "sourcetimestamp": 1589086604182 + np.sort(rng.integers(0, 7200000, n))})
+    df.loc[floors == "floor2", "buildingid"] = "building2"
+    data_file = os.path.join(str(tmpdir), "temp.csv")
+    (dwell_file, floor_file, building_file) = [os.path.join(str(tmpdir), f"{name}.csv")
+                                               for name in ("dwell", "floors", "buildings")]
+    df.to_csv(data_file, index=False)
+    total = dwell_history(data_file, dwell_file, floor_file, building_file, "Australia/Sydney", radius=1.0,
+                          gap_seconds=300, interval_minutes=15)
+    segments = pd.read_csv(dwell_file, dtype={"start": str})
+    assert len(segments) == total
+    assert segments["samples"].sum() == n
+    assert (segments["duration_seconds"] >= 0).all()
+    starts = timestamp_ms(segments["start"], "Australia/Sydney")
+    expected = brute_force_segments(df, 1.0, 300000)
+    # Output times are to the second
+    assert sorted(zip(segments.macaddress, segments.floorid, starts, segments.samples)) == \
+           [(mac, floor, start // 1000 * 1000, samples) for (mac, floor, start, samples) in expected]
+
+    interval = (df["sourcetimestamp"] // 900000) * 900000
+    floor_counts = df.assign(interval=interval).groupby(["interval", "floorid"])["macaddress"].nunique()
+    floors_out = pd.read_csv(floor_file, dtype={"interval_start": str})
+    floors_out["interval"] = timestamp_ms(floors_out["interval_start"], "Australia/Sydney")
+    assert floors_out.set_index(["interval", "floorid"])["devices"].sort_index().equals(floor_counts)
+    building_counts = df.assign(interval=interval).groupby(["interval", "buildingid"])["macaddress"].nunique()
+    buildings_out = pd.read_csv(building_file, dtype={"interval_start": str})
+    buildings_out["interval"] = timestamp_ms(buildings_out["interval_start"], "Australia/Sydney")
+    assert buildings_out.set_index(["interval", "buildingid"])["devices"].sort_index().equals(building_counts)
@@ -0,0 +1,52 @@
+from history_filter import add_filter_arguments, get_history_filter, filter_lines, filter_frame, use_columns, \
+    download_filters
+from argparse import ArgumentParser
+import pandas as pd
+
+
+def get_filter(args):
+    parser = ArgumentParser()
+    add_filter_arguments(parser)
+    return get_history_filter(parser.parse_args(args))
+
+
+def test_get_history_filter():
+    assert get_filter([]) is None
+    history_filter = get_filter(["--floor", "floor1", "--floor", "floor2", "--mac", "9C:FF:D0:AA:50:FF",
+                                 "--columns", "macaddress,sourcetimestamp"])
+    assert history_filter["rows"] == {"floorid": {"floor1", "floor2"}, "macaddress": {"9c:ff:d0:aa:50:ff"}}
+    assert history_filter["columns"] == ["macaddress", "sourcetimestamp"]
+    assert get_filter(["--device-type", "CLIENT"])["rows"] == {"devicetype": {"CLIENT"}}
+
+
+def test_filter_lines():
+    history_filter = get_filter(["--floor", "floor1", "--ssid", "Test-WiFi"])
+    lines = [b"16655,floor1,Test-WiFi", b"16655,floor2,Test-WiFi", b"16655,floor1,Other", b"floor1,Test-WiFi,x"]
+    # The last line only matches on its bytes and is left for filter_frame to reject
+    assert filter_lines(history_filter, lines) == [lines[0], lines[3]]
+    assert filter_lines(None, lines) == lines
+
+
+def test_filter_frame():
+    history_filter = get_filter(["--floor", "floor1", "--columns", "macaddress,ssid"])
+    df = pd.DataFrame({"macaddress": ["a", "b", "c"], "floorid": ["floor1", "floor2", "xfloor1"],
+                       "ssid": ["x", "y", "z"], "tenantid": ["1", "1", "1"]})
+    usecols = use_columns(history_filter)
+    assert [col for col in df.columns if usecols(col)] == ["macaddress", "floorid", "ssid"]
+    filtered = filter_frame(df, history_filter)
+    assert list(filtered.columns) == ["macaddress", "ssid"]
+    assert list(filtered.macaddress) == ["a"]
+    assert len(filter_frame(df, get_filter(["--building", "building1"]))) == 0
+
+
+def test_download_filters():
+    history_filter = get_filter(["--floor", "floor1", "--columns", "macaddress,sourcetimestamp"])
+    usecols = use_columns(history_filter, ["buildingid", "campusid"])
+    assert [col for col in ["tenantid", "buildingid", "campusid", "floorid"] if usecols(col)] == \
+        ["buildingid", "campusid", "floorid"]
+    (download, convert) = download_filters(history_filter, ["buildingid", "campusid"])
+    assert download == {"columns": ["macaddress", "sourcetimestamp", "buildingid", "campusid"],
+                        "rows": {"floorid": {"floor1"}}}
+    assert convert == {"columns": ["macaddress", "sourcetimestamp"], "rows": {}}
+    assert download_filters(history_filter, []) == (history_filter, None)
+    assert download_filters(get_filter(["--floor", "floor1"]), ["buildingid"])[1] is None
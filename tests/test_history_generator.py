@@ -0,0 +1,44 @@
+from history_generator import build_model, generate_batches, write_history, int_field, decimal_field, join_fields
+from history_compression import open_history
+from convert_history import convert_history, history_dict
+import pandas as pd
+import os
+from io import BytesIO
+
+
+def test_join_fields():
+    line = join_fields([int_field([-52, 0, 1589086604182]), decimal_field([13.3026, 0.5, 299.99999])])
+    assert line == b"-52,13.3026\n0,0.5000\n1589086604182,300.0000\n"
+
+
+def test_generate_batches():
+    model = build_model(devices=300, floors=12, seed=1)
+    body = b"".join(generate_batches(1590019200000, 1590022800000, 5000, model, seed=1, batch_rows=1234))
+    df = pd.read_csv(BytesIO(body), keep_default_na=False, dtype=str)
+    assert list(df.columns) == list(history_dict)
+    assert len(df) == 5000
+    timestamps = df.sourcetimestamp.astype("int64")
+    assert timestamps.is_monotonic_increasing
+    assert timestamps.between(1590019200000, 1590022800000).all()
+    assert 250 < df.macaddress.nunique() <= 300
+    assert df.floorid.nunique() == 12
+    assert df.buildingid.nunique() == 3
+    # Zero timestamps and quoted values with commas in them
+    assert (df.firstactiveat == "0").any() and (df.changedon == "0").any()
+    assert df.ipaddress.str.contains(", fe80::").any()
+    assert df.manufacturer.isin(["Apple, Inc."]).any()
+    # A device mostly stays on its home floor
+    assert (df.groupby("macaddress").floorid.agg(lambda floors: floors.value_counts().iloc[0] / len(floors))
+            .mean() > 0.8)
+    # The same window, model and seed always give the same rows
+    assert body == b"".join(generate_batches(1590019200000, 1590022800000, 5000, model, seed=1, batch_rows=1234))
+
+
+def test_write_history(tmpdir):
+    test_filename = os.path.join(str(tmpdir), "temp.csv.gz")
+    assert write_history(test_filename, 1590019200000, 1590105600000, 2000, build_model(devices=50, floors=5)) > 0
+    assert convert_history(test_filename, "Australia/Sydney", False) == test_filename
+    with open_history(test_filename) as f:
+        df = pd.read_csv(f)
+    assert len(df) == 2000
+    assert df.sourcetimestamp.str.startswith("2020-05-2").all()
@@ -0,0 +1,44 @@
+from history_manifest import new_manifest, record_window, windows_to_fetch, window_times, last_sourcetimestamp, \
+    save_manifest, load_manifest, COMPLETE, INCOMPLETE, PENDING
+from datetime import datetime, timedelta, timezone
+import os
+
+
+def test_new_manifest():
+    end = datetime.now(timezone.utc)
+    start = end - timedelta(days=1)
+    manifest = new_manifest([(start, end)])
+    assert len(manifest["windows"]) == 1
+    assert manifest["windows"][0]["status"] == PENDING
+    assert window_times(manifest["windows"][0]) == (start, end)
+
+
+def test_last_sourcetimestamp():
+    header = "tenantid,macaddress,sourcetimestamp,ipaddress"
+    assert last_sourcetimestamp(header, '16655,9c:ff:d0:aa:50:ff,1589086604182,"10.10.10.10, fe80::1"') == \
+        "1589086604182"
+    assert last_sourcetimestamp(header, "") is None
+    assert last_sourcetimestamp("tenantid,macaddress", "16655,9c:ff:d0:aa:50:ff") is None
+
+
+def test_record_window():
+    end = datetime.now(timezone.utc)
+    manifest = new_manifest([(end - timedelta(days=2), end - timedelta(days=1)), (end - timedelta(days=1), end)])
+    stats = {"lines": 3, "bytes": 40, "header": "tenantid,sourcetimestamp", "last_line": "16655,1589086604182",
+             "complete": True}
+    record_window(manifest, manifest["windows"][0], stats, COMPLETE)
+    record_window(manifest, manifest["windows"][1], stats, INCOMPLETE)
+    assert manifest["header"] == "tenantid,sourcetimestamp"
+    assert manifest["windows"][0]["rows"] == 2
+    assert manifest["windows"][0]["bytes"] == 40
+    assert manifest["windows"][0]["last_sourcetimestamp"] == "1589086604182"
+    assert windows_to_fetch(manifest) == [manifest["windows"][1]]
+
+
+def test_save_manifest(tmpdir):
+    test_filename = os.path.join(str(tmpdir), 'temp.csv')
+    assert load_manifest(test_filename) is None
+    end = datetime.now(timezone.utc)
+    manifest = new_manifest([(end - timedelta(days=1), end)])
+    save_manifest(manifest, test_filename)
+    assert load_manifest(test_filename) == manifest
@@ -0,0 +1,20 @@
+from history_memory import parse_size, peak_rss_bytes, progress
+from argparse import ArgumentTypeError
+from time import perf_counter
+import pytest
+
+
+def test_parse_size():
+    assert parse_size("512MB") == 512 * 1024 ** 2
+    assert parse_size("2g") == 2 * 1024 ** 3
+    assert parse_size("1.5K") == 1536
+    assert parse_size("4096") == 4096
+    for value in ["", "MB", "0MB", "12TB", "-1GB"]:
+        with pytest.raises(ArgumentTypeError):
+            parse_size(value)
+
+
+def test_progress():
+    peak = peak_rss_bytes()
+    assert peak is None or peak > 0
+    assert "rows/s" in progress(100, perf_counter() - 1)
@@ -0,0 +1,73 @@
+from history_metrics import RunMetrics, run_metrics
+from history_mock_server import MockHistoryServer
+from dnaspaces_get_history import main
+from datetime import datetime, timedelta, timezone
+import json
+import os
+
+
+def test_run_metrics(tmpdir):
+    metrics = RunMetrics()
+    for (hour, ttfb) in enumerate([0.5, 0.1, 0.2]):
+        window = {"start": f"2020-05-25T0{hour}:00:00+00:00", "end": f"2020-05-25T0{hour + 1}:00:00+00:00"}
+        metrics.record_window("tenant1", window, {"status_code": 200, "complete": hour < 2, "ttfb": ttfb,
+                                                  "elapsed": 1.0, "bytes": 1000, "lines": 11, "retries": hour,
+                                                  "timeout_escalations": 0})
+    metrics.record_chunk("temp.csv", 30, 0.5)
+    report = metrics.report()
+    assert report["tenants"]["tenant1"]["windows"] == 3
+    assert report["tenants"]["tenant1"]["failed_windows"] == 1
+    assert report["tenants"]["tenant1"]["rows"] == 30
+    assert report["tenants"]["tenant1"]["retries"] == 3
+    assert report["convert"] == {"chunks": 1, "rows": 30, "seconds": 0.5, "rows_per_second": 60.0}
+    assert report["windows"][0]["start"] == "2020-05-25T00:00:00+00:00"
+    lines = metrics.prometheus_lines()
+    assert 'dnaspaces_history_fetch_rows{tenant="tenant1"} 30' in lines
+    assert 'dnaspaces_history_ttfb_seconds{tenant="tenant1",quantile="0.5"} 0.2' in lines
+    assert 'dnaspaces_history_ttfb_seconds_count{tenant="tenant1"} 3' in lines
+    assert "dnaspaces_history_convert_rows_per_second 60.0" in lines
+    textfile = os.path.join(str(tmpdir), "history.prom")
+    assert metrics.write_prometheus(textfile)
+    assert not os.path.exists(textfile + ".tmp")
+    with open(textfile) as f:
+        written = f.read().splitlines()
+    # Everything but what depends on how long the run has taken is the same
+    timed = ("dnaspaces_history_fetch_rows_per_second{", "dnaspaces_history_run_", "dnaspaces_history_last_run_")
+    assert [line for line in written if not line.startswith(timed)] == [line for line in lines
+                                                                       if not line.startswith(timed)]
+    assert written[-1].startswith("dnaspaces_history_last_run_timestamp_seconds ")
+    metrics.reset()
+    assert metrics.report()["windows"] == []
+    # Quotes and backslashes in a tenant would otherwise end the label value early
+    metrics.record_window('tenant "1"\\', window, {"status_code": 200, "complete": True, "elapsed": 1.0, "bytes": 1000,
+                                                    "lines": 11})
+    assert 'dnaspaces_history_fetch_rows{tenant="tenant \\"1\\"\\\\"} 10' in metrics.prometheus_lines()
+
+
+def test_main_metrics(tmpdir, monkeypatch):
+    test_filename = os.path.join(str(tmpdir), "temp.csv")
+    report_file = os.path.join(str(tmpdir), "metrics.json")
+    textfile = os.path.join(str(tmpdir), "metrics.prom")
+    end = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0) - timedelta(hours=1)
+    start = end - timedelta(hours=2)
+    with MockHistoryServer(rows_per_hour=100, error_rate=0.5) as server:
+        monkeypatch.setenv("DNASPACES_URL", server.url)
+        monkeypatch.setenv("TOKEN", "TEST_TOKEN")
+        monkeypatch.setattr("dnaspaces_client.sleep", lambda seconds: None)
+        assert main(["-st", start.isoformat(), "-et", end.isoformat(), "-f", test_filename, "-tz", "Australia/Sydney",
+                     "-mj", report_file, "-mp", textfile])
+        errors = server.errors
+    with open(report_file) as f:
+        report = json.load(f)
+    (tenant_totals,) = report["tenants"].values()
+    assert tenant_totals["windows"] == len(report["windows"]) > 0
+    assert tenant_totals["failed_windows"] == 0
+    assert tenant_totals["rows"] == 200
+    assert tenant_totals["retries"] == errors
+    assert all(window["ttfb_seconds"] <= window["seconds"] for window in report["windows"])
+    assert report["convert"]["rows"] == 200
+    with open(textfile) as f:
+        lines = f.read().splitlines()
+    assert "# TYPE dnaspaces_history_fetch_rows gauge" in lines
+    assert "dnaspaces_history_convert_rows 200" in lines
+    assert run_metrics.report()["windows"] == report["windows"]
@@ -0,0 +1,33 @@
+from history_mock_server import MockHistoryServer
+from history_benchmark import run_benchmarks, compare_results
+from dnaspaces_get_history import get_client_history
+from datetime import datetime, timedelta, timezone
+import pandas as pd
+import requests
+import os
+
+
+def test_mock_history_server(tmpdir, monkeypatch):
+    test_filename = os.path.join(str(tmpdir), "temp.csv")
+    end = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    windows = [(end - timedelta(hours=2), end - timedelta(hours=1)), (end - timedelta(hours=1), end)]
+    with MockHistoryServer(rows_per_hour=100, error_rate=0.5) as server:
+        assert requests.get(server.url, params={"startTime": 0, "endTime": 1}).status_code == 401
+        monkeypatch.setenv("DNASPACES_URL", server.url)
+        monkeypatch.setenv("TOKEN", "TEST_TOKEN")
+        # Half of the requests fail and are retried
+        assert get_client_history(windows, test_filename, workers=2) == 202
+        assert server.requests == 2 + server.errors
+    df = pd.read_csv(test_filename)
+    assert len(df) == 200
+    assert df.sourcetimestamp.is_monotonic_increasing
+
+
+def test_run_benchmarks():
+    report = run_benchmarks(rows_per_hour=100, hours=1, benchmarks=["get_client_history", "convert_history"])
+    assert [result["name"] for result in report["results"]] == ["get_client_history", "convert_history"]
+    assert all(result["rows"] == 101 and result["rows_per_second"] > 0 for result in report["results"])
+    previous = {"results": [dict(result, rows_per_second=result["rows_per_second"] / 2)
+                            for result in report["results"]]}
+    assert compare_results(report, previous)[0].startswith("get_client_history:")
+    assert "(+100.0%)" in compare_results(report, previous)[0]
@@ -0,0 +1,55 @@
+from history_store import ingest_history, open_store, where_was, shared_floor, time_range_ms, timestamp_ms, \
+    client_column
+from datetime import datetime
+import pandas as pd
+import os
+
+
+def test_timestamp_ms():
+    assert list(timestamp_ms(pd.Series(["1589086604182"]), "Australia/Sydney")) == [1589086604182]
+    assert list(timestamp_ms(pd.Series(["2020-05-10 14:56:44"]), "Australia/Sydney")) == [1589086604000]
+    assert time_range_ms(datetime(2020, 5, 10, 14, 56, 44), datetime(2020, 5, 10, 15), "Australia/Sydney") == \
+        (1589086604000, 1589086800000)
+    assert client_column("9c:ff:d0:aa:50:ff") == "macaddress"
+    assert client_column("test_user") == "username"
+
+
+def test_history_store(tmpdir):
+    tmpdir = str(tmpdir)
+    data_file = os.path.join(tmpdir, "temp.csv")
+    db_file = os.path.join(tmpdir, "history.db")
+    minute = 60 * 1000
+    df = pd.DataFrame({"macaddress": ["aa:aa:aa:aa:aa:aa", "bb:bb:bb:bb:bb:bb", "cc:cc:cc:cc:cc:cc",
+                                      "aa:aa:aa:aa:aa:aa", "dd:dd:dd:dd:dd:dd"],
+                       "username": ["alice", "", "carol", "alice", "dave"],
+                       "floorid": ["floor1", "floor1", "floor2", "floor2", "floor1"],
+                       "floorhierarchy": ["Campus>Building>Level 1", "Campus>Building>Level 1",
+                                          "Campus>Building>Level 2", "Campus>Building>Level 2",
+                                          "Campus>Building>Level 1"],
+                       "sourcetimestamp": [1589086604182, 1589086604182 + 5 * minute, 1589086604182 + 40 * minute,
+                                           1589086604182 + 45 * minute, 1589086604182 + 90 * minute]})
+    df.to_csv(data_file)
+    assert ingest_history(data_file, db_file, "Australia/Sydney") == 5
+    # An unchanged file is only loaded once
+    assert ingest_history(data_file, db_file, "Australia/Sydney") == 0
+    # Loading a file again replaces the rows it loaded before, whether it was forced or the file changed
+    assert ingest_history(data_file, db_file, "Australia/Sydney", force=True) == 5
+    df.iloc[:4].to_csv(data_file)
+    os.utime(data_file, (0, 0))
+    assert ingest_history(data_file, db_file, "Australia/Sydney") == 4
+    df.to_csv(data_file)
+    assert ingest_history(data_file, db_file, "Australia/Sydney") == 5
+    conn = open_store(db_file)
+    assert conn.execute("SELECT COUNT(*) FROM history").fetchone() == (5,)
+    assert "Unnamed: 0" not in [row[1] for row in conn.execute("PRAGMA table_info(history)")]
+    plan = " ".join(row[-1] for row in conn.execute(
+        "EXPLAIN QUERY PLAN SELECT * FROM history WHERE macaddress = 'x' AND ts_ms BETWEEN 0 AND 1"))
+    assert "history_macaddress" in plan
+    (columns, rows) = where_was(conn, "aa:aa:aa:aa:aa:aa", 1589086604182, 1589086604182 + 60 * minute)
+    assert [row[columns.index("floorid")] for row in rows] == ["floor1", "floor2"]
+    (columns, rows) = where_was(conn, "alice", 1589086604182, 1589086604182)
+    assert len(rows) == 1
+    (columns, rows) = shared_floor(conn, "aa:aa:aa:aa:aa:aa", 1589086604182, 1589086604182 + 60 * minute, 10)
+    assert [row[0] for row in rows] == ["bb:bb:bb:bb:bb:bb", "cc:cc:cc:cc:cc:cc"]
+    assert rows[0][columns.index("sightings")] == 1
+    conn.close()
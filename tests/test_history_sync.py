@@ -0,0 +1,39 @@
+from history_sync import get_sync_run_filename, append_history, save_sync_state, load_sync_state, get_sync_start
+from history_compression import open_history
+from datetime import datetime, timedelta, timezone
+import pytest
+import os
+
+
+def test_get_sync_run_filename():
+    assert get_sync_run_filename("history.csv") == "history.csv.sync-run"
+    assert get_sync_run_filename("history.csv.gz") == "history.csv.sync-run.gz"
+
+
+def test_get_sync_start(tmpdir):
+    dataset_file = os.path.join(str(tmpdir), "history.csv")
+    assert get_sync_start(dataset_file) is None
+    end = datetime.now(timezone.utc) - timedelta(days=2)
+    save_sync_state({"end": end.isoformat(), "rows": 1}, dataset_file)
+    assert load_sync_state(dataset_file)["rows"] == 1
+    assert get_sync_start(dataset_file) == end
+    # A mark DNA Spaces no longer has the history for starts the sync just inside the 30 days it keeps
+    save_sync_state({"end": (end - timedelta(days=29)).isoformat(), "rows": 1}, dataset_file)
+    start = get_sync_start(dataset_file)
+    assert timedelta(days=29, hours=23) < datetime.now(timezone.utc) - start < timedelta(days=30)
+
+
+@pytest.mark.parametrize("filename", ["history.csv", "history.csv.gz"])
+def test_append_history(tmpdir, filename):
+    dataset_file = os.path.join(str(tmpdir), filename)
+    run_file = get_sync_run_filename(dataset_file)
+    for rows in [["16655,1"], ["16655,2", "16655,3"]]:
+        with open_history(run_file, "wt") as f:
+            f.write("tenantid,sourcetimestamp\n" + "\n".join(rows) + "\n")
+        assert append_history(run_file, dataset_file)
+        assert not os.path.isfile(run_file)
+    with open_history(dataset_file, "rt") as f:
+        assert f.read() == "tenantid,sourcetimestamp\n16655,1\n16655,2\n16655,3\n"
+    with open_history(run_file, "wt") as f:
+        f.write("tenantid,macaddress,sourcetimestamp\n16655,9c:ff:d0:aa:50:ff,4\n")
+    assert not append_history(run_file, dataset_file)
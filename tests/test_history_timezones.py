@@ -0,0 +1,91 @@
+from history_timezones import SiteTimezones, offset_table, load_site_timezones
+from convert_history import convert_history, local_datetimes
+import numpy as np
+import pandas as pd
+import pytest
+import json
+import os
+
+
+def test_offset_table():
+    # Sydney leaves daylight saving at 3am on 5 April 2020 and Lord Howe Island moves by half an hour at 2am
+    (starts, offsets) = offset_table("Australia/Sydney", 1585872000000, 1586217600000)
+    assert list(starts) == [1585872000000, 1586016000000]
+    assert list(offsets) == [11 * 3600000, 10 * 3600000]
+    (starts, offsets) = offset_table("Australia/Lord_Howe", 1585872000000, 1586217600000)
+    assert list(offsets) == [11 * 3600000, 10.5 * 3600000]
+    assert starts[1] == 1586012400000
+    (starts, offsets) = offset_table("Asia/Kolkata", 1585872000000, 1586217600000)
+    assert list(offsets) == [5.5 * 3600000]
+
+
+def test_site_timezones():
+    zones = ["Australia/Perth", "Pacific/Auckland", "America/New_York", "Australia/Lord_Howe", "Europe/London"]
+    buildings = {f"building{i}": zones[i % len(zones)] for i in range(8)}
+    campuses = {"campus0": "Asia/Tokyo"}
+    site = SiteTimezones("Australia/Sydney", buildings, campuses)
+    rng = np.random.default_rng(0)
+    rows = 20000
+    building = rng.integers(0, 10, rows)
+    # A year of times crossing every daylight saving change of the zones
+    ms = rng.integers(1577836800000, 1609459200000, rows)
+    ms[::100] = 0
+    df = pd.DataFrame({"buildingid": [f"building{i}" for i in building],
+                       "campusid": [f"campus{i % 2}" for i in building],
+                       "sourcetimestamp": ms.astype(str)})
+    local = local_datetimes(df["sourcetimestamp"], site, df)
+    for i in range(10):
+        zone = buildings.get(f"building{i}", campuses.get(f"campus{i % 2}", "Australia/Sydney"))
+        rows = (building == i) & (ms != 0)
+        expected = pd.to_datetime(ms[rows], unit="ms", utc=True).tz_convert(zone).tz_localize(None).to_numpy()
+        assert (local[rows] == expected).all()
+    assert np.isnat(local[ms == 0]).all()
+    # Without site columns every row is in the default time zone
+    default = local_datetimes(df["sourcetimestamp"], site, df[["sourcetimestamp"]])
+    assert pd.Series(default).equals(pd.Series(local_datetimes(df["sourcetimestamp"], "Australia/Sydney")))
+
+
+def test_convert_history_site_timezones(tmpdir):
+    test_filename = os.path.join(str(tmpdir), "temp.csv")
+    site_filename = os.path.join(str(tmpdir), "sites.json")
+    with open(site_filename, "w") as f:
+        json.dump({"buildings": {"building2": "Pacific/Auckland"}, "campuses": {"campus2": "Australia/Perth"}}, f)
+    pd.DataFrame({"buildingid": ["building1", "building2", "building3"],
+                  "campusid": ["campus1", "campus1", "campus2"],
+                  "sourcetimestamp": [1590019287571] * 3}).to_csv(test_filename)
+    site = load_site_timezones(site_filename, "Australia/Sydney")
+    assert str(site) == "Australia/Sydney with 1 buildings and 1 campuses in 3 time zones"
+    assert convert_history(test_filename, site, False) == test_filename
+    df = pd.read_csv(test_filename)
+    assert list(df.sourcetimestamp) == ["2020-05-21 10:01:27", "2020-05-21 12:01:27", "2020-05-21 08:01:27"]
+    with open(site_filename, "w") as f:
+        json.dump({"buildings": {"building2": "Mars/Olympus_Mons"}}, f)
+    assert load_site_timezones(site_filename, "Australia/Sydney") is None
+
+
+def test_convert_history_site_timezones_columnar(tmpdir):
+    pytest.importorskip("pyarrow")
+    test_filename = os.path.join(str(tmpdir), "temp.csv")
+    pd.DataFrame({"buildingid": ["building1", "building2"],
+                  "sourcetimestamp": [1590019287571] * 2}).to_csv(test_filename, index=False)
+    site = SiteTimezones("Australia/Sydney", {"building2": "Pacific/Auckland"})
+    out_file = convert_history(test_filename, site, False, "parquet")
+    df = pd.read_parquet(out_file)
+    assert df.sourcetimestamp.dt.tz is None
+    assert list(df.sourcetimestamp.astype(str)) == ["2020-05-21 10:01:27.571", "2020-05-21 12:01:27.571"]
+
+
+@pytest.mark.parametrize("output_format", ["csv", "parquet"])
+def test_convert_history_site_timezones_columns(tmpdir, output_format):
+    if output_format != "csv":
+        pytest.importorskip("pyarrow")
+    test_filename = os.path.join(str(tmpdir), "temp.csv")
+    pd.DataFrame({"buildingid": ["building1", "building2"], "floorid": ["floor1", "floor1"],
+                  "sourcetimestamp": [1590019287571] * 2}).to_csv(test_filename, index=False)
+    site = SiteTimezones("Australia/Sydney", {"building2": "Pacific/Auckland"})
+    # The buildingid is read to find the time zone of each row even though it is not kept
+    history_filter = {"columns": ["sourcetimestamp"], "rows": {"floorid": {"floor1"}}}
+    out_file = convert_history(test_filename, site, False, output_format, history_filter=history_filter)
+    df = pd.read_csv(out_file, index_col=0) if output_format == "csv" else pd.read_parquet(out_file)
+    assert list(df.columns) == ["sourcetimestamp"]
+    assert [str(value)[:19] for value in df.sourcetimestamp] == ["2020-05-21 10:01:27", "2020-05-21 12:01:27"]